@@ -0,0 +1,86 @@
+import numpy as np
+
+
+def match_targetids(targetids, reference_targetids, allow_duplicates=False):
+    """Find the rows of a reference catalog matching a list of TARGETIDs.
+
+    Uses a sorted index of the reference TARGETIDs and a single searchsorted,
+    so the cost is O((N + M) log M) instead of one full scan per target.
+
+    Parameters
+    ----------
+    targetids : array
+        TARGETIDs we want to look up.
+    reference_targetids : array
+        TARGETID column of the catalog we are matching against.
+    allow_duplicates : bool, optional
+        If False, raise an error when the reference catalog has repeated TARGETIDs.
+        If True, match each target to the first occurrence in the reference catalog,
+        by default False
+
+    Returns
+    -------
+    array
+        Index into the reference catalog for each target. Only valid where found is True.
+    array
+        Boolean mask of the targets that were found in the reference catalog.
+    """
+    targetids = np.asarray(targetids)
+    reference_targetids = np.asarray(reference_targetids)
+
+    if reference_targetids.size == 0:
+        return np.zeros(targetids.size, dtype=int), np.zeros(targetids.size, dtype=bool)
+
+    # A stable sort keeps the first occurrence first when there are duplicates
+    sort_idx = np.argsort(reference_targetids, kind='stable')
+    sorted_ids = reference_targetids[sort_idx]
+
+    duplicates = sorted_ids[1:] == sorted_ids[:-1]
+    if np.any(duplicates) and not allow_duplicates:
+        dup_ids = np.unique(sorted_ids[1:][duplicates])
+        raise ValueError(
+            f'Found {dup_ids.size} duplicated TARGETIDs in the reference catalog, '
+            f'e.g. {dup_ids[:5]}. Pass allow_duplicates=True to match the first occurrence.'
+        )
+
+    pos = np.searchsorted(sorted_ids, targetids, side='left')
+    pos = np.clip(pos, 0, sorted_ids.size - 1)
+    found = sorted_ids[pos] == targetids
+
+    return sort_idx[pos], found
+
+
+def join_on_targetid(targetids, reference, columns, fill_values, allow_duplicates=False):
+    """Copy columns from a reference catalog onto a list of TARGETIDs.
+
+    Parameters
+    ----------
+    targetids : array
+        TARGETIDs of the catalog we are adding columns to.
+    reference : structured array or Table
+        Catalog with a TARGETID column and the columns to copy.
+    columns : list
+        Names of the columns to copy.
+    fill_values : dict
+        Value used for each column when a target is missing from the reference catalog.
+    allow_duplicates : bool, optional
+        Passed to match_targetids, by default False
+
+    Returns
+    -------
+    dict
+        New column arrays, keyed by column name.
+    array
+        Boolean mask of the targets that were found in the reference catalog.
+    """
+    idx, found = match_targetids(targetids, reference['TARGETID'], allow_duplicates)
+
+    new_columns = {}
+    for col in columns:
+        ref_col = np.asarray(reference[col])
+        dtype = np.result_type(ref_col.dtype, np.asarray(fill_values[col]).dtype)
+        new_col = np.full((len(idx), *ref_col.shape[1:]), fill_values[col], dtype=dtype)
+        new_col[found] = ref_col[idx[found]]
+        new_columns[col] = new_col
+
+    return new_columns, found
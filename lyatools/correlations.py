@@ -1,4 +1,4 @@
-from . import submit_utils
+from . import submit_utils, provenance, runtime_model
 
 JOB_CONFIGS = {'cf_lya_lya': 1.5, 'dmat_lya_lya': 2.0, 'metal_dmat_lya_lya': 2.0,
                'cf_lya_lyb': 1.0, 'dmat_lya_lyb': 1.0, 'metal_dmat_lya_lyb': 1.0,
@@ -61,9 +61,17 @@ def run_correlation(
     dmat=False, metal_dmat=False, name='cf_lya_lya', shuffled=False,
     delta_job_ids=None,
 ):
+    # Explicit walltimes take precedence over the runtime history
+    runtime_key = {
+        'stage': name, 'shuffled': shuffled, 'nside': config.getint('nside'),
+        'num_bins_rp': config.getint('num_bins_rp'), 'num_bins_rt': config.getint('num_bins_rt'),
+        'rp_max': config.getfloat('rp_max'), 'rt_max': config.getfloat('rt_max'),
+        'rmu': config.getboolean('r_mu_binning', False)
+    }
+    catalog_size = runtime_model.catalog_size(qso_cat) if cross else None
     slurm_hours = config.getfloat(f'{name}_slurm_hours', None)
     if slurm_hours is None:
-        slurm_hours = JOB_CONFIGS[name]
+        slurm_hours = submit_utils.job_hours(runtime_key, JOB_CONFIGS[name], catalog_size)
 
     # Make the header
     header = submit_utils.make_header(
@@ -93,10 +101,6 @@ def run_correlation(
     else:
         output_path = analysis_tree.corr_dir / f'{name}_{zmin}_{zmax}_{name_string}.fits{gzed}'
 
-    if output_path.is_file():
-        print(f'Correlation already exists, skipping: {output_path}.')
-        return output_path, None
-
     # Get setting we need
     env_command = job.get('env_command')
     nside = config.getint('nside')
@@ -116,10 +120,8 @@ def run_correlation(
     zerr_cut_kms = config.getfloat('zerr_cut_kms', None)
     nproc = config.getint('nproc', 128)
 
-    # Create the script
-    text = header
-    text += f'{env_command}\n\n'
-    text += f'picca_{script_type}.py '
+    # Create the command
+    text = f'picca_{script_type}.py '
     text += f'--out {output_path} '
 
     if cross and lyb:
@@ -186,7 +188,27 @@ def run_correlation(
     if rmu_binning:
         text += '--rmu-binning '
 
-    text += '\n\n'
+    inputs = [in_dir]
+    if lyb and not cross:
+        inputs += [in_dir2]
+    if cross:
+        inputs += [qso_cat]
+
+    executor = submit_utils.get_executor()
+    queued_job_id = provenance.queued_job_id(output_path, executor)
+    if queued_job_id is not None:
+        print(f'Correlation {output_path} is being computed by job {queued_job_id}.')
+        return output_path, queued_job_id
+
+    if provenance.is_up_to_date(
+            output_path, text, executor, inputs=inputs, upstream_job_ids=delta_job_ids):
+        print(f'Correlation already exists, skipping: {output_path}.')
+        return output_path, None
+
+    if not job.getboolean('no_submit'):
+        provenance.write_pending(output_path, text, inputs=inputs)
+        text += provenance.finalize_command(output_path)
+    text = header + f'{env_command}\n\n' + text + '\n\n'
 
     script_path = analysis_tree.scripts_dir / f'{name}_{zmin}_{zmax}.sh'
     if shuffled:
@@ -196,5 +218,7 @@ def run_correlation(
 
     job_id = submit_utils.run_job(
         script_path, dependency_ids=delta_job_ids, no_submit=job.getboolean('no_submit'))
+    submit_utils.record_job(
+        job_id, runtime_key, catalog_size, catalog=qso_cat if cross else None)
 
     return output_path, job_id
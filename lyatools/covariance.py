@@ -0,0 +1,255 @@
+"""Covariance of the correlation functions measured in the mocks.
+
+The full covariance joins the correlations (e.g. lyaxlya, lyaxlyb, lyaxqso, lybxqso) into
+one vector per healpix and computes the weighted covariance of these vectors, either
+directly or accumulated one mock at a time. The smoothing averages the correlation
+coefficients of bin pairs with the same separation in (r_par, r_trans) within each pair
+of correlation blocks.
+
+This module only depends on numpy so that the stacking scripts can use it without
+importing the rest of lyatools.
+"""
+from functools import lru_cache
+
+import numpy as np
+
+
+def compute_covariance(xi, weights):
+    """Weighted covariance of rows that fit in memory, same as picca.utils.compute_cov.
+
+    Parameters
+    ----------
+    xi : array
+        Correlations with shape (num_rows, num_bins)
+    weights : array
+        Weights with the same shape as xi
+
+    Returns
+    -------
+    array
+        Covariance matrix with shape (num_bins, num_bins)
+    """
+    # The healpix caches hold float32 correlations, accumulate in float64
+    xi = np.asarray(xi, dtype=float)
+    weights = np.asarray(weights, dtype=float)
+
+    sum_weights = weights.sum(axis=0)
+    mean_xi = (xi * weights).sum(axis=0)
+    w = sum_weights > 0.
+    mean_xi[w] /= sum_weights[w]
+
+    meanless_xi_weighted = weights * (xi - mean_xi)
+    covariance = meanless_xi_weighted.T.dot(meanless_xi_weighted)
+    sum_weights_squared = np.outer(sum_weights, sum_weights)
+    w = sum_weights_squared > 0.
+    covariance[w] /= sum_weights_squared[w]
+
+    return covariance
+
+
+class StreamingCovariance:
+    """Weighted covariance of per-healpix correlations, updated incrementally.
+
+    Gives the same result as picca.utils.compute_cov on the stacked arrays:
+
+        mean = sum_r(w_r * xi_r) / sum_r(w_r)
+        cov = D^T D / outer(sum_r(w_r), sum_r(w_r)),  with D_r = w_r * (xi_r - mean)
+
+    without holding all the rows in memory. The weighted mean is updated with each new
+    set of rows, and the centered cross-product matrix is shifted to the new mean
+    using two other (N_bins, N_bins) accumulators:
+
+        cross[i, j] = sum_r w_ri (xi_ri - mean_i) w_rj
+        weights_sq[i, j] = sum_r w_ri w_rj
+
+    so memory only depends on the number of bins. Accumulators filled with separate
+    sets of rows (e.g. in different processes) can be combined with merge.
+
+    Parameters
+    ----------
+    num_bins : int
+        Number of correlation bins (columns of xi)
+    """
+    def __init__(self, num_bins):
+        self.num_bins = num_bins
+        self.num_rows = 0
+        self.sum_weights = np.zeros(num_bins)
+        self.sum_weighted_xi = np.zeros(num_bins)
+        self.mean = np.zeros(num_bins)
+        self.centered = np.zeros((num_bins, num_bins))
+        self.cross = np.zeros((num_bins, num_bins))
+        self.weights_sq = np.zeros((num_bins, num_bins))
+
+    def add(self, xi, weights):
+        """Add rows of correlations with shape (num_rows, num_bins) and their weights."""
+        xi = np.atleast_2d(np.asarray(xi, dtype=float))
+        weights = np.atleast_2d(np.asarray(weights, dtype=float))
+        if xi.shape != weights.shape or xi.shape[1] != self.num_bins:
+            raise ValueError(f'Expected xi and weights with {self.num_bins} bins, got '
+                             f'shapes {xi.shape} and {weights.shape}.')
+
+        self.sum_weights += weights.sum(axis=0)
+        self.sum_weighted_xi += (weights * xi).sum(axis=0)
+        self._shift_to(self._weighted_mean())
+
+        meanless_xi_weighted = weights * (xi - self.mean)
+        self.centered += meanless_xi_weighted.T.dot(meanless_xi_weighted)
+        self.cross += meanless_xi_weighted.T.dot(weights)
+        self.weights_sq += weights.T.dot(weights)
+        self.num_rows += xi.shape[0]
+
+    def merge(self, other):
+        """Add the rows accumulated by another StreamingCovariance."""
+        if other.num_bins != self.num_bins:
+            raise ValueError(f'Cannot merge covariances with {other.num_bins} and '
+                             f'{self.num_bins} bins.')
+
+        self.sum_weights += other.sum_weights
+        self.sum_weighted_xi += other.sum_weighted_xi
+        new_mean = self._weighted_mean()
+        self._shift_to(new_mean)
+
+        other_centered, other_cross = _shift(
+            other.centered, other.cross, other.weights_sq, other.mean - new_mean)
+        self.centered += other_centered
+        self.cross += other_cross
+        self.weights_sq += other.weights_sq
+        self.num_rows += other.num_rows
+
+    def _weighted_mean(self):
+        mean = self.sum_weighted_xi.copy()
+        w = self.sum_weights > 0.
+        mean[w] /= self.sum_weights[w]
+        return mean
+
+    def _shift_to(self, new_mean):
+        self.centered, self.cross = _shift(
+            self.centered, self.cross, self.weights_sq, self.mean - new_mean)
+        self.mean = new_mean
+
+    def covariance(self):
+        """Return the covariance matrix of the rows added so far."""
+        covariance = self.centered.copy()
+        sum_weights_squared = np.outer(self.sum_weights, self.sum_weights)
+        w = sum_weights_squared > 0.
+        covariance[w] /= sum_weights_squared[w]
+
+        return covariance
+
+
+def _shift(centered, cross, weights_sq, delta):
+    """Move the centered accumulators to a new mean: xi - new_mean = (xi - mean) + delta."""
+    cross_delta = cross * delta[None, :]
+    centered = centered + cross_delta + cross_delta.T + np.outer(delta, delta) * weights_sq
+    cross = cross + delta[:, None] * weights_sq
+    return centered, cross
+
+
+def get_binning(header):
+    """Binning of a correlation, (NP, NT, RPMIN, RPMAX, RTMAX), from its header."""
+    return (int(header['NP']), int(header['NT']), float(header['RPMIN']),
+            float(header['RPMAX']), float(header['RTMAX']))
+
+
+def bin_grid(binning):
+    """Bin centers of a correlation with the binning returned by get_binning.
+
+    Returns
+    -------
+    (r_par, r_trans, delta_r_par, delta_r_trans) : tuple
+        Bin centers in the picca bin order (r_par major) and bin sizes
+    """
+    num_rp, num_rt, r_par_min, r_par_max, r_trans_max = binning
+    delta_r_par = (r_par_max - r_par_min) / num_rp
+    delta_r_trans = r_trans_max / num_rt
+
+    r_par = r_par_min + (np.arange(num_rp) + 0.5) * delta_r_par
+    r_trans = (np.arange(num_rt) + 0.5) * delta_r_trans
+    return np.repeat(r_par, num_rt), np.tile(r_trans, num_rp), delta_r_par, delta_r_trans
+
+
+@lru_cache(maxsize=32)
+def pair_geometry(binning_a, binning_b, same_block=False):
+    """Separation index of every bin pair between two blocks, and the pairs per index.
+
+    The index combines the separations |Delta r_par| and |Delta r_trans| in units of the
+    bin size. It only depends on the binning, so it is computed once per process and
+    reused for every mock. Within the same block, the diagonal is left out of the
+    counts. The diagonal bins all have index 0.
+
+    Returns
+    -------
+    (key, counts) : tuple
+        Index array with shape (num_bins_a, num_bins_b) and number of pairs per index
+    """
+    r_par_a, r_trans_a, delta_r_par_a, delta_r_trans_a = bin_grid(binning_a)
+    r_par_b, r_trans_b, delta_r_par_b, delta_r_trans_b = bin_grid(binning_b)
+    delta_r_par = max(delta_r_par_a, delta_r_par_b)
+    delta_r_trans = max(delta_r_trans_a, delta_r_trans_b)
+
+    ind_drp = np.rint(np.abs(r_par_b[None, :] - r_par_a[:, None]) / delta_r_par)
+    ind_drt = np.rint(np.abs(r_trans_b[None, :] - r_trans_a[:, None]) / delta_r_trans)
+    key = ind_drp.astype(np.int64) * (int(ind_drt.max()) + 1) + ind_drt.astype(np.int64)
+
+    counts = np.bincount(key.ravel())
+    if same_block:
+        counts[0] -= key.shape[0]
+
+    # The index is small, so keep the cached arrays compact
+    dtype = np.int16 if counts.size <= np.iinfo(np.int16).max else np.int32
+    key = key.astype(dtype)
+    key.flags.writeable = False
+    counts.flags.writeable = False
+    return key, counts
+
+
+def smooth_covariance(covariance, binnings):
+    """Smooth a covariance made of one or more correlation blocks.
+
+    For each pair of blocks, the correlation coefficients of all bin pairs with the same
+    separation (|Delta r_par|, |Delta r_trans|), in units of the bin size, are replaced
+    by their mean. Within a block, the diagonal is excluded from the means and set to 1.
+
+    Parameters
+    ----------
+    covariance : array
+        Covariance matrix of the concatenated blocks
+    binnings : list
+        Output of get_binning for each block, in the order of the blocks
+
+    Returns
+    -------
+    array
+        Smoothed covariance matrix
+    """
+    var = np.diagonal(covariance)
+    if np.any(var == 0.):
+        print('WARNING: data has some empty bins, impossible to smooth')
+        return covariance
+
+    sigma = np.sqrt(var)
+    correlation = covariance / np.outer(sigma, sigma)
+    smooth_correlation = np.zeros_like(correlation)
+
+    starts = np.cumsum([0] + [binning[0] * binning[1] for binning in binnings])
+    for a in range(len(binnings)):
+        for b in range(a, len(binnings)):
+            block_a = slice(starts[a], starts[a + 1])
+            block_b = slice(starts[b], starts[b + 1])
+            key, counts = pair_geometry(binnings[a], binnings[b], same_block=(a == b))
+
+            block = correlation[block_a, block_b]
+            sum_correlation = np.bincount(key.ravel(), weights=block.ravel(),
+                                          minlength=counts.size)
+            if a == b:
+                sum_correlation[0] -= np.trace(block)
+            mean_correlation = sum_correlation / np.maximum(counts, 1)
+
+            smooth_block = mean_correlation[key]
+            if a == b:
+                np.fill_diagonal(smooth_block, 1.)
+
+            smooth_correlation[block_a, block_b] = smooth_block
+            smooth_correlation[block_b, block_a] = smooth_block.T
+
+    return smooth_correlation * np.outer(sigma, sigma)
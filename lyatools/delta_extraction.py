@@ -1,6 +1,6 @@
 from configparser import ConfigParser
 
-from . import submit_utils
+from . import submit_utils, runtime_model
 
 
 def make_picca_delta_runs(
@@ -61,11 +61,15 @@ def run_delta_extraction(
     run_name = f'picca_delta_extraction_{region_name}_{type}'
     script_path = analysis_tree.scripts_dir / f'run_{run_name}.sh'
 
+    runtime_key = {'stage': 'delta_extraction', 'region': region_name, 'type': type,
+                   'nproc': nproc}
+    catalog_size = runtime_model.catalog_size(qso_cat)
     slurm_hours = config.getfloat(f'slurm_hours_{region_name}', None)
     if slurm_hours is None:
         slurm_hours = config.getfloat('slurm_hours', None)
         if slurm_hours is None:
-            slurm_hours = 0.5 if true_continuum else 1.
+            slurm_hours = submit_utils.job_hours(
+                runtime_key, 0.5 if true_continuum else 1., catalog_size)
 
     # Make the header
     header = submit_utils.make_header(
@@ -85,6 +89,7 @@ def run_delta_extraction(
 
     job_id = submit_utils.run_job(
         script_path, dependency_ids=job_id, no_submit=job.getboolean('no_submit'))
+    submit_utils.record_job(job_id, runtime_key, catalog_size, catalog=qso_cat)
 
     return job_id
 
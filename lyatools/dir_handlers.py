@@ -1,8 +1,14 @@
+import grp
+import os
+import stat
+from contextlib import contextmanager
 from typing import Union
 from pathlib import Path
-from subprocess import call
 from dataclasses import dataclass, field
 
+# Directories created by check_dir while a deferred_permissions block is active
+_DEFERRED_DIRS = None
+
 
 def make_symlink(target, link_name):
     """ Make a symbolic link named link_name pointing to target.
@@ -18,28 +24,89 @@ def make_symlink(target, link_name):
     link_name.symlink_to(target)
 
 
-def make_permission_group_desi(dir: Path):
+def set_permissions(dirs, group: str = 'desi', skip_if_parent_setgid: bool = True):
     """
-    Makes a directory and all its contents have DESI as their permission group.
+    Gives each directory the permission group, group rwx and setgid, without recursion.
     Args:
-        dir: Path
-            Directory to deal with.
+        dirs: list of Path
+            Directories to deal with. Their contents are left untouched.
+        group: str
+            Name of the permission group.
+        skip_if_parent_setgid: bool
+            Skip directories whose parent is not in dirs and already has setgid and
+            the right group. New directories inherit both from such a parent, and
+            get group rwx from the 0007 umask set by the lyatools scripts.
     """
-    call(f'chgrp -R desi {dir}', shell=True)
-    call(f'chmod -R g+rxw {dir}', shell=True)
-    call(f'chmod -R g+s {dir}', shell=True)
+    try:
+        gid = grp.getgrnam(group).gr_gid
+    except KeyError:
+        print(f'WARNING: Group {group} does not exist. Not changing directory permissions.')
+        return
+
+    dirs = list(dict.fromkeys(Path(dir) for dir in dirs))
+    new_dirs = set(dirs)
+    parent_ok = {}
+    for dir in dirs:
+        parent = dir.parent
+        if skip_if_parent_setgid and parent not in new_dirs:
+            if parent not in parent_ok:
+                parent_stat = os.stat(parent)
+                parent_ok[parent] = (parent_stat.st_mode & stat.S_ISGID
+                                     and parent_stat.st_gid == gid)
+            if parent_ok[parent]:
+                continue
+
+        try:
+            dir_stat = os.stat(dir)
+            mode = stat.S_IMODE(dir_stat.st_mode) | stat.S_IRWXG | stat.S_ISGID
+            if dir_stat.st_gid != gid:
+                os.chown(dir, -1, gid)
+                # chown can clear setgid, so always set the mode after it
+                os.chmod(dir, mode)
+            elif mode != stat.S_IMODE(dir_stat.st_mode):
+                os.chmod(dir, mode)
+        except PermissionError as error:
+            print(f'WARNING: Could not set the permissions of {dir}: {error}')
+
+
+@contextmanager
+def deferred_permissions(group: str = 'desi', skip_if_parent_setgid: bool = True):
+    """
+    Collects the directories created by check_dir and sets their permissions once on exit.
+    Nested blocks are merged into the outermost one.
+    Args:
+        group: str
+            Name of the permission group.
+        skip_if_parent_setgid: bool
+            Passed to set_permissions.
+    """
+    global _DEFERRED_DIRS
+    if _DEFERRED_DIRS is not None:
+        yield
+        return
+
+    _DEFERRED_DIRS = []
+    try:
+        yield
+    finally:
+        dirs, _DEFERRED_DIRS = _DEFERRED_DIRS, None
+        set_permissions(dirs, group, skip_if_parent_setgid)
 
 
 def check_dir(dir: Path):
     """
     Checks that a directory exists, and that its permission group is DESI.
+    Inside a deferred_permissions block, new directories are only fixed on exit.
     Args:
         dir: Path
             Directory to check
     """
     if not dir.is_dir():
         dir.mkdir(parents=True, exist_ok=True)
-        make_permission_group_desi(dir)
+        if _DEFERRED_DIRS is not None:
+            _DEFERRED_DIRS.append(dir)
+        else:
+            set_permissions([dir])
 
 
 @dataclass
@@ -0,0 +1,249 @@
+"""Backends used by submit_utils.run_job to execute the generated job scripts."""
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from subprocess import run
+
+
+SLURM_ACTIVE_STATES = ['PENDING', 'RUNNING', 'REQUEUED', 'CONFIGURING', 'COMPLETING',
+                       'SUSPENDED', 'RESIZING']
+
+
+def make_dependency_string(dependency_ids):
+    """Slurm dependency option for a list of job ids (empty string if there are none)."""
+    if not dependency_ids:
+        return ""
+    return f"--dependency=afterok:{':'.join(str(j) for j in dependency_ids)} "
+
+
+def parse_memory(value):
+    """Convert a sacct memory value (e.g. 1234K, 2.5G) to MB. Returns None if empty."""
+    value = value.strip()
+    if len(value) == 0:
+        return None
+
+    units = {'K': 1 / 1024, 'M': 1., 'G': 1024., 'T': 1024.**2}
+    if value[-1] in units:
+        return float(value[:-1]) * units[value[-1]]
+    return float(value) / 1024**2
+
+
+class SlurmExecutor:
+    """Submit the job scripts to Slurm with sbatch."""
+    name = 'slurm'
+
+    def submit(self, script, dependency_ids):
+        dependency = make_dependency_string(dependency_ids)
+        command = f"sbatch {dependency}{script}"
+
+        print(f'Submitting script {script}')
+        process = run(command + " | tr -dc '0-9'", shell=True, capture_output=True)
+
+        if process.returncode != 0:
+            raise ValueError(f'Running "{command}" returned non-zero exitcode '
+                             f'with error {process.stderr}')
+
+        try:
+            jobid = int(process.stdout)
+        except ValueError:
+            raise ValueError(f'Error getting jobid from output: {process.stdout}')
+
+        return jobid
+
+    def job_states(self, job_ids):
+        """Query sacct once for a list of jobs.
+
+        Returns a dictionary mapping job id to (state, elapsed seconds), where state is
+        one of 'PENDING', 'RUNNING', 'COMPLETED', 'TIMEOUT' or 'FAILED'. Jobs unknown to
+        sacct are left out.
+        """
+        command = ['sacct', '-n', '-X', '-P', '-o', 'JobID,State,ElapsedRaw',
+                   '-j', ','.join(str(j) for j in job_ids)]
+        try:
+            process = run(command, capture_output=True, text=True)
+        except FileNotFoundError:
+            print('WARNING: sacct not found. Could not update the job states.')
+            return {}
+
+        if process.returncode != 0:
+            print(f'WARNING: sacct returned non-zero exitcode with error {process.stderr}')
+            return {}
+
+        states = {}
+        for line in process.stdout.splitlines():
+            fields = line.strip().split('|')
+            if len(fields) < 3 or not fields[0].isdigit():
+                continue
+
+            slurm_state = fields[1].split()[0] if fields[1] else ''
+            if slurm_state == 'COMPLETED':
+                state = 'COMPLETED'
+            elif slurm_state == 'PENDING':
+                state = 'PENDING'
+            elif slurm_state in SLURM_ACTIVE_STATES:
+                state = 'RUNNING'
+            elif slurm_state == 'TIMEOUT':
+                state = 'TIMEOUT'
+            else:
+                state = 'FAILED'
+
+            elapsed = int(fields[2]) if fields[2].isdigit() else None
+            states[int(fields[0])] = (state, elapsed)
+
+        return states
+
+    def job_resources(self, job_ids):
+        """Query sacct once for the peak memory of a list of jobs.
+
+        Returns a dictionary mapping job id to the largest MaxRSS of its steps, in MB.
+        """
+        command = ['sacct', '-n', '-P', '-o', 'JobID,MaxRSS',
+                   '-j', ','.join(str(j) for j in job_ids)]
+        try:
+            process = run(command, capture_output=True, text=True)
+        except FileNotFoundError:
+            return {}
+
+        if process.returncode != 0:
+            return {}
+
+        max_rss = {}
+        for line in process.stdout.splitlines():
+            fields = line.strip().split('|')
+            job_id = fields[0].split('.')[0]
+            if len(fields) < 2 or not job_id.isdigit():
+                continue
+
+            rss = parse_memory(fields[1])
+            if rss is not None:
+                max_rss[int(job_id)] = max(rss, max_rss.get(int(job_id), 0.))
+
+        return max_rss
+
+    def wait(self):
+        """Slurm jobs run independently of this process, so there is nothing to wait for."""
+        return {}
+
+
+class LocalExecutor:
+    """Run the job scripts on the current node in a bounded pool.
+
+    Jobs get synthetic ids, counting up from 1, and honour afterok dependencies between
+    them: a job starts only after all its dependencies finished with exit code 0, and is
+    marked as failed without running otherwise. The #SBATCH --output/--error paths of
+    the script are used for its stdout/stderr, with %j replaced by the synthetic id.
+
+    Jobs are queued in submission order and can only depend on jobs submitted before
+    them, so a job waiting on its dependencies never blocks one of them from starting.
+    """
+    name = 'local'
+
+    def __init__(self, max_workers=1):
+        self.max_workers = max_workers
+        self._pool = ThreadPoolExecutor(max_workers=max_workers)
+        self._lock = threading.Lock()
+        self._futures = {}
+        self._scripts = {}
+        self._wall_times = {}
+        self._next_id = 1
+
+    def submit(self, script, dependency_ids):
+        with self._lock:
+            jobid = self._next_id
+            self._next_id += 1
+
+            dependencies = []
+            for dep_id in dependency_ids:
+                if dep_id not in self._futures:
+                    raise ValueError(f'Unknown dependency {dep_id} for local job {script}. '
+                                     'Mixing Slurm and local job ids is not supported.')
+                dependencies.append(self._futures[dep_id])
+
+            print(f'Queueing script {script} as local job {jobid}')
+            self._scripts[jobid] = script
+            self._futures[jobid] = self._pool.submit(self._run, script, jobid, dependencies)
+
+        return jobid
+
+    @staticmethod
+    def _get_log_paths(script, jobid):
+        paths = {}
+        with open(script) as f:
+            for line in f:
+                match = re.match(r'#SBATCH\s+--(output|error)[\s=]+(\S+)', line)
+                if match is not None:
+                    paths[match.group(1)] = match.group(2).replace('%j', str(jobid))
+        return paths.get('output'), paths.get('error')
+
+    def _run(self, script, jobid, dependencies):
+        for dep in dependencies:
+            if dep.result() != 0:
+                print(f'Local job {jobid} ({script}) not run because a dependency failed.')
+                return -1
+
+        out_path, err_path = self._get_log_paths(script, jobid)
+        out_file = open(out_path, 'w') if out_path is not None else None
+        err_file = open(err_path, 'w') if err_path is not None else None
+        start = time.time()
+        try:
+            process = run(['bash', '-l', str(script)], stdout=out_file, stderr=err_file)
+        finally:
+            self._wall_times[jobid] = int(time.time() - start)
+            for f in [out_file, err_file]:
+                if f is not None:
+                    f.close()
+
+        status = 'finished' if process.returncode == 0 else 'failed'
+        print(f'Local job {jobid} ({script}) {status} with exit code {process.returncode}.')
+        return process.returncode
+
+    def status(self, jobid):
+        """Return one of 'PENDING', 'RUNNING', 'COMPLETED' or 'FAILED'."""
+        future = self._futures[jobid]
+        if future.running():
+            return 'RUNNING'
+        if not future.done():
+            return 'PENDING'
+        return 'COMPLETED' if future.result() == 0 else 'FAILED'
+
+    def job_states(self, job_ids):
+        """Same as SlurmExecutor.job_states, for jobs queued by this executor."""
+        states = {}
+        for jobid in job_ids:
+            if jobid not in self._futures:
+                continue
+
+            state = self.status(jobid)
+            states[jobid] = (state, self._wall_times.get(jobid))
+
+        return states
+
+    def job_resources(self, job_ids):
+        """The peak memory of local jobs is not tracked."""
+        return {}
+
+    def wait(self):
+        """Block until all queued jobs are done and return the exit code of each job."""
+        with self._lock:
+            futures = dict(self._futures)
+
+        return_codes = {jobid: future.result() for jobid, future in futures.items()}
+        failed = [jobid for jobid, code in return_codes.items() if code != 0]
+        if failed:
+            print('Failed local jobs:')
+            for jobid in failed:
+                print(f'    {jobid}: {self._scripts[jobid]}')
+
+        return return_codes
+
+
+def make_executor(job_config):
+    """Make the executor selected by the "executor" option of the [job_info] section."""
+    name = job_config.get('executor', 'slurm')
+    if name == 'slurm':
+        return SlurmExecutor()
+    elif name == 'local':
+        return LocalExecutor(max_workers=job_config.getint('local_max_workers', 1))
+
+    raise ValueError(f'Unknown executor {name}. Choose from ["slurm", "local"].')
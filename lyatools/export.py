@@ -1,5 +1,6 @@
 from . import submit_utils
 from . import dir_handlers
+from . import provenance
 
 CORR_TYPES = {
     'cf_lya_lya': 'dmat_lya_lya', 'cf_lya_lyb': 'dmat_lya_lyb',
@@ -42,17 +43,25 @@ def make_export_runs(corr_paths, analysis_tree, config, job, corr_job_ids=None,
             raise ValueError(f'Unknown correlation type {corr_name_split[0]}')
 
         corr_dict[corr_type] = (cf_path, exp_file)
-        if not exp_file.is_file():
-            # Do the exporting
-            command = f'picca_export.py --data {cf_path} --out {exp_file} '
 
-            if shuffled_path is not None:
-                command += f'--remove-shuffled-correlation {shuffled_path} '
+        # Do the exporting
+        command = f'picca_export.py --data {cf_path} --out {exp_file} '
+        inputs = [cf_path]
 
-            if config.get(f'corr-mat-{corr_type}') is not None:
-                corr_mat = config.get(f'corr-mat-{corr_type}')
-                command += f'--cor {corr_mat} '
+        if shuffled_path is not None:
+            command += f'--remove-shuffled-correlation {shuffled_path} '
+            inputs += [shuffled_path]
 
+        if config.get(f'corr-mat-{corr_type}') is not None:
+            corr_mat = config.get(f'corr-mat-{corr_type}')
+            command += f'--cor {corr_mat} '
+            inputs += [corr_mat]
+
+        if not provenance.is_up_to_date(
+                exp_file, command, submit_utils.get_executor(), inputs=inputs):
+            if not job.getboolean('no_submit'):
+                provenance.write_pending(exp_file, command, inputs=inputs)
+                command += provenance.finalize_command(exp_file)
             export_commands += [command]
 
     if len(export_commands) < 1:
@@ -62,8 +71,9 @@ def make_export_runs(corr_paths, analysis_tree, config, job, corr_job_ids=None,
         return corr_dict, None, export_commands
 
     # Make the header
+    runtime_key = {'stage': 'export', 'num_commands': len(export_commands)}
     header = submit_utils.make_header(
-        job.get('nersc_machine'), time=0.2,
+        job.get('nersc_machine'), time=submit_utils.job_hours(runtime_key, 0.2),
         omp_threads=64, job_name=f'export_{analysis_tree.full_mock_seed}',
         err_file=analysis_tree.logs_dir/f'export-{analysis_tree.full_mock_seed}-%j.err',
         out_file=analysis_tree.logs_dir/f'export-{analysis_tree.full_mock_seed}-%j.out'
@@ -83,20 +93,20 @@ def make_export_runs(corr_paths, analysis_tree, config, job, corr_job_ids=None,
     job_id = corr_job_ids
     job_id = submit_utils.run_job(
         script_path, dependency_ids=corr_job_ids, no_submit=job.getboolean('no_submit'))
+    submit_utils.record_job(job_id, runtime_key)
 
     return corr_dict, job_id, None
 
 
 def export_full_cov(corr_paths, analysis_tree, config, job, corr_job_ids=None, run_local=True):
     subtract_shuffled = config.getboolean('subtract_shuffled')
+    use_cache = config.getboolean('healpix_cache', False)
     ordered_cf_paths = {}
-    block_types = []
 
     for cf_path in corr_paths:
         for key in CORR_TYPES:
             if key in cf_path.name:
                 ordered_cf_paths[key] = cf_path
-                block_types += ['cross'] if 'xcf' in key else ['auto']
 
                 if subtract_shuffled and 'xcf' in cf_path.name:
                     shuffled_path = submit_utils.append_string_to_correlation_path(
@@ -117,28 +127,32 @@ def export_full_cov(corr_paths, analysis_tree, config, job, corr_job_ids=None, r
     name = 'full_cov' if cov_string is None else f'full_cov_{cov_string}'
     output_path = corr_paths[0].parent / f'{name}.fits'
     output_path_smoothed = corr_paths[0].parent / f'{name}_smooth.fits'
-    block_types_str = ' '.join(block_types)
 
+    # Blocks in the order of CORR_TYPES, with the shuffled correlations next to their block
     commands = []
-    if not output_path.is_file():
-        command = '/global/cfs/projectdirs/desi/science/lya/y1-kp6/iron-tests'
-        command += '/correlations/scripts/write_full_covariance_matrix_flex_size_shuffled.py '
-        for key, path in ordered_cf_paths.items():
-            type = key.split('_')
-            field = f'{type[1]}-{type[2]}'
-            if len(type) > 3:
-                field += f'-{type[3]}'
-            command += f'--{field} {path} '
-
-        command += f'-o {output_path}\n'
-        commands += [command]
-
-    if not output_path_smoothed.is_file():
-        command = '/global/cfs/cdirs/desicollab/science/lya/y1-kp6/iron-tests/'
-        command += 'correlations/scripts/write_smooth_covariance_flex_size.py '
-        command += f'--input-cov {output_path} --output-cov {output_path_smoothed} '
-        command += f'--block-types {block_types_str}\n'
-        commands += [command]
+    command = 'lyatools-stack-fullcov '
+    for key in CORR_TYPES:
+        if key not in ordered_cf_paths:
+            continue
+
+        type = key.split('_')
+        command += f'--{type[1]}x{type[2]} {ordered_cf_paths[key]} '
+        if key + '-shuff' in ordered_cf_paths:
+            command += f'--{type[1]}x{type[2]}-shuffled {ordered_cf_paths[key + "-shuff"]} '
+
+    command += f'--outfile {output_path} --smooth-outfile {output_path_smoothed} --nproc 1'
+    if use_cache:
+        command += ' --healpix-cache'
+    inputs = list(ordered_cf_paths.values())
+    executor = submit_utils.get_executor()
+    if not all(provenance.is_up_to_date(path, command, executor, inputs=inputs)
+               for path in [output_path, output_path_smoothed]):
+        finalize = ''
+        if not job.getboolean('no_submit'):
+            for path in [output_path, output_path_smoothed]:
+                provenance.write_pending(path, command, inputs=inputs)
+                finalize += provenance.finalize_command(path)
+        commands += [command + finalize]
 
     # stacked_cov_flag = config.getboolean('stacked_cov_flag', False)
     # if stacked_cov_flag:
@@ -186,7 +200,8 @@ def export_full_cov(corr_paths, analysis_tree, config, job, corr_job_ids=None, r
 
 
 def stack_correlations(
-    corr_dict, stack_tree, job, shuffled=False, name_string=None, corr_job_ids=None
+    corr_dict, stack_tree, job, shuffled=False, name_string=None, corr_job_ids=None,
+    append=False, use_cache=False
 ):
     # Stack correlations from different seeds
     export_commands = []
@@ -222,21 +237,34 @@ def stack_correlations(
 
         if shuffled_files is not None:
             exp_out_file = submit_utils.append_string_to_correlation_path(exp_out_file, '-shuff')
-        if exp_out_file.is_file():
-            print(f'Exported correlation already exists: {exp_out_file}. Skipping.')
-            continue
 
-        command = f'lyatools-stack-export --data {in_files} --out {exp_out_file} '
+        command = f'lyatools-stack-export --data {in_files} --out {exp_out_file} --nproc 16 '
+        inputs = str_list
 
         if shuffled_files is not None:
             command += f'--shuffled-correlations {shuffled_files} '
+            inputs = inputs + shuffled_list
+
+        if append:
+            command += '--append '
 
+        if use_cache:
+            command += '--healpix-cache '
+
+        if provenance.is_up_to_date(
+                exp_out_file, command, submit_utils.get_executor(), inputs=inputs):
+            print(f'Exported correlation already exists: {exp_out_file}. Skipping.')
+            continue
+
+        if not job.getboolean('no_submit'):
+            provenance.write_pending(exp_out_file, command, inputs=inputs)
+            command += provenance.finalize_command(exp_out_file)
         export_commands += [command]
 
     # Make the header
     header = submit_utils.make_header(
         job.get('nersc_machine'), time=0.2,
-        omp_threads=64, job_name='stack_export',
+        omp_threads=8, job_name='stack_export',
         err_file=stack_tree.logs_dir/'stack_export-%j.err',
         out_file=stack_tree.logs_dir/'stack_export-%j.out'
     )
@@ -259,13 +287,12 @@ def stack_correlations(
 
 
 def stack_full_covariance(corr_dict, stack_tree, job, smooth_covariance_flag,
-                          corr_config, name_string=None, corr_job_ids=None):
+                          corr_config, name_string=None, corr_job_ids=None, use_cache=False):
     # Make correlation file lists
     lyaxlya_files = []
     lyaxlyb_files = []
     lyaxqso_files = []
     lybxqso_files = []
-    correlation_types = []
 
     for cf_name, (cf_list, _) in corr_dict.items():
         if len(cf_list) < 1:
@@ -273,16 +300,12 @@ def stack_full_covariance(corr_dict, stack_tree, job, smooth_covariance_flag,
 
         if 'cf_lya_lya' in cf_name:
             lyaxlya_files += [str(cf) for cf in cf_list]
-            correlation_types += ['auto']
         elif 'cf_lya_lyb' in cf_name:
             lyaxlyb_files += [str(cf) for cf in cf_list]
-            correlation_types += ['auto']
         elif 'xcf_lya_qso' in cf_name:
             lyaxqso_files += [str(cf) for cf in cf_list]
-            correlation_types += ['cross']
         elif 'xcf_lyb_qso' in cf_name:
             lybxqso_files += [str(cf) for cf in cf_list]
-            correlation_types += ['cross']
         else:
             raise ValueError(f'Unknown correlation type {cf_name}')
     if (len(lyaxlya_files) + len(lyaxlyb_files) + len(lyaxqso_files) + len(lybxqso_files)) < 1:
@@ -305,41 +328,26 @@ def stack_full_covariance(corr_dict, stack_tree, job, smooth_covariance_flag,
     text = header
     text += f'{env_command}\n\n'
 
-    if out_file.is_file() and out_file_smoothed.is_file():
-        print(
-            'Full covariance and smoothed full covariance already exist:'
-            f' {out_file}, {out_file_smoothed}. Skipping.'
-        )
+    if out_file.is_file() and (out_file_smoothed.is_file() or not smooth_covariance_flag):
+        print(f'Full covariance already exists: {out_file}. Skipping.')
         return None
 
-    if not out_file.is_file():
-        text += 'lyatools-stack-fullcov '
-        if len(lyaxlya_files) > 0:
-            text += '--lyaxlya ' + ' '.join(lyaxlya_files) + ' '
-        if len(lyaxlyb_files) > 0:
-            text += '--lyaxlyb ' + ' '.join(lyaxlyb_files) + ' '
-        if len(lyaxqso_files) > 0:
-            text += '--lyaxqso ' + ' '.join(lyaxqso_files) + ' '
-        if len(lybxqso_files) > 0:
-            text += '--lybxqso ' + ' '.join(lybxqso_files) + ' '
-        text += f'--outfile {out_file} --nproc {nproc}\n\n'
-
+    # Both outputs come from the same command, so rerun it if either is missing
+    text += 'lyatools-stack-fullcov '
+    if len(lyaxlya_files) > 0:
+        text += '--lyaxlya ' + ' '.join(lyaxlya_files) + ' '
+    if len(lyaxlyb_files) > 0:
+        text += '--lyaxlyb ' + ' '.join(lyaxlyb_files) + ' '
+    if len(lyaxqso_files) > 0:
+        text += '--lyaxqso ' + ' '.join(lyaxqso_files) + ' '
+    if len(lybxqso_files) > 0:
+        text += '--lybxqso ' + ' '.join(lybxqso_files) + ' '
+    text += f'--outfile {out_file} --nproc {nproc}'
     if smooth_covariance_flag:
-        if not out_file_smoothed.is_file():
-            rp_min = corr_config.getint('rp_min', 0)
-            rp_max = corr_config.getint('rp_max', 200)
-            rt_min = corr_config.getint('rt_min', 0)
-            rt_max = corr_config.getint('rt_max', 200)
-            num_bins_rp = corr_config.getint('num_bins_rp', 50)
-            num_bins_rt = corr_config.getint('num_bins_rt', 50)
-
-            text += f'picca_write_smooth_covariance.py --input-cov {out_file} '
-            text += f'--output-cov {out_file_smoothed} '
-            text += f'--rp-min-auto {rp_min} --rp-max-auto {rp_max} --np-auto {num_bins_rp} '
-            text += f'--rt-min-auto {rt_min} --rt-max-auto {rt_max} --nt-auto {num_bins_rt} '
-            text += f'--rp-min-cross {-rp_max} --rp-max-cross {rp_max} --np-cross {2*num_bins_rp} '
-            text += f'--rt-min-cross {rt_min} --rt-max-cross {rt_max} --nt-cross {num_bins_rt} '
-            text += f'--correlation-types {" ".join(correlation_types)}\n'
+        text += f' --smooth-outfile {out_file_smoothed}'
+    if use_cache:
+        text += ' --healpix-cache'
+    text += '\n\n'
 
     # Write the script.
     script_path = stack_tree.scripts_dir / f'stack_full_cov{name_ext}.sh'
@@ -361,37 +369,17 @@ def mpi_export(export_commands, export_cov_commands, analysis_tree, job, corr_jo
         export_job_id = mpi_export_correlations(
             export_commands, analysis_tree, job, corr_job_ids=corr_job_ids)
 
-    # Restructure the export_cov_commands
-    individual_cov_commands = []
-    smooth_cov_commands = []
-    for command in export_cov_commands:
-        if 'write_full_covariance_matrix_flex_size_shuffled' in command:
-            individual_cov_commands += [command]
-        elif 'write_smooth_covariance_flex_size' in command:
-            smooth_cov_commands += [command]
-        else:
-            raise ValueError(f'Unknown covariance command: {command}')
-
+    # Each full covariance command also writes the smoothed covariance
     cov_job_id = None
-    if len(individual_cov_commands) > 1:
-        ntasks_per_node = min(len(individual_cov_commands), 32)
+    if len(export_cov_commands) > 1:
+        num_nodes = max(len(export_cov_commands) // 32, 1)
+        ntasks_per_node = min(len(export_cov_commands) + 1, 32)
         cov_job_id = mpi_export_covariances(
-            individual_cov_commands, analysis_tree, job, script_name='individual_cov',
-            num_nodes=1, ntasks_per_node=ntasks_per_node, corr_job_ids=corr_job_ids
-        )
-
-    cov_smooth_job_id = None
-    if cov_job_id is None:
-        cov_job_id = corr_job_ids
-    if len(smooth_cov_commands) > 1:
-        num_nodes = max(len(smooth_cov_commands) // 32, 1)
-        ntasks_per_node = min(len(smooth_cov_commands), 32)
-        cov_smooth_job_id = mpi_export_covariances(
-            smooth_cov_commands, analysis_tree, job, script_name='smooth_cov',
-            num_nodes=num_nodes, ntasks_per_node=ntasks_per_node, corr_job_ids=cov_job_id
+            export_cov_commands, analysis_tree, job, script_name='full_cov',
+            num_nodes=num_nodes, ntasks_per_node=ntasks_per_node, corr_job_ids=corr_job_ids
         )
 
-    return export_job_id, cov_smooth_job_id
+    return export_job_id, cov_job_id
 
 
 def mpi_export_correlations(export_commands, analysis_tree, job, corr_job_ids=None):
@@ -411,10 +399,11 @@ def mpi_export_correlations(export_commands, analysis_tree, job, corr_job_ids=No
     logs = analysis_tree.logs_dir / 'export'
     dir_handlers.check_dir(logs)
 
+    # One extra task for the rank handing out the commands
     text_commands = '"' + '" "'.join(export_commands) + '"'
-    num_cores = min(len(export_commands), 64)
+    num_cores = min(len(export_commands) + 1, 64)
     text += f'srun --ntasks-per-node={num_cores} lyatools-mpi-export -i {text_commands} '
-    text += f'-l {logs}\n'
+    text += f'-l {logs} --longest-first\n'
 
     # Write the script.
     script_path = analysis_tree.scripts_dir / 'mpi_export.sh'
@@ -449,7 +438,7 @@ def mpi_export_covariances(
     dir_handlers.check_dir(logs)
 
     text += f'srun --ntasks-per-node={ntasks_per_node} lyatools-mpi-export -i {text_commands} '
-    text += f'-l {logs}\n'
+    text += f'-l {logs} --longest-first\n'
 
     # Write the script.
     script_path = analysis_tree.scripts_dir / f'mpi_export_{script_name}.sh'
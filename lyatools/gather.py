@@ -0,0 +1,117 @@
+"""Two-phase gather of FITS tables spread over many files.
+
+A header-only pass reads NAXIS2 from every file to size the output, then workers
+read their file and write the rows straight into their slice of a memory-mapped
+npy buffer. The catalog is never held twice in memory, and the buffer pages are
+file backed so they do not count against the node memory.
+
+This module only depends on numpy and fitsio so that the catalog scripts can use
+it without importing the rest of lyatools.
+"""
+import os
+import tempfile
+from contextlib import contextmanager
+from functools import partial
+from multiprocessing import Pool
+
+import fitsio
+import numpy as np
+
+
+def count_rows(path, extname):
+    """Number of rows in a table HDU, read from the header only."""
+    with fitsio.FITS(path) as hdul:
+        return hdul[extname].read_header()['NAXIS2']
+
+
+def count_all_rows(files, extname, nproc=None):
+    """Header-only pass returning the number of rows of extname in each file."""
+    with Pool(processes=nproc) as pool:
+        counts = pool.map(partial(count_rows, extname=extname), files)
+
+    return np.array(counts, dtype=np.int64)
+
+
+def table_dtype(path, extname):
+    """Numpy dtype of a table HDU, read without loading the data."""
+    with fitsio.FITS(path) as hdul:
+        return hdul[extname].get_rec_dtype()[0]
+
+
+def _fill_slices(args, read_func, buffer_paths):
+    item, starts, counts = args
+    if np.sum(counts) == 0:
+        return
+
+    arrays = read_func(item)
+    if len(buffer_paths) == 1:
+        arrays = (arrays, )
+
+    for path, start, count, arr in zip(buffer_paths, starts, counts, arrays):
+        if count == 0:
+            continue
+
+        if arr is None or arr.size != count:
+            size = 0 if arr is None else arr.size
+            raise ValueError(f'Expected {count} rows from {item}, but got {size}.')
+
+        buffer = np.load(path, mmap_mode='r+')
+        buffer[start:start + count] = arr
+        buffer.flush()
+        del buffer
+
+
+@contextmanager
+def gathered_tables(items, read_func, counts, dtypes, buffer_dir, nproc=None):
+    """Gather the tables produced by read_func over items into preallocated buffers.
+
+    Parameters
+    ----------
+    items : list
+        Items (usually file paths) passed one at a time to read_func
+    read_func : callable
+        Picklable function returning the table for one item. If there is more
+        than one output, it must return one table (or None) per output.
+    counts : array_like
+        Number of rows per item, with shape (num_items, ) or (num_items, num_outputs)
+    dtypes : numpy.dtype or list
+        Dtype of each output table
+    buffer_dir : str or Path
+        Directory for the temporary buffers. They are deleted on exit.
+    nproc : int, optional
+        Number of worker processes, by default None
+
+    Yields
+    ------
+    numpy.ndarray or list
+        Memory-mapped output table(s), with rows in the order of items
+    """
+    single_output = not isinstance(dtypes, (list, tuple))
+    if single_output:
+        dtypes = [dtypes]
+
+    counts = np.asarray(counts, dtype=np.int64).reshape(len(items), len(dtypes))
+    starts = np.zeros_like(counts)
+    starts[1:] = np.cumsum(counts, axis=0)[:-1]
+    totals = counts.sum(axis=0)
+
+    with tempfile.TemporaryDirectory(dir=buffer_dir, prefix='.gather-') as tmp_dir:
+        buffer_paths = []
+        for i, dtype in enumerate(dtypes):
+            path = os.path.join(tmp_dir, f'table_{i}.npy')
+            buffer = np.lib.format.open_memmap(
+                path, mode='w+', dtype=np.dtype(dtype), shape=(int(totals[i]), ))
+            del buffer
+            buffer_paths.append(path)
+
+        fill_func = partial(_fill_slices, read_func=read_func, buffer_paths=buffer_paths)
+        tasks = [(item, start, count) for item, start, count in zip(items, starts, counts)]
+        with Pool(processes=nproc) as pool:
+            for _ in pool.imap_unordered(fill_func, tasks):
+                pass
+
+        tables = [np.load(path, mmap_mode='r+') for path in buffer_paths]
+        try:
+            yield tables[0] if single_output else tables
+        finally:
+            del tables
@@ -0,0 +1,156 @@
+"""Compact copies of the per-healpix correlations used by the stacking tools.
+
+The picca correlation files are gzipped FITS files, which are decompressed every time
+one of the stacking or covariance tools reads them. The cache next to each file
+(<file>.hpcache.npz) holds the per-healpix DA and WE in float32 with rows sorted by
+HEALPID, the (small) binning columns and the header entries needed for stacking. It is
+written the first time a file is read with use_cache=True, and rewritten when the size
+or mtime of the correlation file changes.
+
+Correlations are always returned with their rows sorted by HEALPID, so different
+correlations (or mocks) are aligned with searchsorted.
+
+This module only depends on numpy and fitsio so that the stacking scripts can use it
+without importing the rest of lyatools.
+"""
+import json
+import os
+import tempfile
+import zipfile
+from dataclasses import dataclass
+from pathlib import Path
+
+import fitsio
+import numpy as np
+
+CACHE_SUFFIX = '.hpcache.npz'
+HEADER_KEYS = ['NP', 'NT', 'RPMIN', 'RPMAX', 'RTMAX', 'ZCUTMIN', 'ZCUTMAX', 'OMEGAM',
+               'OMEGAR', 'OMEGAK', 'WL', 'NSIDE']
+
+
+@dataclass
+class HealpixCorrelation:
+    """A correlation function with its per-healpix subsamples sorted by HEALPID."""
+    header: dict
+    r_par: np.ndarray
+    r_trans: np.ndarray
+    z: np.ndarray
+    num_pairs: np.ndarray
+    xi: np.ndarray
+    weights: np.ndarray
+    healpix: np.ndarray
+
+
+def cache_path(corr_file):
+    corr_file = Path(corr_file)
+    return corr_file.parent / (corr_file.name + CACHE_SUFFIX)
+
+
+def _source_id(corr_file):
+    stat = os.stat(corr_file)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def read_correlation_fits(corr_file):
+    """Read a picca correlation file, with the per-healpix rows sorted by HEALPID."""
+    with fitsio.FITS(corr_file) as hdul:
+        header = hdul[1].read_header()
+        header = {key: header[key] for key in HEADER_KEYS if key in header}
+        r_par = hdul[1]['RP'][:]
+        r_trans = hdul[1]['RT'][:]
+        z = hdul[1]['Z'][:]
+        num_pairs = hdul[1]['NB'][:]
+
+        xi_name = 'DA' if 'DA' in hdul[2].get_colnames() else 'DA_BLIND'
+        xi = hdul[2][xi_name][:]
+        weights = hdul[2]['WE'][:]
+        healpix = hdul[2]['HEALPID'][:]
+
+    order = np.argsort(healpix, kind='stable')
+    return HealpixCorrelation(header, r_par, r_trans, z, num_pairs,
+                              xi[order], weights[order], healpix[order])
+
+
+def write_cache(corr, corr_file):
+    """Write the float32 cache of a correlation read from corr_file.
+
+    The cache is written to a unique temporary file and moved in place, so that jobs
+    caching the same file at the same time do not clobber each other.
+    """
+    path = cache_path(corr_file)
+    fd, tmp_name = tempfile.mkstemp(dir=path.parent, prefix=path.name, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(
+                f, header=json.dumps(corr.header), source_id=np.array(_source_id(corr_file)),
+                r_par=corr.r_par, r_trans=corr.r_trans, z=corr.z, num_pairs=corr.num_pairs,
+                xi=corr.xi.astype(np.float32), weights=corr.weights.astype(np.float32),
+                healpix=corr.healpix
+            )
+        os.replace(tmp_name, path)
+    except BaseException:
+        if os.path.exists(tmp_name):
+            os.remove(tmp_name)
+        raise
+
+
+def read_cache(corr_file):
+    """Read the cache of corr_file, or return None if it is missing, out of date or
+    unreadable (e.g. truncated)."""
+    path = cache_path(corr_file)
+    if not path.is_file():
+        return None
+
+    try:
+        with np.load(path) as data:
+            if list(data['source_id']) != _source_id(corr_file):
+                return None
+
+            return HealpixCorrelation(
+                json.loads(str(data['header'])), data['r_par'], data['r_trans'], data['z'],
+                data['num_pairs'], data['xi'], data['weights'], data['healpix'])
+    except (zipfile.BadZipFile, ValueError, KeyError, OSError) as error:
+        print(f'WARNING: Could not read the healpix cache {path} ({error}). Rebuilding it.')
+        return None
+
+
+def load_correlation(corr_file, use_cache=False):
+    """Load a correlation, from its float32 cache if use_cache is True.
+
+    The cache is created or refreshed if needed. The returned xi and weights are float32
+    whenever use_cache is True, whether or not the cache existed.
+    """
+    if not use_cache:
+        return read_correlation_fits(corr_file)
+
+    corr = read_cache(corr_file)
+    if corr is not None:
+        return corr
+
+    corr = read_correlation_fits(corr_file)
+    corr.xi = corr.xi.astype(np.float32)
+    corr.weights = corr.weights.astype(np.float32)
+    try:
+        write_cache(corr, corr_file)
+    except OSError as error:
+        print(f'WARNING: Could not write the healpix cache of {corr_file}: {error}')
+
+    return corr
+
+
+def match_healpix(sorted_healpix, healpix, name=''):
+    """Indexes of healpix in sorted_healpix. Raises ValueError if some are missing."""
+    index = np.searchsorted(sorted_healpix, healpix)
+    index = np.minimum(index, sorted_healpix.size - 1)
+    if sorted_healpix.size == 0 or np.any(sorted_healpix[index] != healpix):
+        raise ValueError(f'Missing healpixels in correlation {name}')
+    return index
+
+
+def shuffled_means(corr):
+    """Weighted mean of a (shuffled) correlation in each healpix."""
+    xi_shuffled = (corr.xi * corr.weights).sum(axis=1, dtype=float)
+    weight_shuffled = corr.weights.sum(axis=1, dtype=float)
+    w = weight_shuffled > 0.
+    xi_shuffled[w] /= weight_shuffled[w]
+    return xi_shuffled
@@ -0,0 +1,130 @@
+"""Run cheap pipeline steps on the current node instead of submitting them as jobs.
+
+Steps like the quickquasars input catalog, the QSO/BAL/DLA/SNR catalogs or the redshift
+error injection take seconds to minutes, but as Slurm jobs they each wait in the queue
+for a full node. submit_utils.run_command_job runs them here instead when their
+estimated cost is below the [job_info] inline_max_node_hours threshold and they do not
+depend on a Slurm job.
+
+The commands run in a process pool, so the steps of different mocks run in parallel.
+Their Python scripts are run in the worker processes with lyatools.task_runner. Inline
+steps get negative synthetic ids, which can be used as dependencies of other inline
+steps. submit_utils.run_job waits for the inline steps a job depends on before
+submitting it.
+
+Inline steps run in the environment of the driver process, which must provide the
+programs they call (e.g. gen_qso_catalog and desi_zcatalog).
+"""
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from lyatools import task_runner
+
+
+def is_inline_id(job_id):
+    return isinstance(job_id, int) and job_id < 0
+
+
+def run_commands(command):
+    """Run the lines of a job command one after the other, stopping at the first failure.
+
+    Returns the exit code, stdout and stderr.
+    """
+    stdout = []
+    stderr = []
+    returncode = 0
+    for line in command.splitlines():
+        line = line.strip()
+        if len(line) == 0 or line.startswith('#'):
+            continue
+
+        returncode, out, err = task_runner.run_command(line)
+        stdout.append(out)
+        stderr.append(err)
+        if returncode != 0:
+            break
+
+    return returncode, ''.join(stdout), ''.join(stderr)
+
+
+class InlineRunner:
+    """Run job commands in a process pool, honouring dependencies between them.
+
+    Like executors.LocalExecutor, steps are queued in submission order and can only depend
+    on steps submitted before them.
+
+    Parameters
+    ----------
+    max_workers : int, optional
+        Number of worker processes, by default 8
+    """
+    def __init__(self, max_workers=8):
+        self.max_workers = max_workers
+        self._processes = None
+        self._threads = None
+        self._lock = threading.Lock()
+        self._futures = {}
+        self._names = {}
+        self._next_id = -1
+
+    def _start_pools(self):
+        # Only start the worker processes if something is actually run inline
+        if self._processes is None:
+            self._processes = ProcessPoolExecutor(max_workers=self.max_workers)
+            self._threads = ThreadPoolExecutor(max_workers=self.max_workers)
+
+    def submit(self, command, name, log_file, dependency_ids):
+        """Queue a command and return its (negative) id."""
+        with self._lock:
+            self._start_pools()
+            job_id = self._next_id
+            self._next_id -= 1
+
+            dependencies = []
+            for dep_id in dependency_ids:
+                if dep_id not in self._futures:
+                    raise ValueError(f'Unknown inline dependency {dep_id} for {name}.')
+                dependencies.append(self._futures[dep_id])
+
+            print(f'Running {name} inline as step {job_id}. Log: {log_file}')
+            self._names[job_id] = name
+            self._futures[job_id] = self._threads.submit(
+                self._run, command, job_id, log_file, dependencies)
+
+        return job_id
+
+    def _run(self, command, job_id, log_file, dependencies):
+        name = self._names[job_id]
+        for dep in dependencies:
+            if dep.result() != 0:
+                print(f'Inline step {job_id} ({name}) not run because a dependency failed.')
+                return -1
+
+        returncode, stdout, stderr = self._processes.submit(run_commands, command).result()
+        with open(log_file, 'w') as f:
+            f.write(stdout)
+            f.write(stderr)
+
+        status = 'finished' if returncode == 0 else 'failed'
+        print(f'Inline step {job_id} ({name}) {status} with exit code {returncode}.')
+        return returncode
+
+    def wait(self, job_ids=None):
+        """Block until the given steps (all by default) are done and return their exit codes."""
+        with self._lock:
+            if job_ids is None:
+                job_ids = list(self._futures.keys())
+            futures = {job_id: self._futures[job_id] for job_id in job_ids}
+
+        return {job_id: future.result() for job_id, future in futures.items()}
+
+    def failed(self, return_codes):
+        return [f'{job_id}: {self._names[job_id]}'
+                for job_id, code in return_codes.items() if code != 0]
+
+    def shutdown(self):
+        if self._processes is not None:
+            self._threads.shutdown()
+            self._processes.shutdown()
+            self._processes = None
+            self._threads = None
@@ -6,7 +6,8 @@ __DIR__ = os.path.dirname(os.path.realpath(__file__))
 
 
 def create_lyacolore_script(
-    colore_out_loc, lyacolore_out_loc, lyacolore_path, config_file, conda_environment
+    colore_out_loc, lyacolore_out_loc, lyacolore_path, config_file, conda_environment,
+    num_nodes=8
 ):
     script_content = f"""
 ################################################################################
@@ -23,7 +24,7 @@ LYACOLORE_OUT_LOC="{lyacolore_out_loc}"
 export LYACOLORE_PATH="{lyacolore_path}"
 
 # Specify the settings for LyaCoLoRe.
-NNODES=16
+NNODES={num_nodes}
 NCORES=128
 TIME="00:15:00" #hh:mm:ss
 
@@ -71,41 +72,20 @@ echo " "
 umask 0002
 export OMP_NUM_THREADS=2
 
-PIXDIRS=$(ls -tr1d {lyacolore_out_loc}/[0-9]*/* | sort -R)
-NPIXELS=$(echo $PIXDIRS | wc -w)
-PIXDIRS_list=($PIXDIRS)
+# Balance the number of sources between the nodes
+NODE_PIXELS_DIR={lyacolore_out_loc}/scripts/node_pixels
+lyatools-partition-pixels -i {lyacolore_out_loc} -o $NODE_PIXELS_DIR --num-nodes $NNODES || exit 1
 
-PIXELS=()
-for PIXDIR in $PIXDIRS; do
-    PIX=${{PIXDIR##*/}}
-    PIXELS=("${{PIXELS[@]}}" $PIX)
-done
-
-NPIXELS_PER_NODE=$(( ($NPIXELS + 8 - 1) / 8 ))
-START_INDEX=0
-STOP_INDEX=$(( $START_INDEX + $NPIXELS_PER_NODE - 1 ))
-FINAL_NODE=0
-
-for NODE in $(seq 8); do
+for NODE in $(seq $NNODES); do
+    NODE_PIXELS=$(cat $NODE_PIXELS_DIR/node-$NODE.txt)
+    if [ -z "$NODE_PIXELS" ]; then
+        continue
+    fi
     echo "starting node $NODE"
-    NODE_PIXELS=${{PIXELS[@]:$START_INDEX:$NPIXELS_PER_NODE}}
     echo "looking at pixels: $NODE_PIXELS"
     command="srun -N 1 -n 1 -c 128 {lyacolore_path}/scripts/make_transmission.py -c {config_file} -i {colore_out_loc} -o {lyacolore_out_loc} --nproc 128 --pixels $NODE_PIXELS"
     echo $command
     $command >& {lyacolore_out_loc}/logs/node-$NODE.log &
-
-    if (( $FINAL_NODE == 1)); then
-        echo "all pixels allocated, no more nodes needed"
-        break
-    fi
-
-    START_INDEX=$(( $STOP_INDEX + 1 ))
-    STOP_INDEX=$(( $START_INDEX + $NPIXELS_PER_NODE - 1 ))
-
-    if (( $STOP_INDEX >= ($NPIXELS - 1) )); then
-        STOP_INDEX=$NPIXELS-1
-        FINAL_NODE=1
-    fi
 done
 
 wait
@@ -132,11 +112,11 @@ def run_lyacolore(lyacolore_config, skewers_path, seed, job, dependency_ids=None
     mock_box_type = lyacolore_config.get('mock_box_type', 'colore')
     input_box_path = input_box_dir / mock_box_type / f'box-{seed}' / 'results'
     env_command = job.get('env_command')
+    num_nodes = lyacolore_config.getint('num_nodes', 8)
     lyacolore_script = create_lyacolore_script(input_box_path, output_dir, lyacolore_install_path, 
-                                               config_file, env_command)
+                                               config_file, env_command, num_nodes)
 
     # Write the script to file and submit it.
-    num_nodes = lyacolore_config.getint('num_nodes', 8)
     slurm_hours = lyacolore_config.getfloat('slurm_hours', 0.25)
     header = submit_utils.make_header(
         job.get('nersc_machine'), 'regular', nodes=num_nodes, time=slurm_hours,
@@ -0,0 +1,116 @@
+"""Run the small per-mock jobs of one stage in a single Slurm allocation.
+
+Without packing, a batch of N mocks submits N seed catalog, QSO/BAL, SNR, DLA and
+redshift error jobs, each asking for a full node for a few minutes. A JobPack collects
+the commands of one stage from all the mocks and submits them as one job, with each
+command launched as its own srun step (like the node loop of the quickquasars script).
+The packed job depends on the union of the jobs the individual commands depend on, and
+it fails if any of its commands fails, so the downstream dependencies still hold.
+
+If the commands can run inline (see submit_utils.run_command_job), they are run inline
+one by one instead.
+"""
+import shlex
+from pathlib import Path
+
+from lyatools import submit_utils
+
+
+class JobPack:
+    """Commands of the same stage from several mocks, submitted as one job.
+
+    Parameters
+    ----------
+    name : str
+        Name of the stage, used for the script, logs and job name
+    job : configparser.SectionProxy
+        The [job_info] section
+    env_command : str
+        Command setting up the environment of the job
+    hours : float
+        Requested time of the individual jobs, in hours. The commands run concurrently,
+        so this is also the time of the packed job.
+    tasks_per_node : int, optional
+        Number of commands run at the same time on each node, by default 2
+    omp_threads : int, optional
+        Number of threads of each command, by default 128
+    """
+    def __init__(self, name, job, env_command, hours, tasks_per_node=2, omp_threads=128):
+        self.name = name
+        self.job = job
+        self.env_command = env_command
+        self.hours = hours
+        self.tasks_per_node = tasks_per_node
+        self.omp_threads = omp_threads
+        self.commands = []
+        self.log_files = []
+        self.dependency_ids = []
+
+    def __len__(self):
+        return len(self.commands)
+
+    def add(self, command, log_file, dependency_ids=None):
+        """Add a command, with the log file it writes to and the job ids it depends on."""
+        self.commands.append(command.strip())
+        self.log_files.append(Path(log_file))
+        self.dependency_ids.append(dependency_ids)
+
+    def _all_dependencies(self):
+        all_ids = []
+        for dependency_ids in self.dependency_ids:
+            if isinstance(dependency_ids, list):
+                all_ids += [j for j in dependency_ids if j is not None]
+            elif dependency_ids is not None:
+                all_ids.append(dependency_ids)
+        return sorted(set(all_ids))
+
+    def make_script_text(self, runfiles_dir):
+        nodes = -(-len(self.commands) // self.tasks_per_node)
+        header = submit_utils.make_header(
+            self.job.get('nersc_machine'), self.job.get('slurm_queue', 'regular'), nodes,
+            time=float(self.hours), omp_threads=self.omp_threads,
+            job_name=f'packed_{self.name}',
+            err_file=Path(runfiles_dir)/f'run-packed-{self.name}-%j.err',
+            out_file=Path(runfiles_dir)/f'run-packed-{self.name}-%j.out'
+        )
+
+        text = header + f'{self.env_command}\n\n'
+        text += 'pids=""\n'
+        for command, log_file in zip(self.commands, self.log_files):
+            text += f'srun --exact -N 1 -n 1 -c {self.omp_threads} '
+            text += f'bash -c {shlex.quote(command)} >& {log_file} &\n'
+            text += 'pids="$pids $!"\n'
+
+        text += '\nstatus=0\n'
+        text += 'for pid in $pids ; do\n'
+        text += '    wait $pid || status=1\n'
+        text += 'done\n\n'
+        text += 'exit $status\n'
+        return text
+
+    def submit(self, script_path, runfiles_dir, force_inline=False):
+        """Submit the packed job.
+
+        Returns a list with the job id of each command: the packed job id for all of them,
+        or their own ids if they were run inline.
+        """
+        if len(self.commands) == 0:
+            return []
+
+        no_submit = self.job.getboolean('no_submit')
+        dependency_ids = self._all_dependencies()
+        if submit_utils.can_run_inline(self.hours, dependency_ids, force_inline):
+            return [
+                submit_utils.run_command_job(
+                    command, '', self.env_command, script_path, log_file, self.hours,
+                    dependency_ids=deps, no_submit=no_submit, force_inline=force_inline
+                ) for command, log_file, deps
+                in zip(self.commands, self.log_files, self.dependency_ids)
+            ]
+
+        print(f'Submitting {len(self.commands)} {self.name} commands as one packed job')
+        submit_utils.write_script(script_path, self.make_script_text(runfiles_dir))
+        job_id = submit_utils.run_job(
+            script_path, dependency_ids=dependency_ids, no_submit=no_submit)
+
+        return [job_id] * len(self.commands)
@@ -0,0 +1,92 @@
+"""Split healpix pixels between nodes so that every node has about the same work.
+
+The number of quasars per healpix pixel varies a lot: the pixels on the edge of the
+footprint are almost empty, so splitting the pixels into equal-count groups leaves some
+nodes running much longer than the others. The pixels (or their files) are instead assigned
+with the greedy longest-processing-time rule: from the largest to the smallest, each goes to
+the node with the least work so far.
+"""
+import heapq
+import re
+from pathlib import Path
+
+import fitsio
+import numpy as np
+
+TRANSMISSION_PATTERN = re.compile(r'transmission-(\d+)-(\d+)\.fits')
+
+
+def lpt_partition(weights, num_groups):
+    """Split items with the given weights into num_groups groups of similar total weight.
+
+    Returns a list with the indices of the items in each group, sorted, and the total
+    weight of each group.
+    """
+    groups = [[] for _ in range(num_groups)]
+    loads = [(0., i) for i in range(num_groups)]
+    heapq.heapify(loads)
+
+    for index in np.argsort(-np.asarray(weights), kind='stable'):
+        load, group = heapq.heappop(loads)
+        groups[group].append(int(index))
+        heapq.heappush(loads, (load + weights[index], group))
+
+    totals = [0.] * num_groups
+    for load, group in loads:
+        totals[group] = load
+    return [sorted(group) for group in groups], totals
+
+
+def transmission_pixel(path):
+    """Healpix pixel of a transmission file, from its name."""
+    match = TRANSMISSION_PATTERN.search(Path(path).name)
+    if match is None:
+        return None
+    return int(match.group(2))
+
+
+def pixel_counts_from_master(master_path):
+    """Number of quasars in each healpix pixel of a LyaCoLoRe master catalog."""
+    pixnum = fitsio.read(master_path, ext=1, columns=['PIXNUM'])['PIXNUM']
+    pixels, counts = np.unique(pixnum, return_counts=True)
+    return dict(zip(pixels.tolist(), counts.tolist()))
+
+
+def lyacolore_pixels(lyacolore_out_loc):
+    """Healpix pixels of the <pix//100>/<pix> directories made by LyaCoLoRe make_master."""
+    return sorted(int(pixdir.name) for pixdir in Path(lyacolore_out_loc).glob('[0-9]*/[0-9]*')
+                  if pixdir.is_dir())
+
+
+def transmission_counts(files, master_path=None):
+    """Number of quasars in each transmission file.
+
+    The counts come from the PIXNUM column of the master catalog if it is given, and
+    otherwise from the METADATA header of each file (slower for compressed files).
+    """
+    if master_path is not None and Path(master_path).is_file():
+        pixel_counts = pixel_counts_from_master(master_path)
+        pixels = [transmission_pixel(file) for file in files]
+        if None not in pixels:
+            return [pixel_counts.get(pixel, 0) for pixel in pixels]
+
+    counts = []
+    for file in files:
+        header = fitsio.read_header(str(file), ext='METADATA')
+        counts.append(header['NAXIS2'])
+    return counts
+
+
+def write_node_lists(items, groups, out_dir):
+    """Write the items (files or pixels) of each group to out_dir/node-<n>.txt.
+
+    The nodes are numbered from 1, like in the node loops of the job scripts.
+    """
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    for old_list in out_dir.glob('node-*.txt'):
+        old_list.unlink()
+
+    for node, group in enumerate(groups, start=1):
+        with open(out_dir / f'node-{node}.txt', 'w') as f:
+            f.write(' '.join(str(items[index]) for index in group) + '\n')
@@ -0,0 +1,257 @@
+"""Summary of the job profiles recorded across a batch of mocks.
+
+Collects the records written by the instrumented job scripts (perf.jsonl, see
+submit_utils.make_perf_wrapper) under one or more directory trees, optionally adds the
+queue wait of each job from sacct, and reports per-stage percentiles across the mocks,
+the outlier jobs, and the node-hour cost of the batch.
+"""
+import json
+import os
+import re
+from datetime import datetime
+from pathlib import Path
+from subprocess import run
+
+import numpy as np
+
+from lyatools.submit_utils import PERF_FILENAME
+
+# Job names end with the mock seed, e.g. qq_cat_3, export_0.0 or lyacolore_12
+SEED_SUFFIX = re.compile(r'_\d+(\.\d+)*$')
+# Directories of a single mock: skewers-<seed>, mock-<seed> (quickquasars) and
+# analysis-<seed>. The stack tree is analysis-<stack_name>.
+MOCK_DIR = re.compile(r'^(skewers|mock|analysis)-(\d+(?:\.\d+)*)')
+# Jobs of the stack tree that run the work of every mock (see packing and export.mpi_export)
+BATCHED_STAGES = ['export_mocks', 'full_cov', 'fit_mocks']
+
+
+def stage_name(job_name):
+    return SEED_SUFFIX.sub('', job_name)
+
+
+def mock_seed(tree):
+    """Seed of the mock a directory belongs to, None for the stack tree."""
+    for part in Path(tree).parts:
+        match = MOCK_DIR.match(part)
+        if match is not None:
+            return match.group(2)
+    return None
+
+
+def stage_scope(stage, records):
+    """'mock' for stages run for each mock, 'batched' for jobs of the stack tree doing the
+    work of every mock, and 'batch' for the stages run once per batch (e.g. stacking)."""
+    if all(record['mock'] is not None for record in records):
+        return 'mock'
+    if stage.startswith('packed_') or stage in BATCHED_STAGES:
+        return 'batched'
+    return 'batch'
+
+
+def find_perf_files(paths):
+    """All the perf.jsonl files under the given directories."""
+    perf_files = []
+    for path in paths:
+        for root, _, files in os.walk(path):
+            if PERF_FILENAME in files:
+                perf_files.append(Path(root) / PERF_FILENAME)
+    return sorted(perf_files)
+
+
+def read_records(perf_files):
+    """Read the records of the perf files, adding their tree, stage and node hours."""
+    records = []
+    for perf_file in perf_files:
+        with open(perf_file) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+
+                record['tree'] = str(perf_file.parent)
+                record['mock'] = mock_seed(perf_file.parent)
+                record['job_name'] = record['stage']
+                record['stage'] = stage_name(record['stage'])
+                num_nodes = int(record.get('num_nodes') or 1)
+                record['node_hours'] = record['wall_time'] * num_nodes / 3600
+                records.append(record)
+
+    return records
+
+
+def _parse_slurm_time(value):
+    try:
+        return datetime.fromisoformat(value).timestamp()
+    except ValueError:
+        return None
+
+
+def add_queue_wait(records):
+    """Add the queue wait (start - submit) of the Slurm jobs, with one sacct query."""
+    job_ids = sorted({record['job_id'] for record in records if record.get('job_id')})
+    if len(job_ids) == 0:
+        return
+
+    command = ['sacct', '-n', '-X', '-P', '-o', 'JobID,Submit,Start', '-j', ','.join(job_ids)]
+    try:
+        process = run(command, capture_output=True, text=True)
+    except FileNotFoundError:
+        print('WARNING: sacct not found. Queue wait times are not available.')
+        return
+
+    queue_wait = {}
+    for line in process.stdout.splitlines():
+        fields = line.strip().split('|')
+        if len(fields) < 3:
+            continue
+
+        submit = _parse_slurm_time(fields[1])
+        start = _parse_slurm_time(fields[2])
+        if submit is not None and start is not None:
+            queue_wait[fields[0]] = start - submit
+
+    for record in records:
+        record['queue_wait'] = queue_wait.get(record.get('job_id'))
+
+
+def find_qq_node_outliers(records, factor=1.5):
+    """Quickquasars nodes that finished much later than the other nodes of their job.
+
+    The time each node took is estimated from the modification time of its log in the
+    logs directory next to the run_files directory holding the perf file.
+    """
+    outliers = []
+    for record in records:
+        if record['stage'] != 'qq' or record['returncode'] != 0:
+            continue
+
+        node_logs = sorted((Path(record['tree']).parent / 'logs').glob('node-*.log'))
+        node_times = {log.name: log.stat().st_mtime - record['start'] for log in node_logs}
+        node_times = {name: t for name, t in node_times.items() if 0 < t < 1e6}
+        if len(node_times) < 2:
+            continue
+
+        median = np.median(list(node_times.values()))
+        for name, node_time in node_times.items():
+            if node_time > factor * median:
+                outliers.append((record['tree'], name, node_time, median))
+
+    return outliers
+
+
+def summarize(records, outlier_factor=2.):
+    """Per-stage statistics of the successful jobs, and the outlier jobs.
+
+    Returns a dictionary of stage summaries and a list of (record, stage median) tuples
+    for the jobs that took more than outlier_factor times the median of their stage. The
+    cost per mock of the stages run for each mock, or batched over the mocks, is their
+    total cost divided by the number of mocks they ran for.
+    """
+    # The skewers of a mock are shared by its quickquasars runs (e.g. skewers-0 and
+    # mock-0.1.0), so only the full mock seeds are counted
+    seeds = {record['mock'] for record in records if record['mock'] is not None}
+    num_mocks = max(len([seed for seed in seeds
+                         if not any(other.startswith(seed + '.') for other in seeds)]), 1)
+
+    stages = {}
+    for record in records:
+        if record['returncode'] == 0:
+            stages.setdefault(record['stage'], []).append(record)
+
+    summary = {}
+    outliers = []
+    for stage, stage_records in stages.items():
+        wall_times = np.array([record['wall_time'] for record in stage_records])
+        node_hours = np.array([record['node_hours'] for record in stage_records])
+        max_rss = [record['max_rss_mb'] for record in stage_records
+                   if record.get('max_rss_mb') is not None]
+        queue_wait = [record['queue_wait'] for record in stage_records
+                      if record.get('queue_wait') is not None]
+
+        scope = stage_scope(stage, stage_records)
+        stage_mocks = num_mocks
+        if scope == 'mock':
+            stage_mocks = len({record['mock'] for record in stage_records})
+        summary[stage] = {
+            'scope': scope,
+            'num_jobs': len(stage_records),
+            'num_mocks': stage_mocks,
+            'wall_time_p50': float(np.percentile(wall_times, 50)),
+            'wall_time_p90': float(np.percentile(wall_times, 90)),
+            'wall_time_max': float(wall_times.max()),
+            'node_hours_p50': float(np.percentile(node_hours, 50)),
+            'node_hours_total': float(node_hours.sum()),
+            'node_hours_per_mock': (float(node_hours.sum()) / stage_mocks
+                                    if scope != 'batch' else None),
+            'max_rss_mb': float(max(max_rss)) if max_rss else None,
+            'queue_wait_p50': float(np.percentile(queue_wait, 50)) if queue_wait else None,
+        }
+
+        median = np.median(wall_times)
+        outliers += [(record, median) for record in stage_records
+                     if record['wall_time'] > outlier_factor * median]
+
+    return summary, outliers
+
+
+def estimate_batch_cost(summary, num_mocks):
+    """Node hours of a batch of num_mocks mocks, extrapolated from the recorded batch.
+
+    The stages run for each mock, or batched over the mocks, scale with the number of
+    mocks. The stages run once per batch (e.g. stacking) are counted once.
+    """
+    total = 0.
+    for stage_summary in summary.values():
+        if stage_summary['scope'] == 'batch':
+            total += stage_summary['node_hours_total']
+        else:
+            total += stage_summary['node_hours_per_mock'] * num_mocks
+    return total
+
+
+def format_report(summary, outliers, qq_outliers, num_failed, num_mocks=None):
+    def fmt(value, scale=1.):
+        return '       -' if value is None else f'{value / scale:8.2f}'
+
+    lines = []
+    lines.append(f'{"stage":24s} {"jobs":>5s} {"p50 [h]":>8s} {"p90 [h]":>8s} '
+                 f'{"max [h]":>8s} {"nodeh/mock":>10s} {"nodeh tot":>9s} {"rss [GB]":>8s} '
+                 f'{"wait [h]":>8s}')
+
+    by_cost = sorted(summary.items(), key=lambda item: -item[1]['node_hours_total'])
+    for stage, stats in by_cost:
+        lines.append(
+            f'{stage:24s} {stats["num_jobs"]:5d} {fmt(stats["wall_time_p50"], 3600)} '
+            f'{fmt(stats["wall_time_p90"], 3600)} {fmt(stats["wall_time_max"], 3600)} '
+            f'{fmt(stats["node_hours_per_mock"]):>10s} {stats["node_hours_total"]:9.2f} '
+            f'{fmt(stats["max_rss_mb"], 1024)} {fmt(stats["queue_wait_p50"], 3600)}'
+        )
+
+    total = sum(stats['node_hours_total'] for stats in summary.values())
+    lines.append('')
+    lines.append(f'Total recorded cost: {total:.1f} node hours')
+    if by_cost:
+        lines.append(f'Dominant stage: {by_cost[0][0]} '
+                     f'({100 * by_cost[0][1]["node_hours_total"] / max(total, 1e-10):.0f}%)')
+    if num_mocks is not None:
+        lines.append(f'Estimated cost of {num_mocks} mocks: '
+                     f'{estimate_batch_cost(summary, num_mocks):.1f} node hours')
+    if num_failed > 0:
+        lines.append(f'{num_failed} failed jobs are not included.')
+
+    if outliers:
+        lines.append('')
+        lines.append('Slow jobs:')
+        for record, median in outliers:
+            lines.append(f'    {record["job_name"]} ({record["job_id"]}) in {record["tree"]}: '
+                         f'{record["wall_time"] / 60:.1f} min, stage median {median / 60:.1f} min')
+
+    if qq_outliers:
+        lines.append('')
+        lines.append('Slow quickquasars nodes:')
+        for tree, name, node_time, median in qq_outliers:
+            lines.append(f'    {name} in {tree}: {node_time / 60:.1f} min, '
+                         f'job median {median / 60:.1f} min')
+
+    return '\n'.join(lines)
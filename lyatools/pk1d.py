@@ -18,7 +18,10 @@ def make_pk1d_runs(analysis_tree, config, job, delta_job_ids=None):
 
 
 def run_picca_pk1d(analysis_tree, config, job, region_name='lya', delta_job_ids=None):
-    slurm_hours = config.getfloat(f'pk1d_{region_name}_slurm_hours', 0.5)
+    runtime_key = {'stage': 'pk1d', 'region': region_name}
+    slurm_hours = config.getfloat(f'pk1d_{region_name}_slurm_hours', None)
+    if slurm_hours is None:
+        slurm_hours = submit_utils.job_hours(runtime_key, 0.5)
 
     # Make the header
     header = submit_utils.make_header(
@@ -83,4 +86,5 @@ def run_picca_pk1d(analysis_tree, config, job, region_name='lya', delta_job_ids=
     submit_utils.write_script(script_path, text)
     job_id = submit_utils.run_job(
         script_path, dependency_ids=delta_job_ids, no_submit=job.getboolean('no_submit'))
+    submit_utils.record_job(job_id, runtime_key)
     return job_id
@@ -0,0 +1,271 @@
+"""Provenance manifests used to decide whether an output has to be recomputed.
+
+Each output gets a small JSON manifest next to it (<output>.provenance.json) with a hash
+of the command that produces it and fingerprints of its inputs. The config values used
+by the stages (binning, cosmology, redshift cuts, ...) all end up in their command lines,
+so they are covered by the command hash. The manifest is written as "pending" when the job
+is submitted, gets the id of the job once it is submitted, and is finalized in the job
+itself, right after the command succeeds, by lyatools-write-provenance.
+
+An output is up to date if its manifest is complete, the command is unchanged, none of its
+inputs is being regenerated (pending manifest), and the input fingerprints match. An output
+whose job is still queued or running is not submitted again. Outputs from before manifests
+existed are taken as up to date unless one of their inputs is being regenerated.
+"""
+import hashlib
+import json
+import re
+from pathlib import Path
+
+MANIFEST_SUFFIX = '.provenance.json'
+FINALIZE_PATTERN = re.compile(r'lyatools-write-provenance -m (\S+)')
+MAX_HASH_SIZE = 2 * 1024**3
+
+
+def manifest_path(output_path):
+    output_path = Path(output_path)
+    return output_path.parent / (output_path.name + MANIFEST_SUFFIX)
+
+
+def command_hash(command):
+    """Hash of a command line, ignoring whitespace and the number of processes."""
+    command = re.sub(r'--(nproc|ncpu)[\s=]+\S+', '', command)
+    command = ' '.join(command.split())
+    return hashlib.sha256(command.encode()).hexdigest()
+
+
+def file_hash(path, chunk_size=16 * 1024**2):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def fingerprint(path, with_hash=True):
+    """Size, mtime and sha256 of a file, or the mtime of a directory.
+
+    Directories are compared on their own mtime, which changes when files are added,
+    removed or renamed in them. Files larger than MAX_HASH_SIZE are not hashed.
+    """
+    path = Path(path)
+    if not path.exists():
+        return None
+
+    stat = path.stat()
+    if path.is_dir():
+        return {'mtime_ns': stat.st_mtime_ns}
+
+    info = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+    if with_hash and stat.st_size <= MAX_HASH_SIZE:
+        info['sha256'] = file_hash(path)
+    return info
+
+
+def _same_fingerprint(path, stored):
+    if stored is None:
+        return not Path(path).exists()
+
+    current = fingerprint(path, with_hash=False)
+    if current is None:
+        return False
+    if current == {key: stored[key] for key in current if key in stored}:
+        return True
+
+    # Touched but not modified: same size and content
+    if 'sha256' not in stored or current.get('size') != stored.get('size'):
+        return False
+    return file_hash(path) == stored['sha256']
+
+
+def read_manifest(output_path):
+    path = manifest_path(output_path)
+    if not path.is_file():
+        return None
+
+    with open(path) as f:
+        return json.load(f)
+
+
+def _is_pending(path):
+    manifest = read_manifest(path)
+    return manifest is not None and manifest.get('status') != 'complete'
+
+
+def _write_manifest(path, manifest):
+    tmp_path = Path(str(path) + '.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    tmp_path.replace(path)
+
+
+# States of the jobs of the pending manifests, queried once per run (see refresh_job_states)
+_JOB_STATES = {}
+
+
+def refresh_job_states(directories, executor):
+    """Query the states of the jobs of all the pending manifests in the directories.
+
+    All the job ids are queried in one call to the executor, and kept for the checks of
+    queued_job_id during this run.
+    """
+    job_ids = set()
+    for directory in directories:
+        for path in Path(directory).glob('*' + MANIFEST_SUFFIX):
+            try:
+                with open(path) as f:
+                    manifest = json.load(f)
+            except (OSError, json.JSONDecodeError):
+                continue
+
+            if manifest.get('status') == 'complete' or manifest.get('job_id') is None:
+                continue
+            if manifest.get('executor') == executor.name:
+                job_ids.add(manifest['job_id'])
+
+    _JOB_STATES.clear()
+    if len(job_ids) > 0:
+        job_states = executor.job_states(sorted(job_ids))
+        _JOB_STATES.update({job_id: job_states.get(job_id) for job_id in job_ids})
+
+
+def queued_job_id(output_path, executor):
+    """Id of the job computing output_path if it is still queued or running, else None."""
+    manifest = read_manifest(output_path)
+    if manifest is None or manifest.get('status') == 'complete':
+        return None
+
+    job_id = manifest.get('job_id')
+    if job_id is None or manifest.get('executor') != executor.name:
+        return None
+
+    if job_id not in _JOB_STATES:
+        # Manifest outside of the directories given to refresh_job_states
+        _JOB_STATES[job_id] = executor.job_states([job_id]).get(job_id)
+
+    job_state = _JOB_STATES[job_id]
+    if job_state is not None and job_state[0] in ['PENDING', 'RUNNING']:
+        return job_id
+    return None
+
+
+def is_up_to_date(output_path, command, executor, inputs=None, upstream_job_ids=None):
+    """Check whether output_path can be reused instead of being recomputed.
+
+    Parameters
+    ----------
+    output_path : str or Path
+        Output of the command
+    command : str
+        Command producing the output
+    executor : executors.SlurmExecutor or executors.LocalExecutor
+        Executor running the jobs, used to check whether the output is being computed
+    inputs : list, optional
+        Input files or directories, by default None
+    upstream_job_ids : int or list, optional
+        Jobs submitted in this run that produce the inputs, by default None
+
+    Returns
+    -------
+    bool
+        True if the output exists and nothing it depends on changed, or if the job
+        computing it is still queued or running
+    """
+    output_path = Path(output_path)
+    job_id = queued_job_id(output_path, executor)
+    if job_id is not None:
+        print(f'Output {output_path} is being computed by job {job_id}. Not resubmitting.')
+        return True
+
+    if not output_path.is_file():
+        return False
+
+    manifest = read_manifest(output_path)
+    if manifest is None:
+        # Output made before provenance manifests existed. Reuse it unless one of its
+        # inputs is being recomputed.
+        return not any(_is_pending(path) for path in inputs or [])
+
+    if manifest.get('status') != 'complete':
+        print(f'Output {output_path} was not finalized by its job. Recomputing.')
+        return False
+
+    if manifest['command_hash'] != command_hash(command):
+        print(f'Command for {output_path} changed. Recomputing.')
+        return False
+
+    if upstream_job_ids is not None:
+        if not isinstance(upstream_job_ids, list):
+            upstream_job_ids = [upstream_job_ids]
+        if any(job_id is not None for job_id in upstream_job_ids):
+            print(f'Inputs of {output_path} are being recomputed. Recomputing.')
+            return False
+
+    stored_inputs = manifest.get('inputs', {})
+    for path in inputs or []:
+        path = str(path)
+        if _is_pending(path):
+            print(f'Input {path} of {output_path} is being recomputed. Recomputing.')
+            return False
+
+        if path not in stored_inputs or not _same_fingerprint(path, stored_inputs[path]):
+            print(f'Input {path} of {output_path} changed. Recomputing.')
+            return False
+
+    return True
+
+
+def write_pending(output_path, command, inputs=None):
+    """Write the manifest of an output about to be (re)computed and return its path.
+
+    The input fingerprints are only filled in by finalize, once the job ran, because
+    some inputs are produced by jobs that have not run yet.
+    """
+    manifest = {
+        'status': 'pending',
+        'output': str(output_path),
+        'command': ' '.join(command.split()),
+        'command_hash': command_hash(command),
+        'inputs': {str(path): None for path in inputs or []},
+    }
+
+    path = manifest_path(output_path)
+    with open(path, 'w') as f:
+        json.dump(manifest, f, indent=2)
+
+    return path
+
+
+def record_job(script_text, job_id, executor_name):
+    """Add the job id to the pending manifests finalized by a job script."""
+    if job_id is None or job_id <= 0:
+        return
+
+    for path in FINALIZE_PATTERN.findall(script_text):
+        if not Path(path).is_file():
+            continue
+
+        with open(path) as f:
+            manifest = json.load(f)
+        if manifest.get('status') == 'complete':
+            continue
+
+        manifest['job_id'] = job_id
+        manifest['executor'] = executor_name
+        _write_manifest(path, manifest)
+
+
+def finalize_command(output_path):
+    """Shell snippet to chain after a command to finalize the manifest of its output."""
+    return f' && lyatools-write-provenance -m {manifest_path(output_path)}'
+
+
+def finalize(path):
+    """Fill in the input and output fingerprints of a pending manifest."""
+    with open(path) as f:
+        manifest = json.load(f)
+
+    manifest['inputs'] = {input_path: fingerprint(input_path) for input_path in manifest['inputs']}
+    manifest['output_fingerprint'] = fingerprint(manifest['output'])
+    manifest['status'] = 'complete'
+    _write_manifest(path, manifest)
@@ -1,5 +1,5 @@
 from . import submit_utils
-from lyatools import qq_run_args
+from lyatools import qq_run_args, runtime_model
 
 
 def create_qq_catalog(qq_tree, seed_cat_path, config, job, seed, prev_job_id=None, run_local=True):
@@ -21,29 +21,26 @@ def create_qq_catalog(qq_tree, seed_cat_path, config, job, seed, prev_job_id=Non
         return command
 
     # Make the header
+    runtime_key = {'stage': 'qq_cat', 'release': release}
+    hours = submit_utils.job_hours(runtime_key, 0.2)
     header = submit_utils.make_header(
-        job.get('nersc_machine'), 'regular', 1, time=0.2,
+        job.get('nersc_machine'), 'regular', 1, time=hours,
         omp_threads=128, job_name=f'qq_cat_{seed}',
         err_file=qq_tree.runfiles_dir/'run-%j.err',
         out_file=qq_tree.runfiles_dir/'run-%j.out'
     )
 
-    env_text = '\n\n'
-    if job.get('desi_env_command', None) is None:
-        env_text += 'source /global/common/software/desi/desi_environment.sh master'
-    else:
-        env_text += job.get('desi_env_command')
-    env_text += '\n\n'
-
-    # Write the script to file and run it.
+    # Write the script to file and run it, or run the command inline if it's cheap enough
     script_path = qq_tree.scripts_dir / 'run_qq_seed_cat.sh'
-    full_text = header + env_text + command
 
     job_id = None
     if not seed_cat_path.is_file():
-        submit_utils.write_script(script_path, full_text)
-        job_id = submit_utils.run_job(
-            script_path, dependency_ids=prev_job_id, no_submit=job.getboolean('no_submit'))
+        job_id = submit_utils.run_command_job(
+            command, header, desi_env_command(job), script_path,
+            log_file=qq_tree.runfiles_dir/'run-qq-seed-cat-inline.log', node_hours=hours,
+            dependency_ids=prev_job_id, no_submit=job.getboolean('no_submit'),
+            runtime_key=runtime_key
+        )
 
     return job_id
 
@@ -72,15 +69,17 @@ def run_qq(qq_tree, config, job, seed_cat_path, qq_seed, qq_special_args, prev_j
     print('Found the following arguments to pass to quickquasars:')
     print(qq_args)
 
-    qq_script = create_qq_script(qq_tree, config, job, qq_args, qq_seed)
+    qq_script, nodes, runtime_key, size = create_qq_script(
+        qq_tree, config, job, qq_args, qq_seed, seed_cat_path)
 
     job_id = submit_utils.run_job(
         qq_script, dependency_ids=prev_job_id, no_submit=job.getboolean('no_submit'))
+    submit_utils.record_job(job_id, runtime_key, size, nodes, catalog=seed_cat_path)
 
     return job_id
 
 
-def create_qq_script(qq_tree, config, job, qq_args, qq_seed):
+def create_qq_script(qq_tree, config, job, qq_args, qq_seed, seed_cat_path=None):
     submit_utils.set_umask()
 
     slurm_queue = job.get('slurm_queue', 'regular')
@@ -88,6 +87,20 @@ def create_qq_script(qq_tree, config, job, qq_args, qq_seed):
     nproc = config.getint('nproc', 32)
     slurm_hours = config.getfloat('slurm_hours', 0.5)
 
+    # Size the job from previous runs of the same configuration
+    runtime_key = {'stage': 'quickquasars', 'qq_run': qq_tree.qq_run_name, 'nproc': nproc,
+                   'test_run': job.getboolean('test_run')}
+    size = runtime_model.catalog_size(seed_cat_path)
+    target_hours = config.getfloat('target_hours', None)
+    model = submit_utils.get_runtime_model()
+    if target_hours is not None and model is not None:
+        nodes, slurm_hours = model.nodes(
+            runtime_key, nodes, slurm_hours, target_hours, size,
+            max_nodes=config.getint('max_nodes', None)
+        )
+    else:
+        slurm_hours = submit_utils.job_hours(runtime_key, slurm_hours, size)
+
     # Make the header
     time = submit_utils.convert_job_time(slurm_hours)
     header = submit_utils.make_header(
@@ -112,30 +125,24 @@ def create_qq_script(qq_tree, config, job, qq_args, qq_seed):
     text += '\n\n'
     text += 'echo "get list of skewers to run ..."\n\n'
 
+    # Balance the number of quasars between the nodes. Run by path, lyatools may not be
+    # installed in the DESI environment
+    node_lists_dir = qq_tree.scripts_dir / 'node_files'
+    partition_script = submit_utils.find_path(
+        'lyatools/scripts/partition_transmission.py', enforce=True)
+    text += f'python {partition_script} -i {qq_tree.skewers_path} -o {node_lists_dir} '
+    text += f'--num-nodes {nodes}'
     if job.getboolean('test_run'):
-        text += 'echo "test run enabled, selecting only first 10 files"\n'
-        text += f'files=`ls -1 {qq_tree.skewers_path}/*/*/transmission*.fits* | head -10`\n'
-    else:
-        text += f'files=`ls -1 {qq_tree.skewers_path}/*/*/transmission*.fits*`\n'
+        text += ' --max-files 10'
+    text += ' || exit 1\n\n'
 
-    text += 'nfiles=`echo $files | wc -w`\n'
-    text += f'nfilespernode=$(( $nfiles / {nodes} + 1 ))\n\n'
-    text += 'echo "n files =" $nfiles\n'
-    text += 'echo "n files per node =" $nfilespernode\n\n'
-
-    text += 'first=1\n'
-    text += 'last=$nfilespernode\n'
     text += f'for node in `seq {nodes}` ; do\n'
-    text += '    echo "starting node $node"\n\n'
     text += '    # list of files to run\n'
-    text += f'    if (( $node == {nodes} )) ; then\n'
-    text += '        last=""\n'
+    text += f'    tfiles=`cat {node_lists_dir}/node-$node.txt`\n'
+    text += '    if [ -z "$tfiles" ] ; then\n'
+    text += '        continue\n'
     text += '    fi\n\n'
-    text += '    echo ${first}-${last}\n'
-    text += '    tfiles=`echo $files | cut -d " " -f ${first}-${last}`\n'
-    text += '    first=$(( first + nfilespernode ))\n'
-    text += '    last=$(( last + nfilespernode ))\n'
-
+    text += '    echo "starting node $node"\n'
     text += qq_run
 
     text += '    echo $command\n'
@@ -152,11 +159,19 @@ def create_qq_script(qq_tree, config, job, qq_args, qq_seed):
     script_path = qq_tree.scripts_dir / 'run_quickquasars.sh'
     submit_utils.write_script(script_path, full_text)
 
-    return script_path
+    return script_path, nodes, runtime_key, size
+
 
+def make_catalogs(
+    qq_tree, config, job, dla_flag, bal_flag, qq_job_id, only_qso_targets, run_local=True
+):
+    """Submit the QSO/BAL, SNR and DLA catalog jobs that are still needed.
 
-def make_catalogs(qq_tree, config, job, dla_flag, bal_flag, qq_job_id, only_qso_targets):
+    With run_local=False nothing is submitted, and the (name, command, env_command) of
+    each catalog step are returned in the order they must run.
+    """
     job_id = qq_job_id
+    steps = []
 
     # Check which QSO catalog to use
     command = ''
@@ -166,47 +181,74 @@ def make_catalogs(qq_tree, config, job, dla_flag, bal_flag, qq_job_id, only_qso_
     print(f"Only QSO Targets flag: {only_qso_targets}")
     print(f"Expected zcat_file path: {zcat_file}")
 
-    # Create the QSO catalog command
-    if not zcat_file.is_file():
-        only_qso_targets_flag = "--only_qso_targets" if only_qso_targets else ""
-        command += f'lyatools-make-zcat -i {qq_tree.spectra_dir} -o {zcat_file}'
-        command += f' --nproc {128} {only_qso_targets_flag}\n\n'
-
-    # Create the BAL catalog command
     bal_cat_check = qq_tree.qq_dir / 'bal_cat.fits'
-    if bal_flag and not bal_cat_check.is_file():
-        command += f'lyatools-make-bal-cat -i {qq_tree.spectra_dir} -o {qq_tree.qq_dir} '
+    ai_cut = config.getint('bal_ai_cut', None)
+    bi_cut = config.getint('bal_bi_cut', None)
+
+    mask_nhi_cut = config.getfloat('dla_mask_nhi_cut')
+    mask_snr_cut = config.getfloat('dla_mask_snr_cut')
+    completeness = config.getfloat('dla_completeness')
+
+    dla_cat_check = qq_tree.qq_dir / 'dla_cat.fits'
+    dla_cat_name = f'dla_cat_nhi_{mask_nhi_cut:.2f}_snr_{mask_snr_cut:.1f}'
+    dla_cat_name += f'_completeness_{completeness:.2f}.fits'
+    dla_cat_check2 = qq_tree.qq_dir / dla_cat_name
+    dla_cat_exist = dla_cat_check.is_file() and dla_cat_check2.is_file()
+
+    hcd_meta = None
+    if config.getboolean('single_pass_catalogs', True):
+        # Read the zbest and truth files once for all the catalogs
+        hcd_meta = qq_tree.qq_dir / 'hcd_truth_meta.fits'
+        options = ''
+        if not zcat_file.is_file():
+            options += f'--zcat-name {zcat_file.name} '
+            if only_qso_targets:
+                options += '--only-qso-targets '
+
+        if bal_flag and not bal_cat_check.is_file():
+            options += '--bal '
+            if ai_cut is not None:
+                options += f'--ai-cut {ai_cut} '
+            if bi_cut is not None:
+                options += f'--bi-cut {bi_cut} '
+
+        if dla_flag and not dla_cat_exist and not hcd_meta.is_file():
+            options += '--dla '
+
+        if len(options) > 0:
+            command += f'lyatools-make-catalogs -i {qq_tree.spectra_dir} -o {qq_tree.qq_dir} '
+            command += options + f'--nproc {128}\n\n'
+    else:
+        # Create the QSO catalog command
+        if not zcat_file.is_file():
+            only_qso_targets_flag = "--only_qso_targets" if only_qso_targets else ""
+            command += f'lyatools-make-zcat -i {qq_tree.spectra_dir} -o {zcat_file}'
+            command += f' --nproc {128} {only_qso_targets_flag}\n\n'
+
+        # Create the BAL catalog command
+        if bal_flag and not bal_cat_check.is_file():
+            command += f'lyatools-make-bal-cat -i {qq_tree.spectra_dir} -o {qq_tree.qq_dir} '
 
-        ai_cut = config.getint('bal_ai_cut', None)
-        if ai_cut is not None:
-            command += f'--ai-cut {ai_cut} '
+            if ai_cut is not None:
+                command += f'--ai-cut {ai_cut} '
 
-        bi_cut = config.getint('bal_bi_cut', None)
-        if bi_cut is not None:
-            command += f'--bi-cut {bi_cut} '
+            if bi_cut is not None:
+                command += f'--bi-cut {bi_cut} '
 
-        command += f'--nproc {128}\n\n'
+            command += f'--nproc {128}\n\n'
 
-    # Submit the QSO/BAL catalog job
+    # QSO/BAL catalog job
     if len(command) > 0:
-        print('Submitting QSO/BAL catalog job')
-        job_id = run_cat_job(command, 'qso_bal', qq_tree, job, job_id)
+        steps.append(('qso_bal', command, job.get('env_command')))
 
-    # Run SNR catalog job
+    # SNR catalog job
     snr_cat = qq_tree.qq_dir / 'snr_cat.fits'
     if not snr_cat.is_file():
-        job_id = snr_cat_job(snr_cat, qq_tree, bal_flag, job, job_id)
+        fast_snr = config.getboolean('fast_snr_cat', False)
+        command = snr_cat_command(snr_cat, qq_tree, bal_flag, fast=fast_snr)
+        steps.append(('snr', command, desi_env_command(job)))
 
     # Run DLA catalog job
-    dla_cat_check = qq_tree.qq_dir / 'dla_cat.fits'
-    mask_nhi_cut = config.getfloat('dla_mask_nhi_cut')
-    mask_snr_cut = config.getfloat('dla_mask_snr_cut')
-    completeness = config.getfloat('dla_completeness')
-
-    dla_cat_name = f'dla_cat_nhi_{mask_nhi_cut:.2f}_snr_{mask_snr_cut:.1f}'
-    dla_cat_name += f'_completeness_{completeness:.2f}.fits'
-    dla_cat_check2 = qq_tree.qq_dir / dla_cat_name
-    dla_cat_exist = dla_cat_check.is_file() and dla_cat_check2.is_file()
     if dla_flag and not dla_cat_exist:
         command = f'lyatools-make-dla-cat -i {qq_tree.spectra_dir} -o {qq_tree.qq_dir} '
         command += f'--mask-nhi-cut {mask_nhi_cut} --mask-snr-cut {mask_snr_cut} '
@@ -214,60 +256,61 @@ def make_catalogs(qq_tree, config, job, dla_flag, bal_flag, qq_job_id, only_qso_
         nhi_errors = config.getfloat('dla_nhi_errors', None)
         if nhi_errors is not None:
             command += f'--nhi-errors {nhi_errors} '
+        if hcd_meta is not None:
+            command += f'--hcd-cat {hcd_meta} '
         command += f'--completeness {completeness} --seed {qq_tree.mock_seed} --nproc {128}\n\n'
 
-        print('Submitting DLA catalog job')
-        job_id = run_cat_job(command, 'dla', qq_tree, job, job_id)
+        steps.append(('dla', command, job.get('env_command')))
+
+    if not run_local:
+        return steps
+
+    for name, command, env_command in steps:
+        job_id = run_cat_job(command, name, qq_tree, job, job_id, env_command)
 
     return job_id
 
 
-def run_cat_job(command, name, qq_tree, job, job_id):
+def run_cat_job(command, name, qq_tree, job, job_id, env_command=None):
+    if env_command is None:
+        env_command = job.get('env_command')
+
+    runtime_key = {'stage': f'catalog_{name}'}
+    hours = submit_utils.job_hours(runtime_key, 0.5)
     header = submit_utils.make_header(
-        job.get('nersc_machine'), nodes=1, time=0.5,
+        job.get('nersc_machine'), nodes=1, time=hours,
         omp_threads=128, job_name=f'{name}_{qq_tree.mock_seed}',
         err_file=qq_tree.runfiles_dir/f'run-{name}-%j.err',
         out_file=qq_tree.runfiles_dir/f'run-{name}-%j.out'
     )
 
-    env_command = job.get('env_command')
-    text = header + f'{env_command}\n\n' + command
+    if not submit_utils.can_run_inline(hours, job_id):
+        print(f'Submitting {name} catalog job')
 
     script_path = qq_tree.scripts_dir / f'make_{name}_cat.sh'
-    submit_utils.write_script(script_path, text)
-
-    job_id = submit_utils.run_job(
-        script_path, dependency_ids=job_id, no_submit=job.getboolean('no_submit'))
+    job_id = submit_utils.run_command_job(
+        command, header, env_command, script_path,
+        log_file=qq_tree.runfiles_dir/f'run-{name}-inline.log', node_hours=hours,
+        dependency_ids=job_id, no_submit=job.getboolean('no_submit'),
+        runtime_key=runtime_key
+    )
 
     return job_id
 
 
-def snr_cat_job(snr_cat, qq_tree, bal_flag, job, cat_job_id):
+def snr_cat_command(snr_cat, qq_tree, bal_flag, fast=False):
     script = submit_utils.find_path('lyatools/scripts/make_snr_cat.py', enforce=True)
     command = f'python {script} --path {qq_tree.qq_dir} -o {snr_cat} '
     if bal_flag:
         command += '--balmask '
+    if fast:
+        command += '--fast '
 
     command += f'--nproc {128}\n\n'
+    return command
 
-    header = submit_utils.make_header(
-        job.get('nersc_machine'), nodes=1, time=0.5,
-        omp_threads=128, job_name=f'snr_cat_{qq_tree.mock_seed}',
-        err_file=qq_tree.runfiles_dir/'run-snr-cat-%j.err',
-        out_file=qq_tree.runfiles_dir/'run-snr-cat-%j.out'
-    )
 
+def desi_env_command(job):
     if job.get('desi_env_command', None) is None:
-        env_command = 'source /global/common/software/desi/desi_environment.sh master'
-    else:
-        env_command = job.get('desi_env_command')
-
-    text = header + f'{env_command}\n\n' + command
-
-    script_path = qq_tree.scripts_dir / 'make_snr_cat.sh'
-    submit_utils.write_script(script_path, text)
-
-    job_id = submit_utils.run_job(
-        script_path, dependency_ids=cat_job_id, no_submit=job.getboolean('no_submit'))
-
-    return job_id
+        return 'source /global/common/software/desi/desi_environment.sh master'
+    return job.get('desi_env_command')
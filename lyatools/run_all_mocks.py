@@ -1,10 +1,15 @@
 import configparser
 import copy
+import os
 
-from . import submit_utils, dir_handlers
+from . import submit_utils, dir_handlers, executors, provenance
+from lyatools.state import refresh_states
 from lyatools.run_one_mock import MockRun
 from lyatools.export import stack_correlations, stack_full_covariance, mpi_export
 from lyatools.vegafit import run_vega_mpi
+from lyatools.packing import JobPack
+from lyatools.runtime_model import RuntimeModel
+from lyatools.quickquasars import desi_env_command
 
 
 class MockBatchRun:
@@ -15,6 +20,23 @@ class MockBatchRun:
         self.config.read(submit_utils.find_path('defaults/desi_y5.ini'))
         self.config.read(submit_utils.find_path(config_path))
         self.job_config = self.config['job_info']
+        submit_utils.set_executor(executors.make_executor(self.job_config))
+        submit_utils.set_instrumentation(self.job_config.getboolean('instrument_jobs', False))
+        submit_utils.set_inline_mode(
+            self.job_config.getfloat('inline_max_node_hours', 0.),
+            self.job_config.getint('inline_max_workers', 8)
+        )
+
+        # Optional history of the job runtimes, used to size the jobs
+        self.runtime_model = None
+        runtime_history = self.job_config.get('runtime_history', None)
+        if runtime_history is not None:
+            self.runtime_model = RuntimeModel(
+                os.path.expandvars(runtime_history),
+                quantile=self.job_config.getfloat('runtime_quantile', 0.95),
+                margin=self.job_config.getfloat('runtime_margin', 1.3)
+            )
+        submit_utils.set_runtime_model(self.runtime_model)
 
         # Get the seeds
         mock_seeds_str = self.config['mock_setup'].get('mock_seeds')
@@ -45,21 +67,28 @@ class MockBatchRun:
             self.config['mock_setup']['analysis_start_path'])
         skewers_start_path = submit_utils.find_path(self.config['mock_setup']['skewers_start_path'])
 
-        # Initialize the mock objects
+        # Initialize the mock objects. Permissions of the new directories are set in one go.
         self.run_mock_objects = []
         dmat_on_first_mock_only = self.config['picca_corr'].getboolean(
             'dmat_on_first_mock_only', False)
-        for ii, (mock_seed, qq_seed) in enumerate(zip(self.mock_seeds, self.qq_seeds)):
-            this_mock_config = copy.deepcopy(self.config)
-            if ii > 0 and dmat_on_first_mock_only:
-                this_mock_config['picca_corr']['compute_dmat'] = 'False'
-
-            self.run_mock_objects.append(
-                MockRun(
-                    this_mock_config, mock_start_path, analysis_start_path, mock_seed,
-                    skewers_start_path=skewers_start_path, qq_seeds=qq_seed
+        with dir_handlers.deferred_permissions():
+            for ii, (mock_seed, qq_seed) in enumerate(zip(self.mock_seeds, self.qq_seeds)):
+                this_mock_config = copy.deepcopy(self.config)
+                if ii > 0 and dmat_on_first_mock_only:
+                    this_mock_config['picca_corr']['compute_dmat'] = 'False'
+
+                self.run_mock_objects.append(
+                    MockRun(
+                        this_mock_config, mock_start_path, analysis_start_path, mock_seed,
+                        skewers_start_path=skewers_start_path, qq_seeds=qq_seed
+                    )
                 )
-            )
+
+        # Update the state of the jobs submitted by previous runs, with one query for all mocks
+        self.states = [state for mock_obj in self.run_mock_objects for state in mock_obj.states]
+        refresh_states(self.states, submit_utils.get_executor())
+        if self.runtime_model is not None:
+            self.runtime_model.harvest(submit_utils.get_executor())
 
         # Get the run options
         self.run_mocks_individually = self.config['control'].getboolean('run_mocks_individually')
@@ -75,9 +104,16 @@ class MockBatchRun:
         self.stack_tree = None
         if self.stack_correlations or not self.run_mocks_individually:
             stack_name = self.config['mock_setup'].get('stack_name', 'stack')
-            self.stack_tree = dir_handlers.AnalysisTree.stack_from_other(
-                self.run_mock_objects[0].analysis_tree, stack_name
-            )
+            with dir_handlers.deferred_permissions():
+                self.stack_tree = dir_handlers.AnalysisTree.stack_from_other(
+                    self.run_mock_objects[0].analysis_tree, stack_name
+                )
+
+        # Same for the jobs computing the correlations and exports of previous runs
+        corr_dirs = [mock_obj.analysis_tree.corr_dir for mock_obj in self.run_mock_objects]
+        if self.stack_tree is not None:
+            corr_dirs.append(self.stack_tree.corr_dir)
+        provenance.refresh_job_states(corr_dirs, submit_utils.get_executor())
 
     def run(self):
         corr_dict = {}
@@ -107,9 +143,12 @@ class MockBatchRun:
             submit_utils.print_spacer_line()
             name_string = self.config['picca_export'].get('exp_string', None)
             subtract_shuffled = self.config['picca_export'].getboolean('subtract_shuffled')
+            append_stack = self.config['picca_export'].getboolean('append_stack', False)
+            healpix_cache = self.config['picca_export'].getboolean('healpix_cache', False)
             _ = stack_correlations(
                     corr_dict, self.stack_tree, self.job_config, shuffled=subtract_shuffled,
-                    name_string=name_string, corr_job_ids=job_ids
+                    name_string=name_string, corr_job_ids=job_ids, append=append_stack,
+                    use_cache=healpix_cache
                 )
 
             no_smooth_covariance_flag = self.config['picca_export'].getboolean(
@@ -121,13 +160,20 @@ class MockBatchRun:
                     corr_dict, self.stack_tree, self.job_config,
                     smooth_covariance_flag=not no_smooth_covariance_flag,
                     corr_config=self.run_mock_objects[0].corr_config,
-                    name_string=cov_string, corr_job_ids=job_ids
+                    name_string=cov_string, corr_job_ids=job_ids, use_cache=healpix_cache
                 )
 
         submit_utils.print_spacer_line()
-        print('All mocks submitted. Done!')
+        print('All mocks submitted. Waiting for the inline steps to finish.')
+        submit_utils.wait_for_inline()
+        print('Done!')
         submit_utils.print_spacer_line()
 
+        if isinstance(submit_utils.get_executor(), executors.LocalExecutor):
+            print('Waiting for local jobs to finish.')
+            submit_utils.wait_for_jobs()
+            refresh_states(self.states, submit_utils.get_executor())
+
     def run_parallel(self):
         assert not self.run_mocks_individually
 
@@ -136,28 +182,15 @@ class MockBatchRun:
         all_export_commands = []
         all_export_cov_commands = []
         all_vega_commands = []
-        for mock_obj in self.run_mock_objects:
-            submit_utils.print_spacer_line()
-            print('Running mock:', mock_obj.analysis_tree.full_mock_seed)
-
-            job_id = None
-            if mock_obj.run_lyacolore_flag:
-                submit_utils.print_spacer_line()
-                job_id = mock_obj.run_lyacolore(job_id)
-
-            if mock_obj.mock_analysis_type == 'raw' or mock_obj.run_qq_flag:
-                submit_utils.print_spacer_line()
-                # TODO parallelize this
-                job_id = mock_obj.create_qq_catalog(job_id, run_local=True)
 
-            if mock_obj.run_qq_flag:
-                submit_utils.print_spacer_line()
-                job_id = mock_obj.run_qq(job_id)
+        if self.job_config.getboolean('pack_small_jobs', False):
+            mock_job_ids = self.submit_packed_catalogs()
+        else:
+            mock_job_ids = self.submit_catalogs()
 
-            if mock_obj.run_zerr_flag:
-                submit_utils.print_spacer_line()
-                # TODO parallelize this
-                job_id = mock_obj.make_zerr_cat(job_id, run_local=True)
+        for mock_obj, job_id in zip(self.run_mock_objects, mock_job_ids):
+            submit_utils.print_spacer_line()
+            print('Running mock:', mock_obj.analysis_tree.full_mock_seed)
 
             job_id_deltas = None
             if mock_obj.run_deltas_flag or mock_obj.run_qsonic_flag:
@@ -232,3 +265,125 @@ class MockBatchRun:
                 )
 
         return corr_dict, job_ids
+
+    def submit_catalogs(self):
+        """Submit the jobs up to the redshift errors for each mock and return their job ids.
+
+        The catalog steps of all the mocks are submitted before anything has to wait for
+        them, so that the ones run inline (see lyatools.inline) run in parallel.
+        """
+        mock_job_ids = []
+        for mock_obj in self.run_mock_objects:
+            submit_utils.print_spacer_line()
+            print('Submitting catalogs for mock:', mock_obj.analysis_tree.full_mock_seed)
+
+            job_id = None
+            if mock_obj.run_lyacolore_flag:
+                submit_utils.print_spacer_line()
+                job_id = mock_obj.run_lyacolore(job_id)
+
+            if mock_obj.mock_analysis_type == 'raw' or mock_obj.run_qq_flag:
+                submit_utils.print_spacer_line()
+                job_id = mock_obj.create_qq_catalog(job_id, run_local=True)
+
+            mock_job_ids.append(job_id)
+
+        for ii, mock_obj in enumerate(self.run_mock_objects):
+            job_id = mock_job_ids[ii]
+            if mock_obj.run_qq_flag:
+                submit_utils.print_spacer_line()
+                job_id = mock_obj.run_qq(job_id)
+
+            if mock_obj.run_zerr_flag:
+                submit_utils.print_spacer_line()
+                job_id = mock_obj.make_zerr_cat(job_id, run_local=True)
+
+            mock_job_ids[ii] = job_id
+
+        return mock_job_ids
+
+    def submit_packed_catalogs(self):
+        """Same as submit_catalogs, but with the small jobs of each stage packed together.
+
+        The seed catalog, QSO/BAL, SNR, DLA and redshift error commands of all the mocks
+        each go into one job (see lyatools.packing). The packed job of a stage waits for
+        the jobs of the previous stage of all the mocks in it.
+        """
+        assert self.stack_tree is not None
+        tasks_per_node = self.job_config.getint('pack_tasks_per_node', 2)
+        runfiles_dir = self.stack_tree.logs_dir
+
+        def submit_pack(pack, mock_indexes, force_inline=False):
+            script_path = self.stack_tree.scripts_dir / f'packed_{pack.name}.sh'
+            pack_job_ids = pack.submit(script_path, runfiles_dir, force_inline=force_inline)
+            for ii, job_id in zip(mock_indexes, pack_job_ids):
+                mock_job_ids[ii] = job_id
+
+        mock_job_ids = [None] * len(self.run_mock_objects)
+        for ii, mock_obj in enumerate(self.run_mock_objects):
+            if mock_obj.run_lyacolore_flag:
+                submit_utils.print_spacer_line()
+                mock_job_ids[ii] = mock_obj.run_lyacolore(None)
+
+        # Seed catalogs for quickquasars
+        submit_utils.print_spacer_line()
+        pack = JobPack('qq_cat', self.job_config, desi_env_command(self.job_config), 0.2,
+                       tasks_per_node)
+        mock_indexes = []
+        for ii, mock_obj in enumerate(self.run_mock_objects):
+            if mock_obj.mock_analysis_type == 'raw' or mock_obj.run_qq_flag:
+                command = mock_obj.create_qq_catalog(mock_job_ids[ii], run_local=False)
+                if isinstance(command, str):
+                    pack.add(command, mock_obj.qq_tree.runfiles_dir/'run-qq-cat-packed.log',
+                             mock_job_ids[ii])
+                    mock_indexes.append(ii)
+        submit_pack(pack, mock_indexes)
+
+        # The quickquasars runs themselves are too big to pack
+        catalog_steps = []
+        for ii, mock_obj in enumerate(self.run_mock_objects):
+            steps = []
+            if mock_obj.run_qq_flag:
+                submit_utils.print_spacer_line()
+                mock_job_ids[ii] = mock_obj.run_qq(mock_job_ids[ii], submit_catalogs=False)
+                steps = mock_obj.get_catalog_steps()
+            catalog_steps.append({name: (command, env) for name, command, env in steps})
+
+        # QSO/BAL, SNR and DLA catalogs
+        for name in ['qso_bal', 'snr', 'dla']:
+            pack = None
+            mock_indexes = []
+            for ii, mock_obj in enumerate(self.run_mock_objects):
+                if name not in catalog_steps[ii]:
+                    continue
+
+                command, env_command = catalog_steps[ii][name]
+                if pack is None:
+                    pack = JobPack(name, self.job_config, env_command, 0.5, tasks_per_node)
+                pack.add(command, mock_obj.qq_tree.runfiles_dir/f'run-{name}-packed.log',
+                         mock_job_ids[ii])
+                mock_indexes.append(ii)
+
+            if pack is not None:
+                submit_utils.print_spacer_line()
+                submit_pack(pack, mock_indexes)
+
+        # Redshift errors
+        pack = JobPack('zerr', self.job_config, self.job_config.get('env_command'), 0.2,
+                       tasks_per_node)
+        mock_indexes = []
+        for ii, mock_obj in enumerate(self.run_mock_objects):
+            if mock_obj.run_zerr_flag:
+                command = mock_obj.make_zerr_cat(mock_job_ids[ii], run_local=False)
+                if isinstance(command, str):
+                    pack.add(command, mock_obj.qq_tree.runfiles_dir/'run-zerr-packed.log',
+                             mock_job_ids[ii])
+                    mock_indexes.append(ii)
+
+        if len(pack) > 0:
+            submit_utils.print_spacer_line()
+            force_inline = self.run_mock_objects[0].inject_zerr_config.getboolean(
+                'run_inline', True)
+            submit_pack(pack, mock_indexes, force_inline=force_inline)
+
+        return mock_job_ids
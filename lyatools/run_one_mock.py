@@ -1,6 +1,7 @@
 from pathlib import Path
 
 from . import submit_utils, dir_handlers
+from lyatools.state import PipelineState
 from lyatools.lyacolore import run_lyacolore
 from lyatools.raw_deltas import make_raw_deltas
 from lyatools.quickquasars import run_qq, create_qq_catalog, make_catalogs
@@ -170,6 +171,20 @@ class MockRun:
         if self.mock_analysis_type != 'raw_master':
             self.qq_special_args, self.bal_flag, self.dla_flag = self.get_qq_special_args()
 
+        # Persistent records of the stages already run for this mock
+        executor_name = submit_utils.get_executor().name
+        self.skewers_state = None
+        self.qq_state = None
+        if self.qq_tree is not None:
+            self.skewers_state = PipelineState(self.qq_tree.skewers_path, executor_name)
+            self.qq_state = PipelineState(self.qq_tree.qq_dir, executor_name)
+        self.analysis_state = PipelineState(self.analysis_tree.analysis_dir, executor_name)
+
+    @property
+    def states(self):
+        return [state for state in [self.skewers_state, self.qq_state, self.analysis_state]
+                if state is not None]
+
     def run_mock(self):
         job_id = None
         job_id_deltas = None
@@ -215,13 +230,23 @@ class MockRun:
 
     def run_lyacolore(self, job_id):
         submit_utils.print_spacer_line()
-        check_transmission_files = list(self.qq_tree.skewers_path.glob("*/*/transmission-*.fits*"))
-        if len(check_transmission_files) < 1:
-            job_id = run_lyacolore(self.lyacolore_config, self.qq_tree.skewers_path, self.qq_seed,
-                                   self.job_config, job_id)
-        else:
+
+        def transmission_files_exist():
+            check_transmission_files = self.qq_tree.skewers_path.glob(
+                "*/*/transmission-*.fits*")
+            if next(check_transmission_files, None) is None:
+                return False
             print(f'Found transmission files in {self.qq_tree.skewers_path}. Skipping lyacolore.')
-        return job_id
+            return True
+
+        return self.skewers_state.run_stage(
+            'lyacolore',
+            lambda: run_lyacolore(self.lyacolore_config, self.qq_tree.skewers_path,
+                                  self.qq_seed, self.job_config, job_id),
+            inputs={'seed': self.qq_seed, 'config': dict(self.lyacolore_config)},
+            outputs=[self.qq_tree.skewers_path / 'master.fits'],
+            prev_job_id=job_id, legacy_done=transmission_files_exist
+        )
 
     def create_qq_catalog(self, job_id=None, run_local=True):
         seed_cat_path = self.qq_tree.qq_dir / "seed_zcat.fits"
@@ -240,29 +265,48 @@ class MockRun:
             )
         return job_id
 
-    def run_qq(self, job_id):
+    def run_qq(self, job_id, submit_catalogs=True):
         # TODO Figure out a way to check if QQ run already exists
         # Run quickquasars
         submit_utils.print_spacer_line()
-        check_spectra_files = list(self.qq_tree.spectra_dir.glob("*/*/spectra-*.fits*"))
         seed_cat_path = self.qq_tree.qq_dir / "seed_zcat.fits"
-        if len(check_spectra_files) < 1:
-            job_id = run_qq(
+
+        def spectra_files_exist():
+            check_spectra_files = self.qq_tree.spectra_dir.glob("*/*/spectra-*.fits*")
+            if next(check_spectra_files, None) is None:
+                return False
+            print(f'Found spectra files in {self.qq_tree.spectra_dir}. Skipping quickquasars.')
+            return True
+
+        job_id = self.qq_state.run_stage(
+            'quickquasars',
+            lambda: run_qq(
                 self.qq_tree, self.qq_config, self.job_config, seed_cat_path,
                 self.qq_seed, self.qq_special_args, prev_job_id=job_id
-            )
-        else:
-            print(f'Found spectra files in {self.qq_tree.spectra_dir}. Skipping quickquasars.')
+            ),
+            inputs={'seed': self.qq_seed, 'special_args': self.qq_special_args,
+                    'test_run': self.job_config.getboolean('test_run')},
+            outputs=[self.qq_tree.spectra_dir, seed_cat_path],
+            prev_job_id=job_id, legacy_done=spectra_files_exist
+        )
 
         # Make QSO, DLA, BAL catalogs
-        submit_utils.print_spacer_line()
-        job_id = make_catalogs(
-            self.qq_tree, self.qq_config, self.job_config,
-            self.dla_flag, self.bal_flag, job_id, self.only_qso_targets_flag
-        )
+        if submit_catalogs:
+            submit_utils.print_spacer_line()
+            job_id = make_catalogs(
+                self.qq_tree, self.qq_config, self.job_config,
+                self.dla_flag, self.bal_flag, job_id, self.only_qso_targets_flag
+            )
 
         return job_id
 
+    def get_catalog_steps(self):
+        """(name, command, env_command) of the catalog steps still needed after quickquasars."""
+        return make_catalogs(
+            self.qq_tree, self.qq_config, self.job_config, self.dla_flag, self.bal_flag,
+            None, self.only_qso_targets_flag, run_local=False
+        )
+
     def make_zerr_cat(self, qq_job_id, run_local=True):
         distribution = self.inject_zerr_config.get('distribution')
         amplitude = self.inject_zerr_config.get('amplitude')
@@ -279,23 +323,26 @@ class MockRun:
         if not run_local:
             return command
 
-        print('Submitting inject zerr job')
+        runtime_key = {'stage': 'zerr'}
+        hours = submit_utils.job_hours(runtime_key, 0.2)
+        force_inline = self.inject_zerr_config.getboolean('run_inline', True)
+        if not submit_utils.can_run_inline(hours, qq_job_id, force_inline):
+            print('Submitting inject zerr job')
         header = submit_utils.make_header(
-            self.job_config.get('nersc_machine'), nodes=1, time=0.2,
+            self.job_config.get('nersc_machine'), nodes=1, time=hours,
             omp_threads=128, job_name=f'zerr_{self.qq_tree.mock_seed}',
             err_file=self.qq_tree.runfiles_dir/'run-zerr-%j.err',
             out_file=self.qq_tree.runfiles_dir/'run-zerr-%j.out'
         )
 
-        env_command = self.job_config.get('env_command')
-        text = header + f'{env_command}\n\n' + command
-
-        script_path = self.qq_tree.scripts_dir / 'inject_zerr.sh'
-        submit_utils.write_script(script_path, text)
-
-        zerr_job_id = submit_utils.run_job(
-            script_path, dependency_ids=qq_job_id,
-            no_submit=self.job_config.getboolean('no_submit')
+        # This is a few seconds of numpy work, so by default it's run inline
+        # unless it has to wait for a Slurm job
+        zerr_job_id = submit_utils.run_command_job(
+            command, header, self.job_config.get('env_command'),
+            self.qq_tree.scripts_dir / 'inject_zerr.sh',
+            log_file=self.qq_tree.runfiles_dir/'run-zerr-inline.log', node_hours=hours,
+            dependency_ids=qq_job_id, no_submit=self.job_config.getboolean('no_submit'),
+            force_inline=force_inline, runtime_key=runtime_key
         )
 
         return zerr_job_id
@@ -303,6 +350,17 @@ class MockRun:
     def run_deltas(self, job_id):
         no_zerr = not self.inject_zerr_config.getboolean('zerr_in_deltas', False)
         qso_cat = self.get_analysis_qso_cat(no_zerr=no_zerr)
+        config = self.qsonic_config if self.run_qsonic_flag else self.deltas_config
+
+        return self.analysis_state.run_stage(
+            'deltas', lambda: self._submit_deltas(qso_cat, job_id),
+            inputs={'analysis_type': self.mock_analysis_type, 'qsonic': self.run_qsonic_flag,
+                    'qso_cat': qso_cat, 'config': dict(config)},
+            outputs=[self.analysis_tree.deltas_lya_dir, self.analysis_tree.deltas_lyb_dir],
+            prev_job_id=job_id
+        )
+
+    def _submit_deltas(self, qso_cat, job_id):
 
         # Run raw deltas
         if 'raw' in self.mock_analysis_type:
@@ -358,9 +416,15 @@ class MockRun:
             return job_id
 
     def run_pk1d(self, delta_job_ids):
-        job_id = make_pk1d_runs(
-            self.analysis_tree, self.pk1d_config, self.job_config,
-            delta_job_ids=delta_job_ids
+        job_id = self.analysis_state.run_stage(
+            'pk1d',
+            lambda: make_pk1d_runs(
+                self.analysis_tree, self.pk1d_config, self.job_config,
+                delta_job_ids=delta_job_ids
+            ),
+            inputs={'config': dict(self.pk1d_config)},
+            outputs=[self.analysis_tree.pk1d_lya_dir, self.analysis_tree.pk1d_lyb_dir],
+            prev_job_id=delta_job_ids
         )
         return job_id
 
@@ -0,0 +1,192 @@
+"""Slurm walltimes and node counts from the runtimes of previous jobs.
+
+The walltimes in the job scripts are otherwise fixed defaults: too long and the jobs wait
+longer for a backfill slot, too short and they time out on larger catalogs. The runtime
+history is a JSON-lines file with one record per submitted job. Each record holds a key
+(stage, tracer pair, nside, binning, ...), the catalog size, the number of nodes, and once
+the job finished, its elapsed time and peak memory harvested from the executor (sacct for
+Slurm). Catalogs that do not exist yet when the job is submitted are measured at harvest.
+
+The requested walltime of a new job is a quantile of the elapsed times of the finished
+jobs with the same key, scaled linearly with the catalog size and multiplied by a safety
+margin. Without enough history, the default walltime of the stage is used. The elapsed
+time of a job that timed out is only a lower bound of its runtime, so the next job with the
+same key asks for at least TIMEOUT_GROWTH times as long.
+"""
+import json
+import math
+import time
+from pathlib import Path
+
+import fitsio
+import numpy as np
+
+MIN_HOURS = 0.1
+MAX_HOURS = 48.
+TIMEOUT_GROWTH = 1.5
+
+
+def catalog_size(path):
+    """Number of rows in the first table of a FITS catalog, None if it does not exist yet."""
+    if path is None or not Path(path).is_file():
+        return None
+
+    try:
+        with fitsio.FITS(path) as hdul:
+            return hdul[1].read_header()['NAXIS2']
+    except (OSError, KeyError):
+        return None
+
+
+def _normalize(key):
+    return json.loads(json.dumps(key, default=str, sort_keys=True))
+
+
+class RuntimeModel:
+    """Runtime history of the pipeline jobs, used to size new jobs.
+
+    Parameters
+    ----------
+    path : str or Path
+        JSON-lines file holding the history
+    quantile : float, optional
+        Quantile of the previous elapsed times to request, by default 0.95
+    margin : float, optional
+        Factor applied on top of the quantile, by default 1.3
+    min_samples : int, optional
+        Number of finished jobs needed before the history is used, by default 3
+    """
+    def __init__(self, path, quantile=0.95, margin=1.3, min_samples=3):
+        self.path = Path(path)
+        self.quantile = quantile
+        self.margin = margin
+        self.min_samples = min_samples
+        self.pending = {}
+        self.finished = []
+
+        if self.path.is_file():
+            with open(self.path) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    self._add(record)
+
+    def _add(self, record):
+        if record.get('elapsed') is None:
+            self.pending[record['job_id']] = record
+        else:
+            self.pending.pop(record['job_id'], None)
+            self.finished.append(record)
+
+    def _append(self, record):
+        record['time'] = time.time()
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(record, default=str) + '\n')
+        self._add(record)
+
+    def register(self, job_id, key, size=None, nodes=1, catalog=None):
+        """Record a submitted job, so that its runtime is harvested by a later run.
+
+        On a new batch, the catalog of a job is often made by an upstream job that has not
+        run yet. Its size is then read from the catalog when the job is harvested.
+        """
+        if job_id is None or job_id <= 0:
+            return
+
+        record = {'job_id': job_id, 'key': _normalize(key), 'size': size, 'nodes': nodes}
+        if size is None and catalog is not None:
+            record['catalog'] = str(catalog)
+        self._append(record)
+
+    def harvest(self, executor):
+        """Add the elapsed time and peak memory of the pending jobs that have finished.
+
+        All the pending jobs are queried in one call to the executor. Timed out jobs are
+        kept as lower bounds of the runtime. Other failed jobs (errors, cancelled, out of
+        memory) are recorded with their state, but their elapsed time is not used.
+        """
+        job_ids = sorted(self.pending)
+        if len(job_ids) == 0:
+            return
+
+        job_states = executor.job_states(job_ids)
+        max_rss = executor.job_resources(job_ids)
+        for job_id in job_ids:
+            state, elapsed = job_states.get(job_id, ('UNKNOWN', None))
+            if state in ['COMPLETED', 'TIMEOUT'] and elapsed is not None:
+                record = dict(self.pending[job_id])
+                if record.get('size') is None:
+                    record['size'] = catalog_size(record.get('catalog'))
+                record['state'] = state
+                record['elapsed'] = elapsed
+                record['max_rss_mb'] = max_rss.get(job_id)
+                self._append(record)
+            elif state in ['FAILED', 'TIMEOUT']:
+                record = dict(self.pending[job_id])
+                record['state'] = state
+                record['elapsed'] = -1
+                record['max_rss_mb'] = max_rss.get(job_id)
+                self._append(record)
+
+    def _samples(self, key, size):
+        """Elapsed hours of the finished jobs with this key, scaled to the catalog size.
+
+        Returns the (hours, nodes) of the jobs, and the lower bounds on the hours and node
+        hours given by the jobs that timed out since the last one completed (0 if there
+        are none).
+        """
+        key = _normalize(key)
+        samples = []
+        timeouts = []
+        for record in self.finished:
+            if record['key'] != key or record['elapsed'] < 0:
+                continue
+
+            hours = record['elapsed'] / 3600
+            if size is not None and record.get('size'):
+                hours *= size / record['size']
+            samples.append((hours, record.get('nodes', 1)))
+
+            if record.get('state') == 'TIMEOUT':
+                timeouts.append(samples[-1])
+            else:
+                timeouts = []
+
+        min_hours = max([hours for hours, _ in timeouts], default=0.) * TIMEOUT_GROWTH
+        min_node_hours = max([hours * nodes for hours, nodes in timeouts], default=0.)
+        return samples, min_hours, min_node_hours * TIMEOUT_GROWTH
+
+    def hours(self, key, default_hours, size=None):
+        """Walltime in hours for a job with this key."""
+        samples, min_hours, _ = self._samples(key, size)
+        if len(samples) < self.min_samples:
+            if min_hours <= default_hours:
+                return default_hours
+            hours = min_hours
+        else:
+            hours = np.quantile([sample[0] for sample in samples], self.quantile) * self.margin
+            hours = max(hours, min_hours)
+
+        return float(np.clip(hours, MIN_HOURS, MAX_HOURS))
+
+    def nodes(self, key, default_nodes, default_hours, target_hours, size=None, max_nodes=None):
+        """Number of nodes and walltime to finish a job with this key in about target_hours.
+
+        Assumes the job scales linearly with the number of nodes.
+        """
+        samples, _, min_node_hours = self._samples(key, size)
+        if len(samples) < self.min_samples:
+            if min_node_hours <= default_nodes * default_hours:
+                return default_nodes, default_hours
+            node_hours = min_node_hours
+        else:
+            node_hours = np.quantile([hours * nodes for hours, nodes in samples], self.quantile)
+            node_hours = max(node_hours * self.margin, min_node_hours)
+
+        nodes = max(int(math.ceil(node_hours / target_hours)), 1)
+        if max_nodes is not None:
+            nodes = min(nodes, max_nodes)
+
+        return nodes, float(np.clip(node_hours / nodes, MIN_HOURS, MAX_HOURS))
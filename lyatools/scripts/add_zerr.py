@@ -1,23 +1,8 @@
 #!/usr/bin/env python3
 import argparse
 
-import fitsio
-import numpy as np
-import scipy as sp
-from scipy.constants import speed_of_light
-
 from lyatools import submit_utils
-
-
-def gen_lorentzian(loc, scale, size, cut):
-    samples = sp.stats.cauchy.rvs(loc=loc, scale=scale, size=3*size)
-    samples = samples[abs(samples) < cut]
-    if len(samples) >= size:
-        samples = samples[:size]
-    else:
-        # Only added for the very unlikely case that there are not enough samples after the cut.
-        samples = gen_lorentzian(loc, scale, size, cut)
-    return samples
+from lyatools.zerr import DISTRIBUTIONS, ZerrVariant, write_zerr_catalogs
 
 
 def main():
@@ -27,43 +12,36 @@ def main():
     parser.add_argument("-i", "--input", type=str, required=True,
                         help="Input catalog")
 
-    parser.add_argument("-o", "--output", type=str, required=True,
+    parser.add_argument("-o", "--output", type=str, required=False, default=None,
                         help="Ouput catalog with redshift errors")
 
-    parser.add_argument("-a", "--amplitude", type=float, required=True,
+    parser.add_argument("-a", "--amplitude", type=float, required=False, default=None,
                         help="Amplitude of redshift errors in km/s")
 
-    parser.add_argument("-t", "--type", type=str, required=True, choices=['gauss', 'lorentz'],
+    parser.add_argument("-t", "--type", type=str, required=False, default=None,
+                        choices=DISTRIBUTIONS,
                         help="Type of distribution to draw redshift errors from")
 
     parser.add_argument("-s", "--seed", type=int, required=False, default=0,
                         help="Seed for drawing random redshift errors")
 
-    args = parser.parse_args()
+    parser.add_argument("--variant", type=str, nargs=4, action='append', default=[],
+                        metavar=('TYPE', 'AMPLITUDE', 'SEED', 'OUTPUT'),
+                        help="Additional catalog to write from the same input. Can be repeated")
 
-    print(f'Creating new catalog with redshift errors from {args.input}.')
-    print(f'Distribution: {args.type}, Amplitude: {args.amplitude}')
-
-    hdul = fitsio.FITS(args.input)
-    header = hdul[1].read_header()
-    data = hdul[1].read()
-    size = data['Z'].size
-
-    np.random.seed(args.seed)
+    args = parser.parse_args()
 
-    dv = np.zeros(size)
-    if args.type == 'gauss':
-        dv = np.random.normal(0, args.amplitude, size)
-    elif args.type == 'lorentz':
-        dv = gen_lorentzian(0, args.amplitude, size, cut=2000)
-    else:
-        raise ValueError(f'Unkown distribution "{args.type}".')
+    variants = [ZerrVariant(*variant) for variant in args.variant]
+    if args.output is not None:
+        if args.amplitude is None or args.type is None:
+            parser.error('--output requires --amplitude and --type')
+        variants.insert(0, ZerrVariant(args.type, args.amplitude, args.seed, args.output))
 
-    data['Z'] += dv / (speed_of_light / 1e3) * (1 + data['Z'])
+    if len(variants) < 1:
+        parser.error('Nothing to write. Use --output or --variant')
 
-    results = fitsio.FITS(args.output, 'rw', clobber=True)
-    results.write(data, header=header)
-    results.close()
+    print(f'Creating {len(variants)} new catalog(s) with redshift errors from {args.input}.')
+    write_zerr_catalogs(args.input, variants)
 
     print('Done')
 
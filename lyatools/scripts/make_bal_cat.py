@@ -3,14 +3,19 @@
 import argparse
 import fitsio
 import numpy as np
-from multiprocessing import Pool
 
 from lyatools import submit_utils
+from lyatools.catalog_join import match_targetids
+from lyatools.gather import count_all_rows, gathered_tables, table_dtype
 
 
 def read_bals_from_truth(truth_file):
     with fitsio.FITS(truth_file) as hdul:
-        data = hdul['BAL_META'].read()
+        return bals_from_hdul(hdul)
+
+
+def bals_from_hdul(hdul):
+    data = hdul['BAL_META'].read()
 
     if data.shape[0] < 1:
         return None
@@ -20,35 +25,25 @@ def read_bals_from_truth(truth_file):
 
 def make_bal_catalog(input_dir, output_dir, ai_cut=None, bi_cut=None, nproc=1):
     spec_dir = submit_utils.find_path(input_dir)
-    truth_files = spec_dir.glob("*/*/truth-*.fits*")
+    truth_files = list(spec_dir.glob("*/*/truth-*.fits*"))
 
     # Read BALs from truth files
     print("Iterating over files")
-    bal_chunks = []
-    with Pool(processes=nproc) as pool:
-        imap_it = list(pool.imap(read_bals_from_truth, truth_files))
-
-        for arr in imap_it:
-            if arr is None:
-                continue
-
-            bal_chunks.append(arr)
-
-    num_bals = np.sum([chunk.size for chunk in bal_chunks])
+    counts = count_all_rows(truth_files, 'BAL_META', nproc=nproc)
+    num_bals = np.sum(counts)
+    if num_bals == 0:
+        raise ValueError(f'No BALs found in {spec_dir}.')
 
     print(f"There are {num_bals} BALs.")
 
-    output_catalog = np.empty(num_bals, dtype=bal_chunks[0].dtype)
-
-    i = 0
-    for chunk in bal_chunks:
-        nrows = chunk.size
-        if nrows == 0:
-            continue
+    dtype = table_dtype(truth_files[np.argmax(counts > 0)], 'BAL_META')
+    with gathered_tables(
+            truth_files, read_bals_from_truth, counts, dtype,
+            submit_utils.find_path(output_dir), nproc=nproc) as output_catalog:
+        write_bal_catalogs(output_catalog, output_dir, ai_cut, bi_cut)
 
-        output_catalog[i:i+nrows] = chunk
-        i += nrows
 
+def write_bal_catalogs(output_catalog, output_dir, ai_cut=None, bi_cut=None):
     # Write full BAL catalog
     output_path = submit_utils.find_path(output_dir)
     output_file = output_path / 'bal_cat.fits'
@@ -79,11 +74,9 @@ def make_bal_catalog(input_dir, output_dir, ai_cut=None, bi_cut=None, nproc=1):
         header = hdul_qso[1].read_header()
         qso_cat = hdul_qso[1].read()
 
-    _, common_idx, __ = np.intersect1d(
-        qso_cat['TARGETID'], output_catalog[~mask]['TARGETID'], return_indices=True)
-
-    qso_mask = np.ones(qso_cat.size, dtype=bool)
-    qso_mask[common_idx] = False
+    _, is_cut_bal = match_targetids(
+        qso_cat['TARGETID'], output_catalog[~mask]['TARGETID'], allow_duplicates=True)
+    qso_mask = ~is_cut_bal
 
     output_file = output_path / f'zcat_masked_AI_{ai_cut}_BI_{bi_cut}.fits'
     if not output_file.is_file():
@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+
+import argparse
+import os
+import fitsio
+import numpy as np
+from functools import partial
+from multiprocessing import Pool
+
+from lyatools import submit_utils
+from lyatools.gather import gathered_tables, table_dtype
+from lyatools.scripts.make_z_cat import FINAL_DTYPE as ZCAT_DTYPE
+from lyatools.scripts.make_z_cat import zcatalog_from_hdul, write_z_catalog
+from lyatools.scripts.make_bal_cat import bals_from_hdul, write_bal_catalogs
+from lyatools.scripts.make_dla_cat import FINAL_DTYPE as DLA_DTYPE
+from lyatools.scripts.make_dla_cat import dla_from_hdul
+
+HCD_META_NAME = 'hcd_truth_meta.fits'
+
+
+def _find_file(pix_dir, names, prefix):
+    for name in names:
+        if name.startswith(f'{prefix}-') and '.fits' in name:
+            return pix_dir / name
+    return None
+
+
+def _healpix_files(pix_dir, prefix):
+    names = sorted(os.listdir(pix_dir))
+    return _find_file(pix_dir, names, prefix), _find_file(pix_dir, names, 'truth')
+
+
+def count_healpix_dir(pix_dir, prefix='zbest', read_zcat=True, read_bal=False, read_dla=False):
+    """Header-only pass returning the (zcat, bal, hcd) row counts of one healpix directory."""
+    zbest_file, truth_file = _healpix_files(pix_dir, prefix)
+    counts = [0, 0, 0]
+
+    if read_zcat and zbest_file is not None:
+        with fitsio.FITS(zbest_file) as hdul:
+            counts[0] = hdul['ZBEST'].read_header()['NAXIS2']
+
+    if (read_bal or read_dla) and truth_file is not None:
+        with fitsio.FITS(truth_file) as hdul:
+            if read_bal:
+                counts[1] = hdul['BAL_META'].read_header()['NAXIS2']
+            if read_dla:
+                counts[2] = hdul['DLA_META'].read_header()['NAXIS2']
+
+    return counts
+
+
+def scan_healpix_dir(pix_dir, prefix='zbest', read_zcat=True, read_bal=False, read_dla=False):
+    """Read everything needed for the catalogs from one healpix directory.
+
+    The directory is listed once and each of the zbest and truth files is opened once,
+    with the ZBEST/FIBERMAP, BAL_META and DLA_META HDUs read from the open handles.
+
+    Returns
+    -------
+    (zcat, bals, hcds) : tuple
+        Catalog chunks for this healpix. Entries are None if empty or not requested.
+    """
+    zbest_file, truth_file = _healpix_files(pix_dir, prefix)
+    zcat, bals, hcds = None, None, None
+
+    if read_zcat and zbest_file is not None:
+        with fitsio.FITS(zbest_file) as hdul:
+            zcat = zcatalog_from_hdul(hdul)
+
+    if (read_bal or read_dla) and truth_file is not None:
+        with fitsio.FITS(truth_file) as hdul:
+            if read_bal:
+                bals = bals_from_hdul(hdul)
+            if read_dla:
+                hcds = dla_from_hdul(hdul)
+
+    return zcat, bals, hcds
+
+
+def make_catalogs(
+    input_dir, output_dir, zcat_name=None, prefix='zbest', only_qso_targets=False,
+    bal=False, ai_cut=None, bi_cut=None, dla=False, nproc=None
+):
+    """Make the QSO, BAL and HCD catalogs from a single pass over the spectra directory.
+
+    The HCD metadata is written to an intermediate file, to be finalized with
+    lyatools-make-dla-cat --hcd-cat once the SNR catalog exists.
+    """
+    spec_dir = submit_utils.find_path(input_dir)
+    output_path = submit_utils.find_path(output_dir)
+    pix_dirs = [path for path in spec_dir.glob("*/*") if path.is_dir()]
+
+    read_zcat = zcat_name is not None
+    kwargs = {'prefix': prefix, 'read_zcat': read_zcat, 'read_bal': bal, 'read_dla': dla}
+
+    print(f"Counting rows in {len(pix_dirs)} healpix directories")
+    with Pool(processes=nproc) as pool:
+        counts = np.array(pool.map(partial(count_healpix_dir, **kwargs), pix_dirs), dtype=int)
+
+    bal_dtype = np.dtype([('TARGETID', 'i8')])
+    if bal:
+        if np.sum(counts[:, 1]) == 0:
+            raise ValueError(f'No BALs found in {spec_dir}.')
+        _, truth_file = _healpix_files(pix_dirs[np.argmax(counts[:, 1] > 0)], prefix)
+        bal_dtype = table_dtype(truth_file, 'BAL_META')
+
+    print("Reading catalogs")
+    with gathered_tables(
+            pix_dirs, partial(scan_healpix_dir, **kwargs), counts,
+            [ZCAT_DTYPE, bal_dtype, DLA_DTYPE], output_path, nproc=nproc) as tables:
+        zcat_catalog, bal_catalog, hcd_catalog = tables
+
+        if read_zcat:
+            write_z_catalog(zcat_catalog, output_path / zcat_name, only_qso_targets)
+
+        if bal:
+            print(f"There are {bal_catalog.size} BALs.")
+            write_bal_catalogs(bal_catalog, output_path, ai_cut, bi_cut)
+
+        if dla:
+            print(f"There are {hcd_catalog.size} HCDs.")
+            with fitsio.FITS(output_path / HCD_META_NAME, 'rw', clobber=True) as file:
+                file.write(hcd_catalog, extname='DLA_META')
+
+
+def main():
+    submit_utils.set_umask()
+    parser = argparse.ArgumentParser(
+        description='Make the QSO, BAL and HCD catalogs in a single pass over the truth files.')
+
+    parser.add_argument("-i", "--input-dir", type=str, required=True,
+                        help="the spectra-16 directory containing zbest and truth files")
+
+    parser.add_argument("-o", "--output-dir", type=str, required=True,
+                        help="Name of output directory")
+
+    parser.add_argument("--zcat-name", type=str, default=None, required=False,
+                        help="Name of the QSO catalog to write. No QSO catalog if not given")
+
+    parser.add_argument("--prefix", type=str, default='zbest', required=False,
+                        help="Prefix of the redshift files")
+
+    parser.add_argument("--only-qso-targets", action="store_true",
+                        help="Keep only the QSO targets listed in seed_zcat.fits")
+
+    parser.add_argument("--bal", action="store_true",
+                        help="Make the BAL catalogs")
+
+    parser.add_argument("--ai-cut", type=int, default=None, required=False,
+                        help='AI cut for the BAL catalog')
+
+    parser.add_argument("--bi-cut", type=int, default=None, required=False,
+                        help='BI cut for the BAL catalog')
+
+    parser.add_argument("--dla", action="store_true",
+                        help=f"Write the HCD metadata to {HCD_META_NAME}")
+
+    parser.add_argument("--nproc", type=int, default=None, required=False,
+                        help='Number cores for parallelization')
+
+    args = parser.parse_args()
+
+    make_catalogs(
+        args.input_dir, args.output_dir, zcat_name=args.zcat_name, prefix=args.prefix,
+        only_qso_targets=args.only_qso_targets, bal=args.bal, ai_cut=args.ai_cut,
+        bi_cut=args.bi_cut, dla=args.dla, nproc=args.nproc
+    )
+
+
+if __name__ == '__main__':
+    main()
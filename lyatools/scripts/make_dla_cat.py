@@ -3,9 +3,10 @@
 import argparse
 import fitsio
 import numpy as np
-from multiprocessing import Pool
 
 from lyatools import submit_utils
+from lyatools.catalog_join import match_targetids
+from lyatools.gather import count_all_rows, gathered_tables
 
 FINAL_DTYPE = np.dtype(
     [('NHI', 'f8'), ('Z', 'f8'), ('TARGETID', 'i8'), ('DLAID', 'i8'), ('SNR', 'f8')])
@@ -13,38 +14,42 @@ FINAL_DTYPE = np.dtype(
 
 def make_dla_catalog(
     input_dir, output_dir, mask_nhi_cut=None, sigma_nhi_errors=None,
-    mask_snr_cut=None, completeness=1.0, seed=0, nproc=None
+    mask_snr_cut=None, completeness=1.0, seed=0, nproc=None, hcd_cat=None
 ):
+    write_args = (output_dir, mask_nhi_cut, sigma_nhi_errors, mask_snr_cut, completeness, seed)
+    if hcd_cat is not None:
+        print(f"Reading HCDs from {hcd_cat}")
+        write_dla_catalogs(read_hcd_catalog(hcd_cat), *write_args)
+        return
 
     spec_dir = submit_utils.find_path(input_dir)
-    truth_files = spec_dir.glob("*/*/truth-*.fits*")
-
-    dla_chunks = []
+    truth_files = list(spec_dir.glob("*/*/truth-*.fits*"))
 
     print("Iterating over files")
-    with Pool(processes=nproc) as pool:
-        imap_it = pool.imap(_get_dla_catalog, truth_files)
-
-        for arr in imap_it:
-            if arr is None:
-                continue
-
-            dla_chunks.append(arr)
+    counts = count_all_rows(truth_files, 'DLA_META', nproc=nproc)
+    print(f"There are {np.sum(counts)} HCDs.")
+    with gathered_tables(
+            truth_files, _get_dla_catalog, counts, FINAL_DTYPE,
+            submit_utils.find_path(output_dir), nproc=nproc) as output_catalog:
+        write_dla_catalogs(output_catalog, *write_args)
 
-    num_hcds = np.sum([chunk.size for chunk in dla_chunks])
 
-    print(f"There are {num_hcds} HCDs.")
-    output_catalog = np.empty(num_hcds, dtype=FINAL_DTYPE)
+def read_hcd_catalog(path):
+    data = fitsio.read(path, ext='DLA_META')
+    output_catalog = np.zeros(data.size, dtype=FINAL_DTYPE)
+    for name in FINAL_DTYPE.names:
+        if name in data.dtype.names:
+            output_catalog[name] = data[name]
 
-    i = 0
-    for chunk in dla_chunks:
-        nrows = chunk.size
-        if nrows == 0:
-            continue
+    print(f"There are {output_catalog.size} HCDs.")
+    return output_catalog
 
-        output_catalog[i:i+nrows] = chunk
-        i += nrows
 
+def write_dla_catalogs(
+    output_catalog, output_dir, mask_nhi_cut=None, sigma_nhi_errors=None,
+    mask_snr_cut=None, completeness=1.0, seed=0
+):
+    num_hcds = output_catalog.size
     output_path = submit_utils.find_path(output_dir)
     snr_cat_path = output_path / 'snr_cat.fits'
     snr_catalog = _read_snr_catalog(snr_cat_path, output_catalog['TARGETID'])
@@ -88,18 +93,19 @@ def make_dla_catalog(
 
 
 def _get_dla_catalog(truth_file):
-    hdul = fitsio.FITS(truth_file)
+    with fitsio.FITS(truth_file) as hdul:
+        return dla_from_hdul(hdul)
+
 
+def dla_from_hdul(hdul):
     hdr_dla = hdul['DLA_META'].read_header()
 
-    nrows = hdr_dla['NAXIS']
+    nrows = hdr_dla['NAXIS2']
     if nrows == 0:
-        hdul.close()
         return None
 
     dat_dla = hdul['DLA_META'].read()
     nrows = len(dat_dla)
-    hdul.close()
 
     newdata = np.empty(nrows, dtype=FINAL_DTYPE)
     newdata['NHI'] = dat_dla['NHI']
@@ -115,17 +121,15 @@ def _read_snr_catalog(path, targetids):
         raise FileNotFoundError('SNR catalog not found.')
 
     snr_catalog = fitsio.read(path, ext='SNRCAT', columns=['TARGETID', 'SNR_REDSIDE'])
-    in_catalog = np.isin(targetids, snr_catalog['TARGETID'])
-    if not np.all(in_catalog):
+    idx, found = match_targetids(targetids, snr_catalog['TARGETID'], allow_duplicates=True)
+    if not np.all(found):
         raise ValueError(
             'There are some TARGETIDs in the DLA catalog that are not in the SNR catalog.'
             ' This should not happen.'
         )
 
-    # Sort SNR catalog to match the order of the DLA catalog.
-    snr_catalog_sorted = np.sort(snr_catalog, order='TARGETID')
-    sort_indices = np.searchsorted(snr_catalog_sorted['TARGETID'], targetids)
-    snr_catalog = snr_catalog_sorted[sort_indices]
+    # Reorder SNR catalog to match the order of the DLA catalog.
+    snr_catalog = snr_catalog[idx]
     assert np.all(snr_catalog['TARGETID'] == targetids)
 
     return snr_catalog
@@ -172,11 +176,16 @@ def main():
     parser.add_argument("--nproc", type=int, default=None, required=False,
                         help='Number cores for parallelization')
 
+    parser.add_argument("--hcd-cat", type=str, default=None, required=False,
+                        help=('HCD metadata written by lyatools-make-catalogs. '
+                              'If given, the truth files are not read again.'))
+
     args = parser.parse_args()
 
     make_dla_catalog(
         args.input_dir, args.output_dir, args.mask_nhi_cut, args.nhi_error_amplitude,
-        args.mask_snr_cut, args.completeness, seed=args.seed, nproc=args.nproc
+        args.mask_snr_cut, args.completeness, seed=args.seed, nproc=args.nproc,
+        hcd_cat=args.hcd_cat
     )
 
 
@@ -4,10 +4,10 @@ import argparse
 import fitsio
 from astropy.io import fits
 import numpy as np
-from multiprocessing import Pool
 from pathlib import Path
 
 from lyatools import submit_utils
+from lyatools.gather import count_all_rows, gathered_tables
 
 
 FINAL_DTYPE = np.dtype([
@@ -19,13 +19,15 @@ FINAL_DTYPE = np.dtype([
 
 
 def one_zcatalog(fzbest):
-    fts = fitsio.FITS(fzbest)
+    with fitsio.FITS(fzbest) as fts:
+        return zcatalog_from_hdul(fts)
 
+
+def zcatalog_from_hdul(fts):
     hdr1 = fts['ZBEST'].read_header()
 
     nrows = hdr1['NAXIS2']
     if nrows == 0:
-        fts.close()
         return None
 
     newdata = np.empty(nrows, dtype=FINAL_DTYPE)
@@ -38,29 +40,23 @@ def one_zcatalog(fzbest):
     n1 = list(set(data.dtype.names).intersection(FINAL_DTYPE.names))
     newdata[n1] = data[n1]
 
-    fts.close()
-
     return newdata
 
 
 def make_z_catalog(input_dir, output_file, prefix='zbest', nproc=None, only_qso_targets=False):
     spec_dir = submit_utils.find_path(input_dir)
-    zbest_files = spec_dir.glob(f"*/*/{prefix}-*.fits*")
+    zbest_files = list(spec_dir.glob(f"*/*/{prefix}-*.fits*"))
 
     # Read quasars from truth files
     print("Iterating over files")
-    zcat_list = []
-    with Pool(processes=nproc) as pool:
-        imap_it = list(pool.imap(one_zcatalog, zbest_files))
+    counts = count_all_rows(zbest_files, 'ZBEST', nproc=nproc)
+    with gathered_tables(
+            zbest_files, one_zcatalog, counts, FINAL_DTYPE,
+            Path(output_file).parent, nproc=nproc) as final_data:
+        write_z_catalog(final_data, output_file, only_qso_targets)
 
-        for arr in imap_it:
-            if arr is None:
-                continue
 
-            zcat_list.append(arr)
-
-    final_data = np.concatenate(zcat_list)
-    
+def write_z_catalog(final_data, output_file, only_qso_targets=False):
     if only_qso_targets:
         seed_zcat=fits.open(Path(output_file).parents[0] / 'seed_zcat.fits')
         final_data = final_data[seed_zcat[1].data['IS_QSO_TARGET']]
@@ -1,10 +1,138 @@
 #!/usr/bin/env python3
+import re
 import sys
+import json
+import time
 import argparse
+from pathlib import Path
 from mpi4py import MPI
-from subprocess import run
 
 from lyatools import submit_utils
+from lyatools.provenance import command_hash
+from lyatools.task_runner import run_command
+
+SUMMARY_FILENAME = 'export_summary.jsonl'
+TAG_READY = 1
+TAG_TASK = 2
+
+
+def runtime_key(command):
+    """Key of a command in the runtime history.
+
+    The directories are removed from the paths in the command, so that the same export
+    (correlation type, redshift bin and options) of another mock gets the same key.
+    """
+    return command_hash(re.sub(r'[^\s=]*/', '', command))
+
+
+def read_history(summary_path):
+    """Latest wall time of each runtime key in a summary log from previous runs."""
+    history = {}
+    if not summary_path.is_file():
+        return history
+
+    with open(summary_path) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if record.get('returncode') == 0:
+                history[runtime_key(record['command'])] = record['wall_time']
+
+    return history
+
+
+def order_commands(commands, history, longest_first=False):
+    """Order of the command indexes to hand out.
+
+    With longest_first, commands without a recorded runtime go first, followed by the
+    others from the slowest to the fastest. Otherwise the input order is kept.
+    """
+    indexes = list(range(len(commands)))
+    if not longest_first:
+        return indexes
+
+    def sort_key(i):
+        wall_time = history.get(runtime_key(commands[i]))
+        return (wall_time is not None, -(wall_time or 0), i)
+
+    return sorted(indexes, key=sort_key)
+
+
+def execute_task(index, command, log_path, rank, in_process=True):
+    start = time.time()
+    returncode, stdout, stderr = run_command(command, in_process)
+    wall_time = time.time() - start
+
+    with open(f'{log_path}/export_{index}.log', 'w') as f:
+        f.write(stdout)
+        if returncode != 0:
+            f.write(stderr)
+
+    return {
+        'index': index, 'command': command, 'rank': rank,
+        'start': start, 'wall_time': wall_time, 'returncode': returncode,
+        'stderr': stderr[-2000:] if returncode != 0 else ''
+    }
+
+
+def write_summary(results, summary_path):
+    print('Export summary (slowest first):')
+    for result in sorted(results, key=lambda res: -res['wall_time']):
+        status = 'OK' if result['returncode'] == 0 else f'FAILED ({result["returncode"]})'
+        print(f'{result["wall_time"]:10.1f}s  rank {result["rank"]:4d}  {status:12s}  '
+              f'export_{result["index"]}.log')
+
+    failed = [res for res in results if res['returncode'] != 0]
+    for result in failed:
+        print(f'Command {result["index"]} failed: {result["command"]}')
+        print(result['stderr'])
+
+    print(f'Summary appended to {summary_path}')
+    return len(failed)
+
+
+def run_master(comm, commands, log_path, summary_path, longest_first):
+    """Hand out the commands to the worker ranks as they become free."""
+    order = order_commands(commands, read_history(summary_path), longest_first)
+    num_workers = comm.Get_size() - 1
+    results = []
+
+    status = MPI.Status()
+    with open(summary_path, 'a') as summary:
+        while num_workers > 0:
+            result = comm.recv(source=MPI.ANY_SOURCE, tag=TAG_READY, status=status)
+            worker = status.Get_source()
+
+            if result is not None:
+                results.append(result)
+                summary.write(json.dumps(result) + '\n')
+                summary.flush()
+
+            if len(order) > 0:
+                comm.send(order.pop(0), dest=worker, tag=TAG_TASK)
+            else:
+                comm.send(None, dest=worker, tag=TAG_TASK)
+                num_workers -= 1
+
+    return results
+
+
+def run_worker(comm, commands, log_path, print_func, in_process=True):
+    """Ask the master for commands until there are none left."""
+    rank = comm.Get_rank()
+    result = None
+    while True:
+        comm.send(result, dest=0, tag=TAG_READY)
+        index = comm.recv(source=0, tag=TAG_TASK)
+        if index is None:
+            break
+
+        print_func(f'Running command {index}: {commands[index]}')
+        result = execute_task(index, commands[index], log_path, rank, in_process)
+        print_func(f'Finished export index {index} in {result["wall_time"]:.1f}s '
+                   f'with exit code {result["returncode"]}.')
 
 
 def main():
@@ -15,6 +143,12 @@ def main():
                         help="The picca export commands to run.")
     parser.add_argument("-l", "--log-path", type=str, required=True,
                         help="The path to the log files.")
+    parser.add_argument("--longest-first", action="store_true", default=False,
+                        help=("Hand out the commands from the slowest to the fastest, using "
+                              f"the runtimes recorded in {SUMMARY_FILENAME} by previous runs."))
+    parser.add_argument("--subprocess", action="store_true", default=False,
+                        help=("Run each command in a new shell instead of running its Python "
+                              "scripts inside the worker process."))
 
     args = parser.parse_args()
 
@@ -25,30 +159,29 @@ def main():
     mpi_comm = MPI.COMM_WORLD
     cpu_rank = mpi_comm.Get_rank()
     num_cpus = mpi_comm.Get_size()
-    if num_cpus > len(args.commands):
-        raise ValueError(f'There are more cores ({num_cpus}) than commands ({len(args.commands)}).')
-
-    num_tasks_per_proc = len(args.commands) // num_cpus
-    remainder = len(args.commands) % num_cpus
-    if cpu_rank < remainder:
-        start = int(cpu_rank * (num_tasks_per_proc + 1))
-        stop = int(start + num_tasks_per_proc + 1)
-    else:
-        start = int(cpu_rank * num_tasks_per_proc + remainder)
-        stop = int(start + num_tasks_per_proc)
+    summary_path = Path(args.log_path) / SUMMARY_FILENAME
 
-    print_func(f'Running export indexes {start} to {stop}.')
-
-    for i in range(start, stop):
-        print_func(f'Running command: {args.commands[i]}')
-        process = run(args.commands[i], shell=True, capture_output=True)
-        if process.returncode != 0:
-            raise ValueError(f'Running {args.commands[i]} returned non-zero exitcode '
-                             f'with error {process.stderr}')
+    if num_cpus == 1:
+        # No workers, run everything on this rank
+        order = order_commands(args.commands, read_history(summary_path), args.longest_first)
+        results = []
+        with open(summary_path, 'a') as summary:
+            for index in order:
+                print_func(f'Running command {index}: {args.commands[index]}')
+                results.append(execute_task(
+                    index, args.commands[index], args.log_path, 0, not args.subprocess))
+                summary.write(json.dumps(results[-1]) + '\n')
+    elif cpu_rank == 0:
+        print_func(f'Scheduling {len(args.commands)} commands on {num_cpus - 1} workers.')
+        results = run_master(
+            mpi_comm, args.commands, args.log_path, summary_path, args.longest_first)
+    else:
+        run_worker(mpi_comm, args.commands, args.log_path, print_func, not args.subprocess)
+        return
 
-        with open(f'{args.log_path}/export_{i}.log', 'w') as f:
-            f.write(process.stdout.decode('utf-8'))
-        print_func(f'Finished export index {i}.')
+    num_failed = write_summary(results, summary_path)
+    if num_failed > 0:
+        raise ValueError(f'{num_failed} of {len(args.commands)} commands failed.')
 
 
 if __name__ == '__main__':
@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+
+import argparse
+from pathlib import Path
+
+from lyatools.partition import (
+    lpt_partition, lyacolore_pixels, pixel_counts_from_master, write_node_lists
+)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=('Split the healpix pixels of a LyaCoLoRe run between nodes, balancing '
+                     'the number of sources on each node'))
+
+    parser.add_argument("-i", "--lyacolore-out", type=str, required=True,
+                        help="LyaCoLoRe output directory, after make_master")
+
+    parser.add_argument("-o", "--out-dir", type=str, required=True,
+                        help="Directory to write the node-<n>.txt pixel lists to")
+
+    parser.add_argument("--num-nodes", type=int, required=True,
+                        help="Number of nodes")
+
+    parser.add_argument("--master", type=str, default=None, required=False,
+                        help="Master catalog. Defaults to master.fits in the LyaCoLoRe output")
+
+    parser.add_argument("--pixel-cost", type=float, default=100, required=False,
+                        help="Fixed cost of processing a pixel, in number of sources")
+
+    args = parser.parse_args()
+
+    lyacolore_out = Path(args.lyacolore_out)
+    pixels = lyacolore_pixels(lyacolore_out)
+    if len(pixels) == 0:
+        raise FileNotFoundError(f'No pixel directories found in {lyacolore_out}')
+
+    master = args.master
+    if master is None:
+        master = lyacolore_out / 'master.fits'
+
+    if Path(master).is_file():
+        pixel_counts = pixel_counts_from_master(master)
+        counts = [pixel_counts.get(pixel, 0) for pixel in pixels]
+    else:
+        print(f'WARNING: {master} not found. Giving every node the same number of pixels.')
+        counts = [0] * len(pixels)
+
+    weights = [count + args.pixel_cost for count in counts]
+    groups, loads = lpt_partition(weights, args.num_nodes)
+    write_node_lists(pixels, groups, args.out_dir)
+
+    print(f'Split {len(pixels)} pixels with {sum(counts)} sources between '
+          f'{args.num_nodes} nodes')
+    for node, (group, load) in enumerate(zip(groups, loads), start=1):
+        print(f'node {node}: {len(group)} pixels, load {load:.0f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+
+import argparse
+import os
+from pathlib import Path
+
+try:
+    from lyatools.partition import lpt_partition, transmission_counts, write_node_lists
+except ImportError:
+    # This script is run by path from the DESI environment, where lyatools may not be
+    # importable. The partitioning only depends on numpy and fitsio, so load it from the file.
+    import importlib.util
+    _spec = importlib.util.spec_from_file_location(
+        'partition',
+        os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'partition.py')
+    )
+    _partition = importlib.util.module_from_spec(_spec)
+    _spec.loader.exec_module(_partition)
+    lpt_partition = _partition.lpt_partition
+    transmission_counts = _partition.transmission_counts
+    write_node_lists = _partition.write_node_lists
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=('Split the transmission files of a mock between nodes, balancing the '
+                     'number of quasars on each node'))
+
+    parser.add_argument("-i", "--skewers-path", type=str, required=True,
+                        help="Directory holding the <pix//100>/<pix>/transmission files")
+
+    parser.add_argument("-o", "--out-dir", type=str, required=True,
+                        help="Directory to write the node-<n>.txt file lists to")
+
+    parser.add_argument("--num-nodes", type=int, required=True,
+                        help="Number of nodes")
+
+    parser.add_argument("--master", type=str, default=None, required=False,
+                        help=("Master catalog giving the quasars per pixel. Defaults to "
+                              "master.fits in the skewers path. Without it, the counts are "
+                              "read from the transmission file headers"))
+
+    parser.add_argument("--file-cost", type=float, default=100, required=False,
+                        help="Fixed cost of processing a file, in number of quasars")
+
+    parser.add_argument("--max-files", type=int, default=None, required=False,
+                        help="Only use the first files (for test runs)")
+
+    args = parser.parse_args()
+
+    skewers_path = Path(args.skewers_path)
+    files = sorted(skewers_path.glob('*/*/transmission*.fits*'))[:args.max_files]
+    if len(files) == 0:
+        raise FileNotFoundError(f'No transmission files found in {skewers_path}')
+
+    master = args.master
+    if master is None:
+        master = skewers_path / 'master.fits'
+    counts = transmission_counts(files, master)
+
+    weights = [count + args.file_cost for count in counts]
+    groups, loads = lpt_partition(weights, args.num_nodes)
+    write_node_lists(files, groups, args.out_dir)
+
+    print(f'Split {len(files)} files with {sum(counts)} quasars between {args.num_nodes} nodes')
+    for node, (group, load) in enumerate(zip(groups, loads), start=1):
+        print(f'node {node}: {len(group)} files, load {load:.0f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+
+import argparse
+import configparser
+import json
+
+from lyatools import submit_utils
+from lyatools.perf_report import (
+    find_perf_files, read_records, add_queue_wait, summarize, find_qq_node_outliers,
+    format_report, estimate_batch_cost
+)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=('Summarize the timing and resource use of the jobs of a batch of mocks, '
+                     'from the perf.jsonl records of the instrumented job scripts'))
+
+    parser.add_argument("paths", type=str, nargs="*",
+                        help="Directories to search for perf.jsonl files")
+
+    parser.add_argument("-i", "--config-file", type=str, default=None, required=False,
+                        help=("lyatools configuration file of the batch. Its mock and analysis "
+                              "start paths are searched"))
+
+    parser.add_argument("--sacct", action="store_true", default=False,
+                        help="Query sacct for the queue wait of the jobs")
+
+    parser.add_argument("--outlier-factor", type=float, default=2., required=False,
+                        help="Flag the jobs slower than this factor times the stage median")
+
+    parser.add_argument("--node-outlier-factor", type=float, default=1.5, required=False,
+                        help=("Flag the quickquasars nodes slower than this factor times the "
+                              "median node of their job"))
+
+    parser.add_argument("--num-mocks", type=int, default=None, required=False,
+                        help="Estimate the node hours of a batch of this many mocks")
+
+    parser.add_argument("--json", type=str, default=None, required=False,
+                        help="Also write the per-stage summary to this JSON file")
+
+    args = parser.parse_args()
+
+    paths = list(args.paths)
+    if args.config_file is not None:
+        config = configparser.ConfigParser()
+        config.optionxform = lambda option: option
+        config.read(submit_utils.find_path('defaults/desi_y5.ini'))
+        config.read(submit_utils.find_path(args.config_file))
+        paths += [
+            submit_utils.find_path(config['mock_setup'][key])
+            for key in ['mock_start_path', 'analysis_start_path']
+        ]
+
+    if len(paths) == 0:
+        parser.error('Give the directories to search or a configuration file.')
+
+    records = read_records(find_perf_files(paths))
+    if len(records) == 0:
+        print('No perf.jsonl records found. Are the jobs run with instrument_jobs = True?')
+        return
+
+    if args.sacct:
+        add_queue_wait(records)
+
+    summary, outliers = summarize(records, args.outlier_factor)
+    qq_outliers = find_qq_node_outliers(records, args.node_outlier_factor)
+    num_failed = sum(record['returncode'] != 0 for record in records)
+
+    print(format_report(summary, outliers, qq_outliers, num_failed, args.num_mocks))
+
+    if args.json is not None:
+        output = {'stages': summary, 'num_failed': num_failed}
+        if args.num_mocks is not None:
+            output['estimated_node_hours'] = estimate_batch_cost(summary, args.num_mocks)
+        with open(args.json, 'w') as f:
+            json.dump(output, f, indent=4)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+"""Run a command and append a JSON record of its timing and resource use to a log.
+
+The generated job scripts re-run themselves through this wrapper (see
+submit_utils.make_header). It only uses the standard library, so it runs with the system
+python3 before any environment is loaded.
+
+The peak memory and I/O are those of the processes started on this node and waited for
+by the command. The tasks that srun starts on other nodes are not included; their usage
+is in sacct. The I/O is counted at the read and write calls (rchar and wchar in
+/proc/<pid>/io), so unlike the block I/O counts of getrusage it includes the traffic to
+network filesystems such as Lustre and NFS.
+"""
+import argparse
+import json
+import os
+import resource
+import socket
+import subprocess
+import sys
+import time
+
+
+def read_io_counters():
+    """Bytes read and written by this process and its waited for children.
+
+    Returns None where /proc/self/io is not available.
+    """
+    try:
+        with open('/proc/self/io') as f:
+            counters = dict(line.split(':', 1) for line in f if ':' in line)
+        return int(counters['rchar']), int(counters['wchar'])
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--log", type=str, required=True,
+                        help="JSON-lines file to append the record to")
+    parser.add_argument("--stage", type=str, required=True,
+                        help="Name of the stage or job")
+    parser.add_argument("command", nargs=argparse.REMAINDER,
+                        help="Command to run, after --")
+
+    args = parser.parse_args()
+    command = args.command[1:] if args.command[:1] == ['--'] else args.command
+
+    io_start = read_io_counters()
+    start = time.time()
+    returncode = subprocess.call(command)
+    end = time.time()
+    io_end = read_io_counters()
+
+    read_bytes, write_bytes = None, None
+    if io_start is not None and io_end is not None:
+        read_bytes = io_end[0] - io_start[0]
+        write_bytes = io_end[1] - io_start[1]
+
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    record = {
+        'stage': args.stage,
+        'job_id': os.environ.get('SLURM_JOB_ID'),
+        'num_nodes': os.environ.get('SLURM_JOB_NUM_NODES'),
+        'host': socket.gethostname(),
+        'start': start,
+        'end': end,
+        'wall_time': end - start,
+        'user_time': usage.ru_utime,
+        'system_time': usage.ru_stime,
+        # ru_maxrss is in kB on Linux
+        'max_rss_mb': usage.ru_maxrss / 1024,
+        'read_bytes': read_bytes,
+        'write_bytes': write_bytes,
+        'returncode': returncode,
+    }
+
+    try:
+        with open(args.log, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+    except OSError as error:
+        print(f'Could not write performance record to {args.log}: {error}', file=sys.stderr)
+
+    # Killed by a signal
+    if returncode < 0:
+        returncode = 128 - returncode
+    sys.exit(returncode)
+
+
+if __name__ == '__main__':
+    main()
@@ -25,10 +25,25 @@ def main():
     parser.add_argument("--shuffled-correlations", type=str, default=None, required=False,
                         nargs="*", help="the xcf.... shuffled correlation files to be subtracted")
 
+    parser.add_argument("--append", action="store_true", default=False,
+                        help=("Only add the files missing from the stack statistics saved with "
+                              "the previous output. Recompute the stack if they cannot be used"))
+
+    parser.add_argument("--nproc", type=int, default=1, required=False,
+                        help="Number of processes reading the input files")
+
+    parser.add_argument("--mpi", action="store_true", default=False,
+                        help="Spread the input files over MPI ranks (run with srun)")
+
+    parser.add_argument("--healpix-cache", action="store_true", default=False,
+                        help=("Read the correlations from float32 per-healpix caches written "
+                              "next to them, creating the caches if needed"))
+
     args = parser.parse_args()
 
     stack_export_correlations(
-        args.data, args.out, not args.no_smooth_cov, args.dmat, args.shuffled_correlations)
+        args.data, args.out, not args.no_smooth_cov, args.dmat, args.shuffled_correlations,
+        args.append, nproc=args.nproc, use_mpi=args.mpi, use_cache=args.healpix_cache)
 
 
 if __name__ == '__main__':
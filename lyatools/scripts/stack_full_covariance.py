@@ -2,46 +2,88 @@
 import fitsio
 import argparse
 import numpy as np
-from functools import reduce
+from functools import partial, reduce
 from multiprocessing import Pool
 from lyatools import submit_utils
-from picca.utils import compute_cov
+from lyatools.covariance import (StreamingCovariance, compute_covariance, get_binning,
+                                 smooth_covariance)
+from lyatools.healpix_cache import load_correlation, match_healpix, shuffled_means
+
+CORRELATIONS = ['lyaxlya', 'lyaxlyb', 'lyaxqso', 'lybxqso']
+
+
+def read_corr(files, shuffled_files=None, use_cache=False):
+    """Read the correlations of one mock and join them over their common healpixels.
+
+    Each file is read once, from its float32 healpix cache if use_cache is True. The
+    rows are ordered by HEALPID, and the per-healpix shuffled correlation is subtracted
+    from the blocks that have a shuffled file.
+    """
+    if shuffled_files is None:
+        shuffled_files = [None] * len(files)
+
+    corrs = [load_correlation(file, use_cache) for file in files]
+    for file, corr in zip(files, corrs):
+        print(file, "correlation shape=", corr.xi.shape)
+
+    common_hp = reduce(partial(np.intersect1d, assume_unique=True),
+                       [corr.healpix for corr in corrs])
 
-def read_corr(files):
     xi = []
     weights = []
-    hp_ids = []
-
-    for file in files:
-        with fitsio.FITS(file) as hdul:
-            txi=None
-            if 'DA' in hdul[2].get_colnames():
-                txi=hdul[2]['DA'][:]
-            else:
-                txi=hdul[2]['DA_BLIND'][:]
-            print(file,"correlation shape=",txi.shape)
-            weights.append(hdul[2]['WE'][:])
-            hp_ids.append(hdul[2]["HEALPID"][:])        
-        xi.append(txi)
-    
-    common_hp = reduce(np.intersect1d, hp_ids)
-    masks = [np.in1d(hp_ids_i, common_hp) for hp_ids_i in hp_ids]
-
-    xi = np.hstack([xi_i[mask] for xi_i, mask in zip(xi, masks)])
-    weights = np.hstack([weights_i[mask] for weights_i, mask in zip(weights, masks)])
+    for file, corr, shuffled_file in zip(files, corrs, shuffled_files):
+        rows = match_healpix(corr.healpix, common_hp, file)
+        xi_block = corr.xi[rows]
+
+        if shuffled_file is not None:
+            shuffled = load_correlation(shuffled_file, use_cache)
+            index = match_healpix(shuffled.healpix, common_hp, shuffled_file)
+            xi_block = xi_block - shuffled_means(shuffled)[index][:, None]
+
+        xi.append(xi_block)
+        weights.append(corr.weights[rows])
+
+    xi = np.hstack(xi)
+    weights = np.hstack(weights)
 
     return xi, weights
 
-def read_all(files, nproc):
+
+def accumulate_covariance(files, nproc, shuffled_files=None, use_cache=False):
+    """Compute the covariance reading at most nproc mocks at a time."""
+    if shuffled_files is None:
+        shuffled_files = [None] * len(files)
+
+    if len(files) == 1:
+        # Single mock, no need for the streaming accumulators
+        xi, weights = read_corr(files[0], shuffled_files[0], use_cache)
+        return compute_covariance(xi, weights)
+
+    accumulator = None
+    tasks = [(mock_files, mock_shuffled, use_cache)
+             for mock_files, mock_shuffled in zip(files, shuffled_files)]
     with Pool(processes=nproc) as pool:
-        results = list(pool.imap(read_corr, files))
-    xi = np.vstack([res[0] for res in results])
-    weights = np.vstack([res[1] for res in results])
-    return xi, weights
+        for start in range(0, len(tasks), nproc):
+            results = pool.starmap(read_corr, tasks[start:start + nproc])
+            for xi, weights in results:
+                if accumulator is None:
+                    accumulator = StreamingCovariance(xi.shape[1])
+                accumulator.add(xi, weights)
+
+    return accumulator.covariance()
+
+
+def write_covariance(cov, path):
+    results = fitsio.FITS(path, 'rw', clobber=True)
+    results.write([cov], names=['COV'], units=[''], extname='COVMAT')
+    results.close()
+
 
 def main():
     submit_utils.set_umask()
-    parser = argparse.ArgumentParser()
+    parser = argparse.ArgumentParser(
+        description=('Full covariance of the correlations, from one or more mocks, '
+                     'and its smoothed version.'))
 
     parser.add_argument("--lyaxlya", type=str, nargs="*", default = None,
                         help="Correlation files for lyaxlya.")
@@ -51,38 +93,60 @@ def main():
                         help="Correlation files for lyaxqso.")
     parser.add_argument("--lybxqso", type=str, nargs="*", default = None,
                         help="Correlation files for lybxqso.")
+    parser.add_argument("--lyaxqso-shuffled", type=str, nargs="*", default=None,
+                        help="Shuffled correlation files to subtract from lyaxqso.")
+    parser.add_argument("--lybxqso-shuffled", type=str, nargs="*", default=None,
+                        help="Shuffled correlation files to subtract from lybxqso.")
     parser.add_argument("--outfile", type=str, required=True, help="name of output file")
+    parser.add_argument("--smooth-outfile", type=str, default=None, required=False,
+                        help="name of the smoothed covariance file. Not smoothed if not given")
     parser.add_argument("--no-smooth-cov", action="store_true", default=False,
-                        help="Whether to turn off smoothing of the covariance matrix")
+                        help=("Deprecated, the covariance is only smoothed with "
+                              "--smooth-outfile. Ignores --smooth-outfile if given"))
     parser.add_argument("--nproc", type=int, default=128, required=False, help="Number of processes")
+    parser.add_argument("--healpix-cache", action="store_true", default=False,
+                        help=("Read the correlations from float32 per-healpix caches written "
+                              "next to them, creating the caches if needed"))
 
     args = parser.parse_args()
-    
+
+    if args.no_smooth_cov and args.smooth_outfile is not None:
+        print('WARNING: --no-smooth-cov is deprecated. Not writing the smoothed covariance.')
+        args.smooth_outfile = None
+
     all_files = []
-    if args.lyaxlya is not None:
-        all_files.append(args.lyaxlya)
-    if args.lyaxlyb is not None:
-        all_files.append(args.lyaxlyb)
-    if args.lyaxqso is not None:
-        all_files.append(args.lyaxqso)
-    if args.lybxqso is not None:
-        all_files.append(args.lybxqso)
+    all_shuffled = []
+    for name in CORRELATIONS:
+        files = getattr(args, name)
+        if files is None:
+            continue
+
+        shuffled = getattr(args, f'{name}_shuffled', None)
+        if shuffled is not None and len(shuffled) != len(files):
+            raise ValueError(f'Expected one shuffled correlation per {name} file.')
+
+        all_files.append(files)
+        all_shuffled.append(shuffled if shuffled is not None else [None] * len(files))
+
     if len(all_files) == 0:
         raise ValueError("No correlation files provided.")
     # Check that all lists have the same length
     if not all(len(f) == len(all_files[0]) for f in all_files):
         raise ValueError("All correlation file lists must have the same length.")
     all_files = list(zip(*all_files))
+    all_shuffled = list(zip(*all_shuffled))
 
     print(f'Reading {len(all_files)} mocks...')
-    xi, weights = read_all(all_files, nproc=args.nproc)
+    cov = accumulate_covariance(all_files, nproc=args.nproc, shuffled_files=all_shuffled,
+                                use_cache=args.healpix_cache)
     print('Done reading')
 
-    cov = compute_cov(xi, weights)
-
     print('Writing covariance')
-    results = fitsio.FITS(args.outfile, 'rw', clobber=True)
-    results.write([cov], names=['COV'], units=[''], extname='COVMAT')
-    results.close()
+    write_covariance(cov, args.outfile)
+
+    if args.smooth_outfile is not None:
+        print('Smoothing covariance')
+        binnings = [get_binning(fitsio.read_header(file, ext=1)) for file in all_files[0]]
+        write_covariance(smooth_covariance(cov, binnings), args.smooth_outfile)
 
     print('Done')
@@ -0,0 +1,24 @@
+#!/usr/bin/env python3
+
+import argparse
+
+from lyatools import submit_utils
+from lyatools.provenance import finalize
+
+
+def main():
+    submit_utils.set_umask()
+    parser = argparse.ArgumentParser(
+        description='Finalize the provenance manifest of an output after its job succeeded.')
+
+    parser.add_argument("-m", "--manifest", type=str, required=True, nargs='*',
+                        help="Pending provenance manifest(s) to finalize.")
+
+    args = parser.parse_args()
+
+    for manifest in args.manifest:
+        finalize(manifest)
+
+
+if __name__ == '__main__':
+    main()
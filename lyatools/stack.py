@@ -1,32 +1,293 @@
+import json
+import os
+from multiprocessing import Pool
+from pathlib import Path
+
 import fitsio
 import numpy as np
 import scipy.linalg
-from picca.utils import smooth_cov, compute_cov
 
+from lyatools.covariance import StreamingCovariance, smooth_covariance
+from lyatools.healpix_cache import load_correlation, match_healpix, shuffled_means
+
+# Header entries that must be consistent across all the files being stacked
+HEADERS_TO_CHECK_MATCH = ['NP', 'NT', 'OMEGAM', 'OMEGAR', 'OMEGAK', 'WL', 'NSIDE']
+STATS_SUFFIX = '.stats.npz'
+# Number of files per partial stack. The partial stacks are always merged in input order,
+# so the result does not depend on the number of processes.
+CHUNK_SIZE = 4
+
+
+def stats_path(output_file):
+    """Path of the sufficient statistics saved next to a stacked export."""
+    output_file = Path(output_file)
+    return output_file.parent / (output_file.name + STATS_SUFFIX)
+
+
+def _file_id(path):
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
 
-def get_shuffled_correlations(files, headers_to_check_match_values):
-    xi_shuffled_list = []
-    for file in files:
+
+class CorrelationStack:
+    """Sufficient statistics of a stack of correlation functions.
+
+    Holds the weighted sums of RP, RT and Z, the number of pairs, the total weights,
+    the streaming covariance accumulators and the list of contributing files. Files
+    can be added one at a time, and the statistics saved to and loaded from an npz
+    file so that new mocks can be added to an existing stack.
+
+    Parameters
+    ----------
+    header_values : dict
+        Values of HEADERS_TO_CHECK_MATCH shared by all the stacked files
+    num_bins : int
+        Number of correlation bins
+    subtract_shuffled : bool, optional
+        Whether the shuffled correlations are subtracted, by default False
+    """
+    def __init__(self, header_values, num_bins, subtract_shuffled=False):
+        self.header_values = header_values
+        self.subtract_shuffled = subtract_shuffled
+
+        self.r_par = np.zeros(num_bins)
+        self.r_trans = np.zeros(num_bins)
+        self.z = np.zeros(num_bins)
+        self.num_pairs = np.zeros(num_bins, dtype=np.int64)
+        self.weights_total = np.zeros(num_bins)
+        self.covariance = StreamingCovariance(num_bins)
+
+        self.r_par_min = 1.e6
+        self.r_par_max = -1.e6
+        self.r_trans_max = -1.e6
+        self.z_cut_min = 1.e6
+        self.z_cut_max = -1.e6
+
+        self.files = []
+        self.file_ids = []
+
+    @classmethod
+    def from_file(cls, file, subtract_shuffled=False):
+        """Empty stack with the header values and binning of a correlation file."""
         with fitsio.FITS(file) as hdul:
-            for entry, value in headers_to_check_match_values.items():
-                head = hdul[1].read_header()
-                assert head[entry] == value
+            header = hdul[1].read_header()
+
+        header_values = {h: header[h] for h in HEADERS_TO_CHECK_MATCH}
+        return cls(header_values, header['NAXIS2'], subtract_shuffled)
+
+    def add_file(self, file, shuffled_file=None, use_cache=False):
+        """Add the weighted contributions of one correlation file to the stack.
+
+        With use_cache, the correlations are read from their float32 healpix caches.
+        """
+        print("coadding file {}".format(file))
+        corr = load_correlation(file, use_cache)
+        header = corr.header
+
+        # Check that the header properties match those from the first file
+        for entry in HEADERS_TO_CHECK_MATCH:
+            assert header[entry] == self.header_values[entry]
+
+        weights = corr.weights
+        weights_total_aux = weights.sum(axis=0, dtype=float)
+        self.r_par += corr.r_par * weights_total_aux
+        self.r_trans += corr.r_trans * weights_total_aux
+        self.z += corr.z * weights_total_aux
+        self.num_pairs += corr.num_pairs
+        self.weights_total += weights_total_aux
+
+        xi = corr.xi
+
+        # Update values to go in stack header
+        self.r_par_min = np.min([self.r_par_min, header['RPMIN']])
+        self.r_par_max = np.max([self.r_par_max, header['RPMAX']])
+        self.r_trans_max = np.max([self.r_trans_max, header['RTMAX']])
+        self.z_cut_min = np.min([self.z_cut_min, header['ZCUTMIN']])
+        self.z_cut_max = np.max([self.z_cut_max, header['ZCUTMAX']])
+
+        if shuffled_file is not None:
+            shuffled = load_correlation(shuffled_file, use_cache)
+            for entry, value in self.header_values.items():
+                assert shuffled.header[entry] == value
+
+            index = match_healpix(shuffled.healpix, corr.healpix, shuffled_file)
+            xi = xi - shuffled_means(shuffled)[index][:, None]
+
+        self.covariance.add(xi, weights)
+        self.files.append(os.path.abspath(file))
+        self.file_ids.append(_file_id(file))
+
+    def merge(self, other):
+        """Add a partial stack of other files to this stack."""
+        assert other.header_values == self.header_values
+        assert other.subtract_shuffled == self.subtract_shuffled
+
+        self.r_par += other.r_par
+        self.r_trans += other.r_trans
+        self.z += other.z
+        self.num_pairs += other.num_pairs
+        self.weights_total += other.weights_total
+        self.covariance.merge(other.covariance)
+
+        self.r_par_min = np.min([self.r_par_min, other.r_par_min])
+        self.r_par_max = np.max([self.r_par_max, other.r_par_max])
+        self.r_trans_max = np.max([self.r_trans_max, other.r_trans_max])
+        self.z_cut_min = np.min([self.z_cut_min, other.z_cut_min])
+        self.z_cut_max = np.max([self.z_cut_max, other.z_cut_max])
+
+        self.files += other.files
+        self.file_ids += other.file_ids
+
+    def save(self, path):
+        """Save the sufficient statistics to an npz file."""
+        meta = {
+            'header_values': self.header_values, 'subtract_shuffled': self.subtract_shuffled,
+            'r_par_min': float(self.r_par_min), 'r_par_max': float(self.r_par_max),
+            'r_trans_max': float(self.r_trans_max), 'z_cut_min': float(self.z_cut_min),
+            'z_cut_max': float(self.z_cut_max), 'files': self.files,
+            'file_ids': self.file_ids, 'num_rows': self.covariance.num_rows,
+        }
+
+        # Write to a temporary file first so that an interrupted job leaves the old stats
+        tmp_path = Path(str(path) + '.tmp.npz')
+        np.savez(
+            tmp_path, meta=json.dumps(meta), r_par=self.r_par, r_trans=self.r_trans,
+            z=self.z, num_pairs=self.num_pairs, weights_total=self.weights_total,
+            sum_weights=self.covariance.sum_weights,
+            sum_weighted_xi=self.covariance.sum_weighted_xi, mean=self.covariance.mean,
+            centered=self.covariance.centered, cross=self.covariance.cross,
+            weights_sq=self.covariance.weights_sq
+        )
+        tmp_path.replace(path)
+
+    @classmethod
+    def load(cls, path):
+        """Load the sufficient statistics saved by CorrelationStack.save."""
+        with np.load(path) as data:
+            meta = json.loads(str(data['meta']))
+            stack = cls(meta['header_values'], data['r_par'].size, meta['subtract_shuffled'])
+
+            for name in ['r_par', 'r_trans', 'z', 'num_pairs', 'weights_total']:
+                setattr(stack, name, data[name])
+            for name in ['sum_weights', 'sum_weighted_xi', 'mean', 'centered', 'cross',
+                         'weights_sq']:
+                setattr(stack.covariance, name, data[name])
+
+        stack.covariance.num_rows = meta['num_rows']
+        for name in ['r_par_min', 'r_par_max', 'r_trans_max', 'z_cut_min', 'z_cut_max',
+                     'files', 'file_ids']:
+            setattr(stack, name, meta[name])
+
+        return stack
+
+    def can_append(self, input_files, subtract_shuffled):
+        """Check that the stack can be updated with input_files instead of recomputed.
+
+        All the stacked files must be among the inputs and unchanged since they were added.
+        """
+        if subtract_shuffled != self.subtract_shuffled:
+            print('Shuffled correlation subtraction changed since the last stack.')
+            return False
 
-            xi_shuffled = hdul[2]['DA'][:]
-            weight_shuffled = hdul[2]['WE'][:]
-            xi_shuffled = (xi_shuffled * weight_shuffled).sum(axis=1)
-            weight_shuffled = weight_shuffled.sum(axis=1)
-            w = weight_shuffled > 0.
-            xi_shuffled[w] /= weight_shuffled[w]
-            xi_shuffled_list.append(xi_shuffled)
+        input_files = {os.path.abspath(file) for file in input_files}
+        for file, file_id in zip(self.files, self.file_ids):
+            if file not in input_files:
+                print(f'Stacked file {file} is no longer an input.')
+                return False
+            if not os.path.isfile(file) or _file_id(file) != file_id:
+                print(f'Stacked file {file} changed since it was added.')
+                return False
 
-    xi_shuffled = np.hstack(xi_shuffled_list)
-    return xi_shuffled[:, None]
+        return True
+
+
+def _stack_chunk(task):
+    header_values, num_bins, subtract_shuffled, files, shuffled_files, use_cache = task
+    stack = CorrelationStack(header_values, num_bins, subtract_shuffled)
+    for file, shuffled_file in zip(files, shuffled_files):
+        stack.add_file(file, shuffled_file, use_cache)
+
+    return stack
+
+
+def _reduce_chunks(tasks, nproc=1):
+    """Yield the partial stacks in task order, computed by up to nproc processes."""
+    if nproc is None or nproc <= 1:
+        for task in tasks:
+            yield _stack_chunk(task)
+        return
+
+    # Go through the tasks nproc at a time so only a few partial stacks are held in memory
+    with Pool(processes=nproc) as pool:
+        for start in range(0, len(tasks), nproc):
+            for stack in pool.map(_stack_chunk, tasks[start:start + nproc]):
+                yield stack
+
+
+def _reduce_chunks_mpi(comm, tasks):
+    """Yield the partial stacks in task order on rank 0, with the tasks spread over ranks.
+
+    Rank 0 receives the partial stacks one at a time, in order. The other ranks yield
+    nothing.
+    """
+    rank = comm.Get_rank()
+    size = comm.Get_size()
+    tasks = comm.bcast(tasks, root=0)
+
+    for i, task in enumerate(tasks):
+        owner = i % size
+        if rank == 0 and owner == 0:
+            yield _stack_chunk(task)
+        elif rank == 0:
+            yield comm.recv(source=owner, tag=i)
+        elif rank == owner:
+            comm.send(_stack_chunk(task), dest=0, tag=i)
+
+
+def _init_stack(input_files, output_file, shuffled_correlations, append, use_cache=False):
+    """Make the stack to update and the chunks of files still to be added to it."""
+    if shuffled_correlations is not None:
+        assert len(shuffled_correlations) == len(input_files)
+    subtract_shuffled = shuffled_correlations is not None
+
+    stack = None
+    if append and stats_path(output_file).is_file():
+        stack = CorrelationStack.load(stats_path(output_file))
+        if not stack.can_append(input_files, subtract_shuffled):
+            print('Recomputing the stack from scratch.')
+            stack = None
+    elif append:
+        print(f'No stack statistics found at {stats_path(output_file)}. Stacking all files.')
+
+    if stack is None:
+        stack = CorrelationStack.from_file(input_files[0], subtract_shuffled)
+
+    stacked_files = set(stack.files)
+    new_files = []
+    new_shuffled = []
+    for i, file in enumerate(input_files):
+        if os.path.abspath(file) in stacked_files:
+            continue
+
+        new_files.append(file)
+        new_shuffled.append(None if shuffled_correlations is None else shuffled_correlations[i])
+
+    tasks = [
+        (stack.header_values, stack.r_par.size, subtract_shuffled,
+         new_files[i:i + CHUNK_SIZE], new_shuffled[i:i + CHUNK_SIZE], use_cache)
+        for i in range(0, len(new_files), CHUNK_SIZE)
+    ]
+    return stack, tasks
 
 
 def stack_export_correlations(
-        input_files, output_file, smooth_cov_flag=True, dmat_path=None, shuffled_correlations=None):
+        input_files, output_file, smooth_cov_flag=True, dmat_path=None,
+        shuffled_correlations=None, append=False, nproc=1, use_mpi=False, use_cache=False):
     """Stacks correlation functions measured in different mocks.
+
+    The files are read in chunks of CHUNK_SIZE, each giving a partial stack, and the
+    partial stacks are merged in input order. The result is the same whether the chunks
+    are computed serially, by nproc processes or by MPI ranks.
     Parameters
     ----------
     input_files : list
@@ -35,99 +296,78 @@ def stack_export_correlations(
         Path to the output file.
     dmat_path : string
         Path to distortion matrix file, by default None
+    append : bool
+        Only add the input files missing from the statistics of a previous stack,
+        by default False. The stack is recomputed if it cannot be updated.
+    nproc : int
+        Number of processes reading the files, by default 1
+    use_mpi : bool
+        Spread the files over the MPI ranks instead, by default False. Rank 0 writes
+        the outputs.
+    use_cache : bool
+        Read the correlations from their float32 healpix caches, by default False
     """
-    # specify which header entries we want to check are consistent across all files being stacked
-    headers_to_check_match = ['NP', 'NT', 'OMEGAM', 'OMEGAR', 'OMEGAK', 'WL', 'NSIDE']
-
-    # initialize stack arrays, fill them with zeros
-    with fitsio.FITS(input_files[0]) as hdul:
-        r_par = hdul[1]['RP'][:] * 0
-        r_trans = hdul[1]['RT'][:] * 0
-        num_pairs = hdul[1]['NB'][:] * 0
-        z = hdul[1]['Z'][:] * 0
-        weights_total = r_par * 0
-
-        # get values of header entries to check with other files
-        header = hdul[1].read_header()
-        headers_to_check_match_values = {h: header[h] for h in headers_to_check_match}
-
-    xi_shuffled = None
-    if shuffled_correlations is not None:
-        assert len(shuffled_correlations) == len(input_files)
-        xi_shuffled = get_shuffled_correlations(shuffled_correlations,
-                                                headers_to_check_match_values)
-
-    # initialise header quantities
-    r_par_min = 1.e6
-    r_par_max = -1.e6
-    r_trans_max = -1.e6
-    z_cut_min = 1.e6
-    z_cut_max = -1.e6
-
-    xi = []
-    weights = []
-    healpixs = []
-
-    for file in input_files:
-        # Open the file and read the header
-        print("coadding file {}".format(file))
-        hdul = fitsio.FITS(file)
-        header = hdul[1].read_header()
+    comm = None
+    is_root = True
+    if use_mpi:
+        from mpi4py import MPI
+        comm = MPI.COMM_WORLD
+        is_root = comm.Get_rank() == 0
 
-        # Check that the header properties match those from the first file
-        for entry in headers_to_check_match:
-            assert header[entry] == headers_to_check_match_values[entry]
-
-        # Add weighted contributions from this file to stack variables
-        weights_aux = hdul[2]['WE'][:]
-        weights_total_aux = weights_aux.sum(axis=0)
-        r_par += hdul[1]['RP'][:] * weights_total_aux
-        r_trans += hdul[1]['RT'][:] * weights_total_aux
-        z += hdul[1]['Z'][:] * weights_total_aux
-        num_pairs += hdul[1]['NB'][:]
-        weights_total += weights_total_aux
+    stack, tasks = None, None
+    if is_root:
+        stack, tasks = _init_stack(
+            input_files, output_file, shuffled_correlations, append, use_cache)
 
-        # Update values to go in stack header
-        r_par_min = np.min([r_par_min, header['RPMIN']])
-        r_par_max = np.max([r_par_max, header['RPMAX']])
-        r_trans_max = np.max([r_trans_max, header['RTMAX']])
-        z_cut_min = np.min([z_cut_min, header['ZCUTMIN']])
-        z_cut_max = np.max([z_cut_max, header['ZCUTMAX']])
+    if use_mpi:
+        partial_stacks = _reduce_chunks_mpi(comm, tasks)
+    else:
+        partial_stacks = _reduce_chunks(tasks, nproc)
 
-        # Add the correlations to the stack
-        xi.append(hdul[2]["DA"][:])
-        weights.append(weights_aux)
-        healpixs.append(hdul[2]["HEALPID"][:])
+    num_old_files = 0 if stack is None else len(stack.files)
+    for partial_stack in partial_stacks:
+        stack.merge(partial_stack)
 
-        hdul.close()
+    if not is_root:
+        return
 
-    xi = np.vstack(xi)
-    weights = np.vstack(weights)
-    healpixs = np.hstack(healpixs)
+    print(f'Added {len(stack.files) - num_old_files} files to a stack of '
+          f'{len(stack.files)} files.')
+    stack.save(stats_path(output_file))
+    write_stack_export(stack, output_file, smooth_cov_flag, dmat_path)
 
-    if xi_shuffled is not None:
-        xi -= xi_shuffled
 
-    # normalize all other quantities by total weights
-    w = weights_total > 0
-    r_par[w] /= weights_total[w]
-    r_trans[w] /= weights_total[w]
-    z[w] /= weights_total[w]
+def write_stack_export(stack, output_file, smooth_cov_flag=True, dmat_path=None):
+    """Write the exported correlation of a stack.
+    Parameters
+    ----------
+    stack : CorrelationStack
+        Sufficient statistics of the stack
+    output_file : string
+        Path to the output file.
+    dmat_path : string
+        Path to distortion matrix file, by default None
+    """
+    headers_to_check_match_values = stack.header_values
+    r_par_min, r_par_max, r_trans_max = stack.r_par_min, stack.r_par_max, stack.r_trans_max
+    num_pairs = stack.num_pairs
 
-    delta_r_par = (r_par_max - r_par_min) / headers_to_check_match_values['NP']
-    delta_r_trans = (r_trans_max - 0.) / headers_to_check_match_values['NT']
+    # normalize all other quantities by total weights
+    r_par = stack.r_par.copy()
+    r_trans = stack.r_trans.copy()
+    z = stack.z.copy()
+    w = stack.weights_total > 0
+    r_par[w] /= stack.weights_total[w]
+    r_trans[w] /= stack.weights_total[w]
+    z[w] /= stack.weights_total[w]
 
+    xi = stack.covariance.mean.copy()
+    covariance = stack.covariance.covariance()
     if smooth_cov_flag:
         print("INFO: The covariance will be smoothed")
-        covariance = smooth_cov(
-            xi, weights, r_par, r_trans, delta_r_trans=delta_r_trans, delta_r_par=delta_r_par)
-    else:
-        covariance = compute_cov(xi, weights)
-
-    xi = (xi * weights).sum(axis=0)
-    weights = weights.sum(axis=0)
-    w = weights > 0
-    xi[w] /= weights[w]
+        binning = (headers_to_check_match_values['NP'], headers_to_check_match_values['NT'],
+                   float(r_par_min), float(r_par_max), float(r_trans_max))
+        covariance = smooth_covariance(covariance, [binning])
 
     try:
         scipy.linalg.cholesky(covariance)
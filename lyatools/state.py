@@ -0,0 +1,246 @@
+"""Persistent record of the pipeline stages run for a mock.
+
+Each directory tree (skewers, quickquasars run, analysis) gets an append-only JSON-lines
+file with one record per stage submission or status change. The latest record of a stage
+holds its inputs, outputs, job ids, status, wall time and output fingerprints. Checking a
+stage only reads this small file and stats the recorded outputs, instead of globbing
+through the mock directories, and tells a finished output apart from one left behind by a
+crashed job.
+"""
+import json
+import os
+import time
+from pathlib import Path
+
+STATE_FILENAME = 'pipeline_state.jsonl'
+ACTIVE_STATUSES = ['SUBMITTED', 'PENDING', 'RUNNING']
+
+
+def fingerprint(path):
+    """Cheap fingerprint of an output: size and mtime for files.
+
+    Directories are fingerprinted by their own mtime and those of their top-level
+    subdirectories, which change when files are added, removed or renamed in them. The
+    files themselves are not stat'ed, so checking a mock directory stays cheap.
+    """
+    path = Path(path)
+    if path.is_dir():
+        mtimes = {'.': path.stat().st_mtime_ns}
+        with os.scandir(path) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir():
+                        mtimes[entry.name] = entry.stat().st_mtime_ns
+                except OSError:
+                    continue
+        return {'dir_mtimes_ns': mtimes}
+    if not path.is_file():
+        return None
+
+    stat = path.stat()
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def _normalize(values):
+    # Round trip through json so that stored and freshly computed values compare equal
+    return json.loads(json.dumps(values, default=str, sort_keys=True))
+
+
+def _job_id_list(job_ids):
+    if job_ids is None:
+        return []
+    if not isinstance(job_ids, list):
+        job_ids = [job_ids]
+    return [int(j) for j in job_ids if j is not None and j > 0]
+
+
+def _any_resubmitted(job_ids):
+    # Inline steps have negative ids, they also regenerate their outputs
+    if job_ids is None:
+        return False
+    if not isinstance(job_ids, list):
+        job_ids = [job_ids]
+    return any(j is not None and j != 0 for j in job_ids)
+
+
+class PipelineState:
+    """Append-only JSON-lines store with the state of each pipeline stage in a directory.
+
+    Parameters
+    ----------
+    directory : str or Path
+        Directory where the state file lives (e.g. the analysis directory)
+    executor_name : str, optional
+        Name of the executor running the jobs, by default 'slurm'
+    """
+    def __init__(self, directory, executor_name='slurm'):
+        self.path = Path(directory) / STATE_FILENAME
+        self.executor_name = executor_name
+        self.records = {}
+
+        if self.path.is_file():
+            with open(self.path) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        # Partial line left by an interrupted write
+                        continue
+                    self.records[record['stage']] = record
+
+    def get(self, stage):
+        return self.records.get(stage)
+
+    def _append(self, record):
+        record['time'] = time.time()
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(record, default=str) + '\n')
+        self.records[record['stage']] = record
+
+    def record_submitted(self, stage, job_ids, inputs=None, outputs=None):
+        self._append({
+            'stage': stage, 'status': 'SUBMITTED', 'executor': self.executor_name,
+            'job_ids': _job_id_list(job_ids), 'inputs': _normalize(inputs),
+            'outputs': [str(path) for path in (outputs or [])],
+        })
+
+    def record_status(self, stage, status, wall_time=None):
+        record = dict(self.records[stage])
+        record['status'] = status
+        record['wall_time'] = wall_time
+        if status == 'COMPLETED':
+            record['checksums'] = {path: fingerprint(path) for path in record['outputs']}
+        self._append(record)
+
+    def record_completed(self, stage, inputs=None, outputs=None):
+        """Record a stage whose outputs were produced outside of this store."""
+        self.record_submitted(stage, None, inputs, outputs)
+        self.record_status(stage, 'COMPLETED')
+
+    def check(self, stage, inputs=None, upstream_job_ids=None):
+        """Return the status of a stage.
+
+        Returns one of 'missing' (no usable record), 'active' (queued or running),
+        'done', 'failed' or 'stale' (inputs or outputs changed since it completed, or an
+        upstream stage was just resubmitted).
+        """
+        record = self.records.get(stage)
+        if record is None or record['status'] == 'UNKNOWN':
+            return 'missing'
+
+        if record['status'] in ACTIVE_STATUSES:
+            return 'active'
+        if record['status'] != 'COMPLETED':
+            return 'failed'
+
+        if inputs is not None and record['inputs'] != _normalize(inputs):
+            return 'stale'
+        if _any_resubmitted(upstream_job_ids):
+            return 'stale'
+        for path, checksum in record.get('checksums', {}).items():
+            # Records written with older directory fingerprints only tell that it exists
+            if isinstance(checksum, dict) and ('dir' in checksum or 'digest' in checksum):
+                if not Path(path).is_dir():
+                    return 'stale'
+            elif fingerprint(path) != checksum:
+                return 'stale'
+
+        return 'done'
+
+    def run_stage(
+        self, stage, submit_func, inputs=None, outputs=None, prev_job_id=None, legacy_done=None
+    ):
+        """Run submit_func unless the stage is done or already queued.
+
+        Parameters
+        ----------
+        stage : str
+            Name of the stage
+        submit_func : callable
+            Function submitting the stage and returning its job id(s)
+        inputs : dict, optional
+            Values that determine the outputs of the stage, by default None
+        outputs : list, optional
+            Output paths to fingerprint once the stage completes, by default None
+        prev_job_id : int or list, optional
+            Job id(s) of the upstream stages submitted in this run, by default None
+        legacy_done : callable, optional
+            Check used when there is no record yet (e.g. outputs from older runs)
+
+        Returns
+        -------
+        int or list
+            Job id(s) that downstream stages should depend on
+        """
+        status = self.check(stage, inputs, prev_job_id)
+        if status == 'done':
+            print(f'Stage {stage} completed according to {self.path}. Skipping.')
+            return prev_job_id
+
+        if status == 'active':
+            job_ids = self.records[stage]['job_ids']
+            print(f'Stage {stage} already submitted as job(s) {job_ids}. Not resubmitting.')
+            return job_ids if len(job_ids) != 1 else job_ids[0]
+
+        if status == 'missing' and legacy_done is not None and legacy_done():
+            self.record_completed(stage, inputs, outputs)
+            return prev_job_id
+
+        if status in ['failed', 'stale']:
+            print(f'Stage {stage} is {status}. Resubmitting.')
+
+        job_id = submit_func()
+        if len(_job_id_list(job_id)) > 0:
+            self.record_submitted(stage, job_id, inputs, outputs)
+
+        return job_id
+
+
+def refresh_states(states, executor):
+    """Update the records of active stages with the job states known to the executor.
+
+    All the job ids are queried in one call to the executor. Stages with a job the
+    executor knows nothing about keep their recorded status. Stages left active by
+    another executor (e.g. an interrupted local run) cannot be checked, so they are
+    marked UNKNOWN and run again.
+    """
+    active = []
+    for state in states:
+        for stage, record in list(state.records.items()):
+            if record['status'] not in ACTIVE_STATUSES:
+                continue
+            if record['executor'] != executor.name:
+                state.record_status(stage, 'UNKNOWN')
+                continue
+            active.append((state, stage, record['job_ids']))
+
+    all_ids = sorted({job_id for _, _, job_ids in active for job_id in job_ids})
+    if len(all_ids) == 0:
+        return
+
+    job_states = executor.job_states(all_ids)
+    for state, stage, job_ids in active:
+        # A failed query, or a job aged out of the accounting database, tells nothing
+        # about the job. Keep its recorded status rather than running it again.
+        if any(job_id not in job_states for job_id in job_ids):
+            continue
+
+        statuses = [job_states[job_id][0] for job_id in job_ids]
+        wall_times = [job_states[job_id][1] for job_id in job_ids]
+
+        if any(status in ['FAILED', 'TIMEOUT'] for status in statuses):
+            new_status = 'FAILED'
+        elif all(status == 'COMPLETED' for status in statuses):
+            new_status = 'COMPLETED'
+        elif any(status == 'RUNNING' for status in statuses):
+            new_status = 'RUNNING'
+        else:
+            new_status = 'PENDING'
+
+        if new_status == state.records[stage]['status']:
+            continue
+
+        wall_time = None
+        if new_status == 'COMPLETED' and None not in wall_times:
+            wall_time = max(wall_times)
+        state.record_status(stage, new_status, wall_time)
@@ -1,10 +1,13 @@
 import os
+import re
+import shlex
 import numpy as np
 from subprocess import run
 from pathlib import Path
 from typing import Union
 
 import lyatools
+from lyatools import executors, inline, provenance
 
 
 def get_seed_list(qq_seeds):
@@ -83,9 +86,39 @@ def make_header(machine: str = 'perl', queue: str = 'regular', nodes: int = int(
     header += 'umask 0007\n'
     header += f'export OMP_NUM_THREADS={omp_threads}\n\n'
 
+    if _INSTRUMENT_JOBS:
+        header += make_perf_wrapper(job_name, Path(err_file).parent / PERF_FILENAME)
+
     return header
 
 
+PERF_FILENAME = 'perf.jsonl'
+_INSTRUMENT_JOBS = False
+
+
+def set_instrumentation(enabled):
+    """Make every job script record its timing and resource use (see make_perf_wrapper)."""
+    global _INSTRUMENT_JOBS
+    _INSTRUMENT_JOBS = enabled
+
+
+def make_perf_wrapper(stage, perf_log):
+    """Lines making a job script re-run itself through lyatools/scripts/perf_wrap.py.
+
+    The wrapper appends a JSON record with the start and end time, peak memory and I/O of
+    the job to perf_log, which is next to the job logs of the directory tree. The script is
+    re-run as a login shell, like the #!/bin/bash -l it was started with, so that the
+    environment commands defined in the user's profile are available.
+    """
+    wrapper = find_path('lyatools/scripts/perf_wrap.py', enforce=True)
+    text = 'if [ -z "$LYATOOLS_PERF_WRAPPED" ]; then\n'
+    text += '    export LYATOOLS_PERF_WRAPPED=1\n'
+    text += (f'    exec python3 {shlex.quote(str(wrapper))} --log {shlex.quote(str(perf_log))} '
+             f'--stage {shlex.quote(str(stage))} -- bash -l "$0" "$@"\n')
+    text += 'fi\n\n'
+    return text
+
+
 def write_script(script_path, text):
     with open(script_path, 'w+') as f:
         f.write(text)
@@ -93,6 +126,177 @@ def write_script(script_path, text):
     make_file_executable(script_path)
 
 
+_EXECUTOR = None
+
+
+def get_executor():
+    """Return the executor used by run_job. Defaults to submitting with sbatch."""
+    global _EXECUTOR
+    if _EXECUTOR is None:
+        _EXECUTOR = executors.SlurmExecutor()
+    return _EXECUTOR
+
+
+def set_executor(executor):
+    """Set the executor used by run_job (see lyatools.executors)."""
+    global _EXECUTOR
+    _EXECUTOR = executor
+
+
+def wait_for_jobs():
+    """Wait for the jobs run by the current executor. Returns immediately for Slurm."""
+    return get_executor().wait()
+
+
+_RUNTIME_MODEL = None
+
+
+def set_runtime_model(model):
+    """Set the runtime history used to size the jobs (see lyatools.runtime_model)."""
+    global _RUNTIME_MODEL
+    _RUNTIME_MODEL = model
+
+
+def get_runtime_model():
+    return _RUNTIME_MODEL
+
+
+def job_hours(key, default_hours, size=None):
+    """Walltime in hours for a job, from the runtime history if there is one."""
+    if _RUNTIME_MODEL is None:
+        return default_hours
+
+    hours = _RUNTIME_MODEL.hours(key, default_hours, size)
+    if hours != default_hours:
+        print(f'Requesting {hours:.2f} hours for {key["stage"]} based on previous runs.')
+    return hours
+
+
+def record_job(job_id, key, size=None, nodes=1, catalog=None):
+    """Add a submitted job to the runtime history, if there is one.
+
+    Without a size, the size of the catalog is read when the job is harvested.
+    """
+    if _RUNTIME_MODEL is None or not isinstance(job_id, int):
+        return
+    _RUNTIME_MODEL.register(job_id, key, size, nodes, catalog)
+
+
+_INLINE_RUNNER = None
+_INLINE_MAX_NODE_HOURS = 0.
+_INLINE_MAX_WORKERS = 8
+
+
+def set_inline_mode(max_node_hours, max_workers=8):
+    """Run the jobs estimated to cost less than max_node_hours inline (see lyatools.inline).
+
+    A value of 0 disables the inline mode, except for the steps forced inline, which still
+    use max_workers processes.
+    """
+    global _INLINE_RUNNER, _INLINE_MAX_NODE_HOURS, _INLINE_MAX_WORKERS
+    _INLINE_MAX_NODE_HOURS = max_node_hours
+    _INLINE_MAX_WORKERS = max_workers
+    if _INLINE_RUNNER is not None:
+        _INLINE_RUNNER.shutdown()
+    _INLINE_RUNNER = inline.InlineRunner(max_workers) if max_node_hours > 0 else None
+
+
+def _limit_nproc(command):
+    """Share the cores of the current node between the inline workers."""
+    nproc = max((os.cpu_count() or 1) // _INLINE_MAX_WORKERS, 1)
+    return re.sub(r'--nproc(\s+|=)(\d+)',
+                  lambda match: f'--nproc{match.group(1)}{min(int(match.group(2)), nproc)}',
+                  command)
+
+
+def wait_for_inline():
+    """Wait for all the inline steps and raise if any of them failed."""
+    if _INLINE_RUNNER is None:
+        return {}
+
+    return_codes = _INLINE_RUNNER.wait()
+    failed = _INLINE_RUNNER.failed(return_codes)
+    if failed:
+        raise RuntimeError('Failed inline steps:\n    ' + '\n    '.join(failed))
+
+    return return_codes
+
+
+def _split_dependencies(dependency_ids):
+    if isinstance(dependency_ids, int):
+        dependency_ids = [dependency_ids]
+    elif not isinstance(dependency_ids, list):
+        dependency_ids = []
+
+    inline_deps = [j for j in dependency_ids if inline.is_inline_id(j)]
+    valid_deps = [j for j in dependency_ids if (j is not None and j > 0)]
+    return inline_deps, valid_deps
+
+
+def can_run_inline(node_hours, dependency_ids=None, force_inline=False):
+    """Whether a job with this cost and dependencies would be run inline by run_command_job."""
+    _, valid_deps = _split_dependencies(dependency_ids)
+    cheap = node_hours < _INLINE_MAX_NODE_HOURS or force_inline
+    return cheap and len(valid_deps) == 0
+
+
+def run_command_job(command, header, env_command, script_path, log_file, node_hours,
+                    dependency_ids=None, no_submit=False, force_inline=False,
+                    runtime_key=None):
+    """Run a job command inline if it is cheap enough, otherwise submit it with run_job
+
+    The command is run inline (see lyatools.inline) if its estimated cost is below the
+    inline_max_node_hours threshold (or force_inline is set) and it only depends on other
+    inline steps. Otherwise the job script is written to script_path and submitted.
+
+    Parameters
+    ----------
+    command : str
+        Commands to run, one per line
+    header : str
+        Slurm header of the job script
+    env_command : str
+        Command setting up the environment in the job script
+    script_path : Path
+        Path of the job script
+    log_file : Path
+        Path of the log of the inline step
+    node_hours : float
+        Estimated cost of the job in node hours (e.g. nodes * requested hours)
+    dependency_ids : int or list, optional
+        Job ids that must finish successfully before this job starts, by default None
+    no_submit : bool, optional
+        flag for submitting the job, by default False
+    force_inline : bool, optional
+        Run the command inline regardless of its cost, by default False
+    runtime_key : dict, optional
+        Key of the job in the runtime history, by default None
+
+    Returns
+    -------
+    int
+        Job id, negative for inline steps
+    """
+    if can_run_inline(node_hours, dependency_ids, force_inline):
+        inline_deps, _ = _split_dependencies(dependency_ids)
+        if no_submit:
+            print(f'No submit active. Inline command prepared: {command.strip()}')
+            return None
+
+        global _INLINE_RUNNER
+        if _INLINE_RUNNER is None:
+            _INLINE_RUNNER = inline.InlineRunner(_INLINE_MAX_WORKERS)
+        return _INLINE_RUNNER.submit(
+            _limit_nproc(command), Path(script_path).stem, log_file, inline_deps)
+
+    write_script(script_path, header + f'{env_command}\n\n' + command)
+    job_id = run_job(script_path, dependency_ids=dependency_ids, no_submit=no_submit)
+    if runtime_key is not None:
+        record_job(job_id, runtime_key)
+
+    return job_id
+
+
 def run_job(script, dependency_ids=None, no_submit=False):
     """Make a job script and run it
 
@@ -100,34 +304,30 @@ def run_job(script, dependency_ids=None, no_submit=False):
     ----------
     script : str
         Path where script will pe written
+    dependency_ids : int or list, optional
+        Job ids that must finish successfully before this job starts, by default None
     no_submit : bool, optional
         flag for submitting the job, by default False
     """
-    dependency = ""
-    if isinstance(dependency_ids, int) and dependency_ids > 0:
-        dependency = f"--dependency=afterok:{dependency_ids} "
-    elif isinstance(dependency_ids, list) and len(dependency_ids) > 0:
-        valid_deps = [str(j) for j in dependency_ids if (j is not None and j > 0)]
-        if valid_deps:
-            dependency = f"--dependency=afterok:{':'.join(valid_deps)} "
+    inline_deps, valid_deps = _split_dependencies(dependency_ids)
 
-    command = f"sbatch {dependency}{script}"
+    # Slurm cannot wait for the inline steps, so wait for them here
+    if len(inline_deps) > 0 and not no_submit:
+        print(f'Waiting for inline step(s) {inline_deps} before submitting {script}')
+        return_codes = _INLINE_RUNNER.wait(inline_deps)
+        failed = _INLINE_RUNNER.failed(return_codes)
+        if failed:
+            raise RuntimeError(f'Cannot submit {script} because inline step(s) failed: '
+                               + ', '.join(failed))
 
     jobid = None
     if not no_submit:
-        print(f'Submitting script {script}')
-        process = run(command + " | tr -dc '0-9'", shell=True, capture_output=True)
-
-        if process.returncode != 0:
-            raise ValueError(f'Running "sbatch {dependency}{script}" returned non-zero exitcode '
-                             f'with error {process.stderr}')
-
-        try:
-            jobid = int(process.stdout)
-        except ValueError:
-            raise ValueError(f'Error getting jobid from output: {process.stdout}')
+        jobid = get_executor().submit(script, valid_deps)
+        with open(script) as f:
+            provenance.record_job(f.read(), jobid, get_executor().name)
     else:
-        print(f'No submit active. Command prepared: {command}')
+        dependency = executors.make_dependency_string(valid_deps)
+        print(f'No submit active. Command prepared: sbatch {dependency}{script}')
 
     return jobid
 
@@ -0,0 +1,142 @@
+"""Run the export commands inside the current interpreter instead of a new shell.
+
+The commands written by lyatools are chains of Python scripts joined with "&&" (e.g.
+picca_export.py ... && lyatools-write-provenance ...). Each script is found on the PATH
+and executed with runpy, with sys.argv set to its arguments and stdout/stderr captured.
+A long-lived worker only pays the interpreter startup and the picca, numpy, scipy and
+astropy imports once, instead of once per command.
+
+Commands that need a shell (pipes, redirections, variables, ...) and programs that are
+not Python scripts are run with subprocess as before.
+"""
+import io
+import runpy
+import shlex
+import shutil
+import sys
+import traceback
+from contextlib import redirect_stdout, redirect_stderr
+from subprocess import run
+
+SHELL_CHARACTERS = set('|;<>$`()*?~{}\n')
+
+_SCRIPT_PATHS = {}
+
+
+def split_command(command):
+    """Split a command into the argument lists of its "&&" separated steps.
+
+    Returns None if the command needs a shell.
+    """
+    if any(char in SHELL_CHARACTERS for char in command):
+        return None
+
+    try:
+        tokens = shlex.split(command)
+    except ValueError:
+        return None
+
+    steps = [[]]
+    for token in tokens:
+        if token == '&&':
+            steps.append([])
+        elif token == '&':
+            return None
+        else:
+            steps[-1].append(token)
+
+    # Empty steps or leading environment variable assignments
+    if any(len(step) == 0 or '=' in step[0] for step in steps):
+        return None
+
+    return steps
+
+
+def find_python_script(program):
+    """Path to program if it is a Python script on the PATH, None otherwise."""
+    if program not in _SCRIPT_PATHS:
+        path = shutil.which(program)
+        if path is not None:
+            with open(path, 'rb') as f:
+                first_line = f.readline()
+            if not (first_line.startswith(b'#!') and b'python' in first_line):
+                path = None
+
+        _SCRIPT_PATHS[program] = path
+
+    return _SCRIPT_PATHS[program]
+
+
+def _exit_code(code, stderr):
+    if code is None:
+        return 0
+    if isinstance(code, int):
+        return code
+
+    stderr.write(f'{code}\n')
+    return 1
+
+
+def run_in_process(script_path, args):
+    """Run a Python script as __main__ and return its exit code, stdout and stderr."""
+    stdout = io.StringIO()
+    stderr = io.StringIO()
+    old_argv = sys.argv
+    sys.argv = [script_path] + list(args)
+
+    returncode = 0
+    try:
+        with redirect_stdout(stdout), redirect_stderr(stderr):
+            runpy.run_path(script_path, run_name='__main__')
+    except SystemExit as exit:
+        returncode = _exit_code(exit.code, stderr)
+    except Exception:
+        stderr.write(traceback.format_exc())
+        returncode = 1
+    finally:
+        sys.argv = old_argv
+
+    return returncode, stdout.getvalue(), stderr.getvalue()
+
+
+def run_subprocess(command):
+    """Run a command in a shell and return its exit code, stdout and stderr."""
+    process = run(command, shell=True, capture_output=True)
+    return process.returncode, process.stdout.decode('utf-8'), process.stderr.decode('utf-8')
+
+
+def run_command(command, in_process=True):
+    """Run a command, in process where possible.
+
+    Parameters
+    ----------
+    command : str
+        Shell command to run
+    in_process : bool, optional
+        Run the Python scripts of the command in this interpreter, by default True
+
+    Returns
+    -------
+    (int, str, str)
+        Exit code, stdout and stderr of the command
+    """
+    steps = split_command(command) if in_process else None
+    if steps is None:
+        return run_subprocess(command)
+
+    stdout = []
+    stderr = []
+    returncode = 0
+    for step in steps:
+        script_path = find_python_script(step[0])
+        if script_path is None:
+            returncode, out, err = run_subprocess(shlex.join(step))
+        else:
+            returncode, out, err = run_in_process(script_path, step[1:])
+
+        stdout.append(out)
+        stderr.append(err)
+        if returncode != 0:
+            break
+
+    return returncode, ''.join(stdout), ''.join(stderr)
@@ -0,0 +1,74 @@
+"""Injection of redshift errors into QSO catalogs.
+
+The input catalog is read once and any number of variants, each with its own
+distribution, amplitude and seed, are written from it. This only needs numpy and fitsio,
+so it is cheap enough to run inline instead of as a separate job.
+"""
+from dataclasses import dataclass
+from pathlib import Path
+
+import fitsio
+import numpy as np
+from scipy.constants import speed_of_light
+
+DISTRIBUTIONS = ['gauss', 'lorentz']
+LORENTZ_CUT = 2000
+
+
+@dataclass
+class ZerrVariant:
+    """One catalog with redshift errors: distribution, amplitude in km/s, seed and path."""
+    distribution: str
+    amplitude: float
+    seed: int
+    output: Path
+
+    def __post_init__(self):
+        if self.distribution not in DISTRIBUTIONS:
+            raise ValueError(f'Unkown distribution "{self.distribution}". '
+                             f'Choose from {DISTRIBUTIONS}.')
+        self.amplitude = float(self.amplitude)
+        self.seed = int(self.seed)
+        self.output = Path(self.output)
+
+
+def truncated_lorentzian(rng, scale, size, cut=LORENTZ_CUT):
+    """Draw Lorentzian (Cauchy) samples centred on 0, truncated to |x| < cut.
+
+    Uses the inverse CDF, x = scale * tan(pi * (u - 1/2)), with u drawn uniformly
+    between CDF(-cut) and CDF(cut), so no samples are rejected.
+    """
+    u_max = np.arctan(cut / scale) / np.pi
+    u = rng.uniform(-u_max, u_max, size)
+    return scale * np.tan(np.pi * u)
+
+
+def draw_velocity_errors(distribution, amplitude, size, seed, cut=LORENTZ_CUT):
+    """Draw size velocity errors in km/s."""
+    rng = np.random.RandomState(seed)
+    if distribution == 'gauss':
+        return rng.normal(0, amplitude, size)
+    elif distribution == 'lorentz':
+        return truncated_lorentzian(rng, amplitude, size, cut)
+
+    raise ValueError(f'Unkown distribution "{distribution}".')
+
+
+def write_zerr_catalogs(input_cat, variants):
+    """Read input_cat once and write one catalog with redshift errors for each variant."""
+    with fitsio.FITS(input_cat) as hdul:
+        header = hdul[1].read_header()
+        data = hdul[1].read()
+
+    z_true = data['Z'].copy()
+
+    for variant in variants:
+        print(f'Distribution: {variant.distribution}, Amplitude: {variant.amplitude}, '
+              f'Seed: {variant.seed}. Writing {variant.output}')
+        dv = draw_velocity_errors(variant.distribution, variant.amplitude, z_true.size,
+                                  variant.seed)
+        # Velocity in km/s to redshift offset, in the same order of operations as before
+        data['Z'] = z_true + dv / (speed_of_light / 1e3) * (1 + z_true)
+
+        with fitsio.FITS(variant.output, 'rw', clobber=True) as results:
+            results.write(data, header=header)
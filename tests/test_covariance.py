@@ -0,0 +1,103 @@
+import numpy as np
+import pytest
+from picca.utils import compute_cov, smooth_cov
+
+from lyatools.covariance import (
+    StreamingCovariance, bin_grid, compute_covariance, smooth_covariance
+)
+
+BINNING = (5, 4, 0., 20., 16.)
+
+
+def random_correlations(rng, num_rows=200, num_bins=12):
+    xi = rng.normal(0., 0.1, (num_rows, num_bins))
+    weights = rng.uniform(0., 10., (num_rows, num_bins))
+    weights[rng.random(weights.shape) < 0.1] = 0.
+    # A bin without any weight
+    weights[:, -1] = 0.
+    return xi, weights
+
+
+def assert_close_covariance(covariance, expected):
+    scale = np.abs(expected).max()
+    np.testing.assert_allclose(covariance, expected, rtol=0, atol=1e-14 * scale)
+
+
+def test_compute_covariance_matches_picca():
+    xi, weights = random_correlations(np.random.default_rng(2))
+    assert_close_covariance(compute_covariance(xi, weights), compute_cov(xi, weights))
+
+
+def test_compute_covariance_of_float32_correlations():
+    xi, weights = random_correlations(np.random.default_rng(7))
+    xi = xi.astype(np.float32)
+    weights = weights.astype(np.float32)
+
+    covariance = compute_covariance(xi, weights)
+    assert covariance.dtype == np.float64
+    assert_close_covariance(
+        covariance, compute_cov(xi.astype(float), weights.astype(float)))
+
+
+@pytest.mark.parametrize('chunk_size', [1, 7, 200])
+def test_streaming_covariance_matches_picca(chunk_size):
+    xi, weights = random_correlations(np.random.default_rng(3))
+
+    streaming = StreamingCovariance(xi.shape[1])
+    for start in range(0, xi.shape[0], chunk_size):
+        streaming.add(xi[start:start + chunk_size], weights[start:start + chunk_size])
+
+    assert streaming.num_rows == xi.shape[0]
+    assert_close_covariance(streaming.covariance(), compute_cov(xi, weights))
+
+
+def test_merged_streaming_covariance_matches_picca():
+    xi, weights = random_correlations(np.random.default_rng(4))
+
+    parts = []
+    for rows in np.array_split(np.arange(xi.shape[0]), 3):
+        part = StreamingCovariance(xi.shape[1])
+        part.add(xi[rows], weights[rows])
+        parts.append(part)
+
+    merged = parts[0]
+    for part in parts[1:]:
+        merged.merge(part)
+
+    assert merged.num_rows == xi.shape[0]
+    assert_close_covariance(merged.covariance(), compute_cov(xi, weights))
+
+
+def test_smooth_covariance_matches_picca():
+    rng = np.random.default_rng(5)
+    num_bins = BINNING[0] * BINNING[1]
+    xi = rng.normal(0., 0.1, (300, num_bins))
+    weights = rng.uniform(0.5, 10., (300, num_bins))
+    covariance = compute_cov(xi, weights)
+
+    r_par, r_trans, delta_r_par, delta_r_trans = bin_grid(BINNING)
+    expected = smooth_cov(xi, weights, r_par, r_trans, delta_r_trans=delta_r_trans,
+                          delta_r_par=delta_r_par, covariance=covariance)
+
+    assert_close_covariance(smooth_covariance(covariance, [BINNING]), expected)
+
+
+def test_smooth_covariance_blocks():
+    rng = np.random.default_rng(6)
+    other_binning = (3, 4, -12., 12., 16.)
+    num_bins = BINNING[0] * BINNING[1]
+    xi = rng.normal(0., 0.1, (300, num_bins + 12))
+    weights = rng.uniform(0.5, 10., (300, num_bins + 12))
+    covariance = compute_cov(xi, weights)
+
+    smoothed = smooth_covariance(covariance, [BINNING, other_binning])
+
+    # The diagonal blocks are smoothed on their own
+    assert_close_covariance(
+        smoothed[:num_bins, :num_bins],
+        smooth_covariance(covariance[:num_bins, :num_bins], [BINNING]))
+    assert_close_covariance(
+        smoothed[num_bins:, num_bins:],
+        smooth_covariance(covariance[num_bins:, num_bins:], [other_binning]))
+    np.testing.assert_array_equal(smoothed, smoothed.T)
+    np.testing.assert_allclose(np.diagonal(smoothed), np.diagonal(covariance), rtol=1e-14)
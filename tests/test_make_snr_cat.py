@@ -0,0 +1,78 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('desispec')
+from lyatools.scripts import make_snr_cat  # noqa: E402
+
+
+def per_target_snr(wave, flux, ivar, z, nciv=None, vmin=None, vmax=None):
+    """The per-target loop of getsnr replaced by compute_snr."""
+    bluesnrlist, redsnrlist = [], []
+    for entry in range(flux.shape[0]):
+        spec_flux = flux[entry]
+        spec_ivar = ivar[entry].copy()
+        wave_rf = wave / (1 + z[entry])
+
+        if nciv is not None:
+            for n in range(nciv[entry]):
+                v_max = -vmax[entry][n] / make_snr_cat.c + 1.
+                v_min = -vmin[entry][n] / make_snr_cat.c + 1.
+
+                for line, lam in make_snr_cat.bal_lines.items():
+                    mask = np.logical_and(wave_rf > lam * v_max, wave_rf < lam * v_min)
+                    spec_ivar[mask] = 0
+
+        mask = np.logical_and(
+            spec_ivar != 0, np.ma.masked_inside(
+                wave_rf, make_snr_cat.bluesnr_min, make_snr_cat.bluesnr_max).mask)
+        if np.sum(mask) > 0:
+            bluesnr = np.mean((spec_flux[mask]*np.sqrt(spec_ivar[mask])))
+        else:
+            bluesnr = np.nan
+
+        mask = np.logical_and(
+            spec_ivar != 0, np.ma.masked_inside(
+                wave_rf, make_snr_cat.redsnr_min, make_snr_cat.redsnr_max).mask)
+        if np.sum(mask) > 0:
+            redsnr = np.mean((spec_flux[mask]*np.sqrt(spec_ivar[mask])))
+        else:
+            redsnr = np.nan
+
+        bluesnrlist.append(bluesnr)
+        redsnrlist.append(redsnr)
+
+    return np.array(bluesnrlist, dtype=float), np.array(redsnrlist, dtype=float)
+
+
+def synthetic_healpix(dtype, num_spec=60, seed=0):
+    """Resampled spectra of a small healpix file, with masked pixels and BALs."""
+    rng = np.random.default_rng(seed)
+    wave = np.arange(3600., 9824., 0.8)
+    z = rng.uniform(1.8, 3.8, num_spec)
+    flux = rng.normal(1., 0.5, (num_spec, wave.size)).astype(dtype)
+    ivar = rng.uniform(0.5, 4., (num_spec, wave.size)).astype(dtype)
+    ivar[rng.random(ivar.shape) < 0.05] = 0
+    # Spectra without any valid pixel in the windows
+    ivar[0] = 0
+    ivar[1, wave / (1 + z[1]) < 1300] = 0
+
+    nciv = rng.integers(0, 4, num_spec)
+    nciv[:num_spec // 2] = 0
+    vmin = np.where(np.arange(5) < nciv[:, None], rng.uniform(2000., 10000., (num_spec, 5)), -1.)
+    vmax = np.where(vmin > 0, vmin + rng.uniform(1000., 8000., (num_spec, 5)), -1.)
+    return wave, flux, ivar, z, nciv, vmin, vmax
+
+
+@pytest.mark.parametrize('dtype', [np.float64, np.float32])
+@pytest.mark.parametrize('with_bals', [False, True])
+def test_compute_snr_matches_per_target_loop(dtype, with_bals):
+    wave, flux, ivar, z, nciv, vmin, vmax = synthetic_healpix(dtype)
+    if not with_bals:
+        nciv, vmin, vmax = None, None, None
+
+    bluesnr, redsnr = make_snr_cat.compute_snr(wave, flux, ivar, z, nciv, vmin, vmax)
+    expected_blue, expected_red = per_target_snr(wave, flux, ivar, z, nciv, vmin, vmax)
+
+    assert np.isnan(bluesnr[0]) and np.isnan(redsnr[0])
+    np.testing.assert_array_equal(bluesnr, expected_blue)
+    np.testing.assert_array_equal(redsnr, expected_red)
@@ -0,0 +1,64 @@
+import fitsio
+import numpy as np
+import pytest
+
+from lyatools.stack import CHUNK_SIZE, _init_stack, _reduce_chunks
+
+NUM_RP = 4
+NUM_RT = 3
+
+
+def write_correlation(path, rng, num_healpix=20):
+    """Small picca-like correlation file with its healpix rows in random order."""
+    num_bins = NUM_RP * NUM_RT
+    header = [
+        {'name': 'NP', 'value': NUM_RP}, {'name': 'NT', 'value': NUM_RT},
+        {'name': 'RPMIN', 'value': 0.}, {'name': 'RPMAX', 'value': 16.},
+        {'name': 'RTMAX', 'value': 12.}, {'name': 'ZCUTMIN', 'value': 0.},
+        {'name': 'ZCUTMAX', 'value': 10.}, {'name': 'OMEGAM', 'value': 0.315},
+        {'name': 'OMEGAR', 'value': 0.}, {'name': 'OMEGAK', 'value': 0.},
+        {'name': 'WL', 'value': -1.}, {'name': 'NSIDE', 'value': 16},
+    ]
+    healpix = rng.permutation(np.arange(100, 100 + num_healpix))
+    weights = rng.uniform(0., 10., (num_healpix, num_bins))
+    weights[rng.random(weights.shape) < 0.1] = 0.
+
+    with fitsio.FITS(path, 'rw', clobber=True) as results:
+        results.write(
+            [rng.uniform(0, 16, num_bins), rng.uniform(0, 12, num_bins),
+             rng.uniform(2, 3, num_bins), rng.integers(0, 1000, num_bins)],
+            names=['RP', 'RT', 'Z', 'NB'], header=header, extname='ATTRI')
+        results.write(
+            [healpix, weights, rng.normal(0., 0.1, (num_healpix, num_bins))],
+            names=['HEALPID', 'WE', 'DA'], extname='COR')
+
+
+def stack_files(files, output_file, nproc, use_cache=False):
+    stack, tasks = _init_stack(files, output_file, None, append=False, use_cache=use_cache)
+    for partial_stack in _reduce_chunks(tasks, nproc):
+        stack.merge(partial_stack)
+    return stack
+
+
+@pytest.mark.parametrize('use_cache', [False, True])
+def test_stack_does_not_depend_on_nproc(tmp_path, use_cache):
+    rng = np.random.default_rng(1)
+    files = []
+    for i in range(3 * CHUNK_SIZE - 1):
+        files.append(tmp_path / f'cf_{i}.fits')
+        write_correlation(files[-1], rng)
+
+    serial = stack_files(files, tmp_path / 'stack.fits', 1, use_cache)
+    parallel = stack_files(files, tmp_path / 'stack.fits', 3, use_cache)
+
+    assert parallel.files == serial.files
+    assert parallel.covariance.num_rows == serial.covariance.num_rows
+    # Stacked DA and WE
+    np.testing.assert_array_equal(parallel.covariance.mean, serial.covariance.mean)
+    np.testing.assert_array_equal(parallel.weights_total, serial.weights_total)
+    for name in ['r_par', 'r_trans', 'z', 'num_pairs']:
+        np.testing.assert_array_equal(getattr(parallel, name), getattr(serial, name))
+    # Accumulated per-healpix blocks
+    for name in ['sum_weights', 'sum_weighted_xi', 'centered', 'cross', 'weights_sq']:
+        np.testing.assert_array_equal(
+            getattr(parallel.covariance, name), getattr(serial.covariance, name))